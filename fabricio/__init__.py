@@ -1,12 +1,13 @@
 import hashlib
-import sys
 
 from fabric import colors, api as fab
 
-from fabricio import utils
+from fabricio.context import ExecutionContext, get_current_stream
 
 fab.env.setdefault('infrastructure', None)
 
+fab.env.setdefault('persistent_shell', False)
+
 
 def _command(
     fabric_method,
@@ -35,8 +36,8 @@ def _command(
 def run(
     command,
     sudo=False,
-    stdout=sys.stdout,
-    stderr=sys.stderr,
+    stdout=None,
+    stderr=None,
     use_cache=False,
     **kwargs
 ):
@@ -50,6 +51,13 @@ def run(
         if cache_key in run.cache:
             return _command(fabric_method=from_cache, command=command, **kwargs)
     fabric_method = sudo and fab.sudo or fab.run
+    # Fabric writes remote output from its own threads which know nothing
+    # about execution context of the current one
+    stdout = stdout or get_current_stream('stdout')
+    stderr = stderr or get_current_stream('stderr')
+    if fab.env.persistent_shell and not sudo:
+        from fabricio import shell
+        fabric_method = shell.run
     result = _command(
         fabric_method=fabric_method,
         command=command,
@@ -83,8 +91,11 @@ def local(command, use_cache=False, **kwargs):
 local.cache = {}
 
 
-def log(message, color=colors.yellow, output=sys.stdout):
-    with utils.patch(sys, 'stdout', output):
+def log(message, color=colors.yellow, output=None):
+    if output is None:
+        # `sys.stdout` is resolved by the current execution context
+        return fab.puts(color(message))
+    with ExecutionContext(stdout=output):
         fab.puts(color(message))
 
 
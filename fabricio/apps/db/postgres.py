@@ -1,4 +1,3 @@
-import multiprocessing
 import os
 import warnings
 
@@ -287,7 +286,15 @@ class PostgresqlContainer(docker.Container):
             fabricio.remove(hba_conf_backup, ignore_errors=True, sudo=True)
         return True
 
-    def revert(self):
+    def is_up_to_date(self, image_id):
+        return False  # config files are checked only by update
+
+    def revert(self, generation=1):
+        if generation != 1:
+            fab.abort(
+                "PostgresqlContainer can be reverted to the previous version "
+                "only because backup of config files is kept only for it."
+            )
         main_conf = os.path.join(self.pg_data, 'postgresql.conf')
         main_conf_backup = main_conf + '.backup'
         hba_conf = os.path.join(self.pg_data, 'pg_hba.conf')
@@ -336,6 +343,7 @@ class StreamingReplicatedPostgresqlContainer(PostgresqlContainer):
     def __init__(self, *args, **kwargs):
         super(StreamingReplicatedPostgresqlContainer, self).__init__(
             *args, **kwargs)
+        import multiprocessing
         self.master_obtained = multiprocessing.Event()
         self.master_lock = multiprocessing.Lock()
         self.multiprocessing_data = data = multiprocessing.Manager().Namespace()
@@ -474,7 +482,7 @@ class StreamingReplicatedPostgresqlContainer(PostgresqlContainer):
             # reset state at the end to prevent fail of the next Fabric command
             self.master_obtained.clear()
 
-    def revert(self):
+    def revert(self, generation=1):
         if not self.pg_recovery_revert_enabled:
             fab.abort(
                 "StreamingReplicatedPostgresqlContainer can not be reverted by "
@@ -483,4 +491,6 @@ class StreamingReplicatedPostgresqlContainer(PostgresqlContainer):
                 "set or not, recovery configs (master-slave configuration) "
                 "will not be reverted anyway."
             )
-        super(StreamingReplicatedPostgresqlContainer, self).revert()
+        super(StreamingReplicatedPostgresqlContainer, self).revert(
+            generation=generation,
+        )
@@ -1,8 +1,15 @@
+import contextlib
+import functools
 import itertools
+import os
+import re
 
 from cached_property import cached_property
 
+import fabricio
+
 from fabricio import docker, utils
+from fabricio.docker.container import Attribute
 
 
 class Migration(str):
@@ -29,11 +36,107 @@ class DjangoContainer(docker.Container):
     manage.py placed
     """
 
+    # remote directory used to store migrations fingerprints, if set then
+    # `migrate()` is skipped when image has no new migrations
+    migrations_fingerprint_dir = Attribute()
+
+    migrations_fingerprint_cmd = Attribute(default=(
+        "sh -c 'find . -path \"*/migrations/*.py\" -type f -exec md5sum {} + "
+        "| LC_ALL=C sort -k 2 "
+        "| md5sum'"
+    ))
+
+    migrations_fingerprint_regex = re.compile('^[0-9a-f]{32}$')
+
+    # run all migrations commands for the same image inside single
+    # container (see `docker.Image.session()`)
+    migrations_session_enabled = Attribute(default=False)
+
+    @contextlib.contextmanager
+    def migrations_runner(self, image):
+        options = self.safe_options
+        if self.migrations_session_enabled:
+            with image.session(options=options) as session:
+                yield session.run
+        else:
+            yield functools.partial(image.run, options=options)
+
     def migrate(self, tag=None, registry=None):
-        self.image[registry:tag].run(
-            'python manage.py migrate --noinput',
-            quiet=False,
-            options=self.safe_options,
+        image = self.image[registry:tag]
+        with self.migrations_runner(image) as run:
+            fingerprint = None
+            if self.migrations_fingerprint_dir is not None:
+                fingerprint = self.get_migrations_fingerprint(image, run=run)
+                if fingerprint == self.get_applied_migrations_fingerprint():
+                    fabricio.log('No new migrations detected, migrate skipped.')
+                    return
+            run('python manage.py migrate --noinput', quiet=False)
+        if fingerprint is not None:
+            self.save_fingerprint(
+                fingerprint,
+                path=self.applied_migrations_fingerprint_path,
+            )
+
+    @property
+    def applied_migrations_fingerprint_path(self):
+        return os.path.join(
+            self.migrations_fingerprint_dir,
+            '{container}.applied'.format(container=self),
+        )
+
+    @staticmethod
+    def read_fingerprint(path):
+        result = fabricio.run(
+            'cat {path}'.format(path=path),
+            ignore_errors=True,
+        )
+        if result.succeeded:
+            return result.strip() or None
+        return None
+
+    @staticmethod
+    def save_fingerprint(fingerprint, path):
+        fabricio.run(
+            'mkdir -p {dir} && echo {fingerprint} > {path}'.format(
+                dir=os.path.dirname(path),
+                fingerprint=fingerprint,
+                path=path,
+            ),
+        )
+
+    def get_applied_migrations_fingerprint(self):
+        return self.read_fingerprint(self.applied_migrations_fingerprint_path)
+
+    def get_migrations_fingerprint(self, image, run=None):
+        """
+        Returns fingerprint of the image migrations. Computed value is cached
+        on the host by image id, so each image is inspected only once
+        """
+        cache_path = os.path.join(
+            self.migrations_fingerprint_dir,
+            'images',
+            image.info['Id'],
+        )
+        fingerprint = self.read_fingerprint(cache_path)
+        if not self.is_valid_fingerprint(fingerprint):
+            run = run or functools.partial(image.run, options=self.safe_options)
+            output = run(self.migrations_fingerprint_cmd)
+            # image entrypoint may print something before command output
+            lines = output.strip().splitlines() or ['']
+            fingerprint = (lines[-1].split() or [''])[0]
+            if not self.is_valid_fingerprint(fingerprint):
+                raise RuntimeError(
+                    'unexpected migrations fingerprint: {output}'.format(
+                        output=output,
+                    )
+                )
+            self.save_fingerprint(fingerprint, path=cache_path)
+        return fingerprint
+
+    def is_valid_fingerprint(self, fingerprint):
+        return bool(
+            fingerprint
+            and self.migrations_fingerprint_regex.match(fingerprint)
         )
 
     @staticmethod
@@ -72,28 +175,32 @@ class DjangoContainer(docker.Container):
             if backup_migration is None:
                 return revert_migrations.values()
 
-    def migrate_back(self):
+    def migrate_back(self, generation=1):
         migrations_cmd = 'python manage.py showmigrations --plan | egrep "^\[X\]" | awk "{print \$2}"'
 
-        backup_container = self.get_backup_container()
-        options = self.safe_options
+        backup_container = self.get_backup_container(generation)
 
-        current_migrations = self.image.run(
-            cmd=migrations_cmd,
-            options=options,
-        )
-        backup_migrations = backup_container.image.run(
-            cmd=migrations_cmd,
-            options=options,
-        )
-        revert_migrations = self.get_revert_migrations(
-            current_migrations,
-            backup_migrations,
-        )
+        with self.migrations_runner(self.image) as run:
+            current_migrations = run(migrations_cmd)
+            backup_migrations = backup_container.image.run(
+                cmd=migrations_cmd,
+                options=self.safe_options,
+            )
+            revert_migrations = self.get_revert_migrations(
+                current_migrations,
+                backup_migrations,
+            )
+
+            for migration in revert_migrations:
+                cmd = 'python manage.py migrate --no-input {app} {migration}'.format(
+                    app=migration.app,
+                    migration=migration.name,
+                )
+                run(cmd, quiet=False)
 
-        for migration in revert_migrations:
-            cmd = 'python manage.py migrate --no-input {app} {migration}'.format(
-                app=migration.app,
-                migration=migration.name,
+        if self.migrations_fingerprint_dir is not None:
+            # applied migrations are not in sync with any image anymore
+            fabricio.remove(
+                self.applied_migrations_fingerprint_path,
+                ignore_errors=True,
             )
-            self.image.run(cmd=cmd, quiet=False, options=options)
@@ -0,0 +1,291 @@
+import sys
+import threading
+
+from fabric import state
+from fabric.network import normalize_to_string, to_dict
+
+__all__ = ['ExecutionContext', 'get_current_context',
+           'get_current_stream']
+
+_lock = threading.RLock()
+
+_local = threading.local()
+
+_installed = dict(count=0, classes={}, streams={}, muted={})
+
+
+def get_current_context():
+    stack = getattr(_local, 'stack', None)
+    return stack and stack[-1] or None
+
+
+def get_current_stream(name):
+    """
+    Returns stream (`stdout` or `stderr`) of the current thread's execution
+    context if any, it should be passed explicitly to the functions which
+    write from other threads (e.g. `fab.run` writes remote output
+    from its own threads)
+    """
+    context = get_current_context()
+    return context and getattr(context, name) or None
+
+
+def _is_muted_thread():
+    """
+    Checks if the current thread serves SSH connection of a host
+    which output is muted (e.g. runs handlers of `fab.remote_tunnel`)
+    """
+    thread = threading.current_thread()
+    with _lock:
+        hosts = list(_installed['muted'])
+    for host in hosts:
+        # `dict.get` doesn't open connection unlike `connections[host]`
+        connection = dict.get(state.connections, host)
+        if connection is not None and connection.get_transport() is thread:
+            return True
+    return False
+
+
+class _ContextDict(dict):
+    """
+    Fabric's settings dict which reads and writes values of the current
+    thread's execution context if any instead of the global values
+    """
+
+    _context_attr = None
+
+    def _data(self):
+        context = get_current_context()
+        if context is None:
+            return None
+        return getattr(context, self._context_attr)
+
+    def __getitem__(self, key):
+        data = self._data()
+        if data is None:
+            return dict.__getitem__(self, key)
+        return data[key]
+
+    def __setitem__(self, key, value):
+        data = self._data()
+        if data is None:
+            return dict.__setitem__(self, key, value)
+        data[key] = value
+
+    def __delitem__(self, key):
+        data = self._data()
+        if data is None:
+            return dict.__delitem__(self, key)
+        del data[key]
+
+    def __contains__(self, key):
+        data = self._data()
+        if data is None:
+            return dict.__contains__(self, key)
+        return key in data
+
+    def __iter__(self):
+        data = self._data()
+        if data is None:
+            return dict.__iter__(self)
+        return iter(data)
+
+    def __len__(self):
+        data = self._data()
+        if data is None:
+            return dict.__len__(self)
+        return len(data)
+
+    def __repr__(self):
+        data = self._data()
+        if data is None:
+            return dict.__repr__(self)
+        return repr(data)
+
+    def _call(self, method, *args):
+        data = self._data()
+        if data is None:
+            return getattr(dict, method)(self, *args)
+        return getattr(data, method)(*args)
+
+    def get(self, *args):
+        return self._call('get', *args)
+
+    def setdefault(self, *args):
+        return self._call('setdefault', *args)
+
+    def pop(self, *args):
+        return self._call('pop', *args)
+
+    def keys(self):
+        return self._call('keys')
+
+    def values(self):
+        return self._call('values')
+
+    def items(self):
+        return self._call('items')
+
+    def copy(self):
+        return self._call('copy')
+
+    if sys.version_info < (3, ):
+        def has_key(self, key):
+            return key in self
+
+        def iterkeys(self):
+            return self._call('iterkeys')
+
+        def itervalues(self):
+            return self._call('itervalues')
+
+        def iteritems(self):
+            return self._call('iteritems')
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+class _ContextStream(object):
+    """
+    Proxy of `sys.stdout`/`sys.stderr` which writes to the stream
+    of the current thread's execution context if any
+    """
+
+    def __init__(self, name, stream):
+        self._name = name
+        self._stream = stream
+
+    def _get_stream(self):
+        context = get_current_context()
+        if context is None:
+            if _installed['muted'] and _is_muted_thread():
+                return _null_stream
+            return self._stream
+        return getattr(context, self._name) or self._stream
+
+    def write(self, data):
+        return self._get_stream().write(data)
+
+    def flush(self):
+        return self._get_stream().flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._get_stream(), attr)
+
+
+class _NullStream(object):
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+_null_stream = _NullStream()
+
+
+def _install():
+    with _lock:
+        _installed['count'] += 1
+        if _installed['count'] > 1:
+            return
+        for attr, obj in (('env', state.env), ('output', state.output)):
+            cls = type(obj)
+            _installed['classes'][attr] = cls
+            # Fabric's dicts store attributes as items
+            dict.__setattr__(obj, '__class__', type(
+                'Context' + cls.__name__,
+                (cls, _ContextDict),
+                dict(_context_attr=attr),
+            ))
+        for name in ('stdout', 'stderr'):
+            stream = getattr(sys, name)
+            _installed['streams'][name] = stream
+            setattr(sys, name, _ContextStream(name, stream))
+
+
+def _uninstall():
+    with _lock:
+        _installed['count'] -= 1
+        if _installed['count'] > 0:
+            return
+        for attr, obj in (('env', state.env), ('output', state.output)):
+            dict.__setattr__(obj, '__class__', _installed['classes'].pop(attr))
+        for name, stream in list(_installed['streams'].items()):
+            if isinstance(getattr(sys, name), _ContextStream):
+                setattr(sys, name, stream)
+        _installed['streams'].clear()
+
+
+class ExecutionContext(object):
+    """
+    Execution context of the current thread: Fabric settings (`fab.env`)
+    including host, output levels (`fab.output`) and output streams.
+
+    Fabric keeps all of these in global objects, so they can't be changed
+    by concurrent threads. While at least one context is active, the global
+    objects are replaced by proxies, and each thread which has entered
+    a context works with its own copy of settings and own streams:
+
+        with ExecutionContext(host='user@host', stdout=output):
+            fabricio.run('docker ps')
+
+    Threads without context (e.g. started by paramiko) use global values.
+    Output of the threads serving SSH connection of the context's host
+    (e.g. handlers of `fab.remote_tunnel`) can be muted
+    by `mute_threads=True`.
+    """
+
+    def __init__(
+        self,
+        host=None,
+        stdout=None,
+        stderr=None,
+        mute_threads=False,
+        **settings
+    ):
+        self.host = host
+        self.settings = settings
+        self.mute_threads = mute_threads
+        parent = get_current_context()
+        self.stdout = stdout or parent and parent.stdout or None
+        self.stderr = stderr or parent and parent.stderr or None
+        self.env = self.output = None
+        self.muted_host = None
+
+    def __enter__(self):
+        _install()
+        parent = get_current_context()
+        if parent is None:
+            self.env = dict.copy(state.env)
+            self.output = dict.copy(state.output)
+        else:
+            self.env = dict(parent.env)
+            self.output = dict(parent.output)
+        if self.host is not None:
+            self.env.update(to_dict(self.host))
+        self.env.update(self.settings)
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        if self.mute_threads and self.env.get('host_string'):
+            self.muted_host = normalize_to_string(self.env['host_string'])
+            with _lock:
+                muted = _installed['muted']
+                muted[self.muted_host] = muted.get(self.muted_host, 0) + 1
+        return self
+
+    def __exit__(self, *args):
+        if self.muted_host is not None:
+            with _lock:
+                muted = _installed['muted']
+                muted[self.muted_host] -= 1
+                if not muted[self.muted_host]:
+                    del muted[self.muted_host]
+            self.muted_host = None
+        _local.stack.remove(self)
+        self.env = self.output = None
+        _uninstall()
@@ -1,3 +1,6 @@
 from .image import Image
 from .container import Container
-from .registry import Registry
+from .registry import Registry, LocalRegistry
+from .reference import ImageReference
+from .context import BuildContext
+from .archive import ImageArchive
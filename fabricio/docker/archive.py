@@ -0,0 +1,89 @@
+import contextlib
+import json
+import posixpath
+import tarfile
+
+
+class ImageArchive(object):
+    """
+    Archive made by `docker save`.
+    """
+
+    compress_level = 6
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def read_json(archive, name):
+        with contextlib.closing(archive.extractfile(name)) as json_file:
+            return json.loads(json_file.read().decode())
+
+    def get_layers(self, archive):
+        """
+        Returns list of (path, diff_id) pairs of layers of each image
+        of the archive, parent layers go first.
+        """
+        images = []
+        for image in self.read_json(archive, 'manifest.json'):
+            config = self.read_json(archive, image['Config'])
+            images.append(list(zip(
+                image['Layers'],
+                config['rootfs']['diff_ids'],
+            )))
+        return images
+
+    def make_delta(self, output, chains=()):
+        """
+        Writes gzipped copy of archive without layers which can be found
+        on the target host, `chains` is list of layers diff_ids of images
+        the host has.
+
+        `docker load` doesn't read layer file if layer with the same
+        chain (layer itself plus all its parents) already exists,
+        so only whole chains prefixes are taken into account.
+
+        Returns number of bytes of layers excluded from the archive.
+        """
+        known_chains = set()
+        for chain in chains:
+            for index in range(1, len(chain) + 1):
+                known_chains.add(tuple(chain[:index]))
+        with contextlib.closing(tarfile.open(self.path)) as archive:
+            skip = set()
+            required = set()
+            for image_layers in self.get_layers(archive):
+                chain = ()
+                for path, diff_id in image_layers:
+                    chain += (diff_id, )
+                    if chain in known_chains:
+                        skip.add(path)
+                    else:
+                        required.add(path)
+            skip -= required
+            members = archive.getmembers()
+            for member in members:
+                if member.issym() and member.name not in skip:
+                    # duplicated layers are stored as symlinks
+                    skip.discard(posixpath.normpath(posixpath.join(
+                        posixpath.dirname(member.name),
+                        member.linkname,
+                    )))
+            skipped_size = 0
+            with contextlib.closing(tarfile.open(
+                output,
+                'w:gz',
+                compresslevel=self.compress_level,
+            )) as delta:
+                for member in members:
+                    if member.name in skip:
+                        skipped_size += member.size
+                        continue
+                    if member.isfile():
+                        with contextlib.closing(
+                            archive.extractfile(member),
+                        ) as member_file:
+                            delta.addfile(member, member_file)
+                    else:
+                        delta.addfile(member)
+        return skipped_size
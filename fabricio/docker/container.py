@@ -1,6 +1,9 @@
+import hashlib
+import itertools
 import json
 
-from cached_property import cached_property
+import six
+
 from frozendict import frozendict
 
 import fabricio
@@ -18,12 +21,71 @@ class Attribute(default_property):
     pass
 
 
-class Container(object):
+class ContainerMeta(type):
+    """
+    Collects container options and attributes once per class
+    """
+
+    _versions = itertools.count()
+
+    # changed each time any container class attribute is set, options
+    # cached by instances are valid only for the same version
+    version = next(_versions)
+
+    def __init__(cls, *args, **kwargs):
+        super(ContainerMeta, cls).__init__(*args, **kwargs)
+        cls.update_fields()
+
+    def __setattr__(cls, attr, value):
+        super(ContainerMeta, cls).__setattr__(attr, value)
+        ContainerMeta.version = next(ContainerMeta._versions)
+        cls.update_fields()
+
+    def __delattr__(cls, attr):
+        super(ContainerMeta, cls).__delattr__(attr)
+        ContainerMeta.version = next(ContainerMeta._versions)
+        cls.update_fields()
+
+    def update_fields(cls):
+        default_options = set()
+        attributes = set()
+        images = {}
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                if isinstance(value, Option):
+                    default_options.add(attr)
+                elif isinstance(value, Attribute):
+                    attributes.add(attr)
+        for attr in dir(cls):
+            value = getattr(cls, attr)
+            if isinstance(value, Image):
+                images.setdefault(value, []).append(attr)
+        for image, fields in images.items():
+            if len(fields) == 1:  # collisions are reported by the image
+                image.field_names[cls] = fields[0]
+        dynamic_options = set()
+        for option in default_options:
+            value = getattr(cls, option, None)
+            if isinstance(value, Option):
+                if value.func is not None:
+                    dynamic_options.add(option)
+            elif hasattr(value, '__get__'):
+                dynamic_options.add(option)
+        type.__setattr__(cls, 'default_options', frozenset(default_options))
+        type.__setattr__(cls, 'attributes', frozenset(attributes))
+        type.__setattr__(cls, 'dynamic_options', frozenset(dynamic_options))
+        for subclass in cls.__subclasses__():
+            subclass.update_fields()
+
+
+class Container(six.with_metaclass(ContainerMeta, object)):
 
     image = Image()
 
     cmd = Attribute()
     stop_timeout = Attribute(default=10)
+    backup_generations = Attribute(default=1)
+    use_standby = Attribute(default=False)
 
     user = Option()
     ports = Option()
@@ -35,6 +97,8 @@ class Container(object):
     restart_policy = Option()
     stop_signal = Option()
 
+    fingerprint_label = 'fabricio.fingerprint'
+
     def __init__(self, name, image=None, options=None, **attrs):
         self.name = name
         if image is not None:
@@ -43,12 +107,13 @@ class Container(object):
         options = options or {}
         self.overridden_options = set()
         is_default_option = self.default_options.__contains__
-        self.options = container_options = {}
+        container_options = {}
         for option, value in options.items():
             if is_default_option(option):
                 setattr(self, option, value)
             else:
                 container_options[option] = value
+        self.options = container_options
 
         self.overridden_attributes = set()
         is_attribute = self.attributes.__contains__
@@ -63,16 +128,53 @@ class Container(object):
     def __setattr__(self, attr, value):
         if attr in self.default_options:
             self.overridden_options.add(attr)
+            self.__dict__['_options_cache'] = None
         elif attr in self.attributes:
             self.overridden_attributes.add(attr)
+        elif attr == '_options':
+            self.__dict__['_options_cache'] = None
         super(Container, self).__setattr__(attr, value)
 
+    # (classes version, static options, names of dynamic options,
+    # safe options or None)
+    _options_cache = None
+
+    def _get_options_cache(self):
+        cache = self._options_cache
+        version = ContainerMeta.version
+        if cache is None or cache[0] != version:
+            static_options = dict(self._options)
+            dynamic_options = []
+            instance_options = self.__dict__
+            for option in self.default_options:
+                if (
+                    option in self.dynamic_options
+                    and option not in instance_options
+                ):
+                    dynamic_options.append(option)
+                else:
+                    static_options[option] = getattr(self, option)
+            static_options = frozendict(static_options)
+            safe_options = None
+            if not dynamic_options:
+                safe_options = frozendict(static_options, ports=None)
+            cache = (
+                version,
+                static_options,
+                tuple(dynamic_options),
+                safe_options,
+            )
+            self.__dict__['_options_cache'] = cache
+        return cache
+
     def _get_options(self):
-        default_options_values = dict(
+        _, static_options, dynamic_options, _ = self._get_options_cache()
+        if not dynamic_options:
+            return static_options
+        return frozendict(static_options, **dict(
             (option, getattr(self, option))
-            for option in self.default_options
-        )
-        return frozendict(self._options, **default_options_values)
+            for option in dynamic_options
+        ))
 
     def _set_options(self, options):
         self._options = options
@@ -81,25 +183,10 @@ class Container(object):
 
     @property
     def safe_options(self):
-        return frozendict(self.options, ports=None)
-
-    @cached_property
-    def default_options(self):
-        return set(
-            attr
-            for cls in type(self).__mro__
-            for attr, value in vars(cls).items()
-            if isinstance(value, Option)
-        )
-
-    @cached_property
-    def attributes(self):
-        return set(
-            attr
-            for cls in type(self).__mro__
-            for attr, value in vars(cls).items()
-            if isinstance(value, Attribute)
-        )
+        safe_options = self._get_options_cache()[3]
+        if safe_options is None:
+            return frozendict(self.options, ports=None)
+        return safe_options
 
     def fork(self, name=None, image=None, options=None, **attrs):
         if name is None:
@@ -165,14 +252,116 @@ class Container(object):
         if delete_image_callback:
             delete_image_callback()
 
+    @staticmethod
+    def _fingerprint_default(value):
+        if hasattr(value, 'items'):
+            return dict(value)
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        # text of arbitrary object (e.g. its repr with address)
+        # may be different for the same configuration
+        raise TypeError('{value!r} can not be used in fingerprint'.format(
+            value=value,
+        ))
+
+    @property
+    def fingerprint(self):
+        """
+        hash of container command and options (label stored
+        by `docker run` is used to detect configuration changes)
+        """
+        data = json.dumps(
+            [self.cmd, self.options],
+            sort_keys=True,
+            default=self._fingerprint_default,
+        )
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @property
+    def run_options(self):
+        options = dict(self.options)
+        fingerprint = '{label}={fingerprint}'.format(
+            label=self.fingerprint_label,
+            fingerprint=self.fingerprint,
+        )
+        labels = options.get('label')
+        if labels is None:
+            options['label'] = fingerprint
+        elif hasattr(labels, 'items'):
+            options['label'] = dict(labels, **{
+                self.fingerprint_label: self.fingerprint,
+            })
+        elif isinstance(labels, six.string_types):
+            options['label'] = [labels, fingerprint]
+        else:
+            options['label'] = list(labels) + [fingerprint]
+        return options
+
     def run(self, tag=None, registry=None):
         self.image[registry:tag].run(
             cmd=self.cmd,
             temporary=False,
             name=self.name,
-            options=self.options,
+            options=self.run_options,
         )
 
+    def create(self, tag=None, registry=None):
+        self.image[registry:tag].create(
+            cmd=self.cmd,
+            name=self.name,
+            options=self.run_options,
+        )
+
+    def get_status(self):
+        """
+        returns container state and image (e.g. 'running nginx:stable'),
+        None if container not found
+        """
+        command = (
+            "docker inspect --type container "
+            "--format '{{{{.State.Status}}}} {{{{.Config.Image}}}}' {container}"
+        )
+        status = fabricio.run(
+            command.format(container=self),
+            ignore_errors=True,
+        )
+        if status.failed:
+            return None
+        return status.strip()
+
+    def is_up_to_date(self, image_id):
+        """
+        checks if container is running image with provided ID using
+        current command and options, containers started without
+        fingerprint label are compared by image only
+        """
+        command = (
+            "docker inspect --type container --format "
+            "'{{{{.Image}}}} {{{{.State.Running}}}} "
+            "{{{{index .Config.Labels \"{label}\"}}}}' {container}"
+        )
+        state = fabricio.run(
+            command.format(label=self.fingerprint_label, container=self),
+            ignore_errors=True,
+        )
+        if state.failed:
+            return False  # container not found
+        current_image_id, running, fingerprint = (
+            state.strip().split(' ', 2) + ['', '']
+        )[:3]
+        if current_image_id != image_id or running != 'true':
+            return False
+        return not self.fingerprint_changed(fingerprint)
+
+    def get_fingerprint_label(self, info):
+        labels = (info.get('Config') or {}).get('Labels') or {}
+        return labels.get(self.fingerprint_label)
+
+    def fingerprint_changed(self, fingerprint):
+        if fingerprint in (None, '', '<no value>'):
+            return False  # container was started without fingerprint label
+        return fingerprint != self.fingerprint
+
     def execute(self, cmd, ignore_errors=False, quiet=True, use_cache=False):
         command = 'docker exec --tty --interactive {container} {cmd}'
         return fabricio.run(
@@ -210,46 +399,135 @@ class Container(object):
     def update(self, tag=None, registry=None, force=False):
         if not force:
             try:
-                current_image_id = self.image.id
+                info = self.info
             except RuntimeError:  # current container not found
                 pass
             else:
                 new_image = self.image[registry:tag]
-                if current_image_id == new_image.id:
-                    self.start()  # force starting container
-                    return False
+                if info['Image'] == new_image.id:
+                    fingerprint = self.get_fingerprint_label(info)
+                    if not self.fingerprint_changed(fingerprint):
+                        self.start()  # force starting container
+                        if self.use_standby:
+                            self.delete_standby_container()
+                        return False
+                    fabricio.log('{container} options changed'.format(
+                        container=self,
+                    ))
         new_container = self.fork(name=self.name)
-        obsolete_container = self.get_backup_container()
+        standby_container = None
+        if self.use_standby:
+            standby_container = self.get_ready_standby_container(
+                tag=tag,
+                registry=registry,
+            )
+        generations = self.backup_generations
+        obsolete_container = self.get_backup_container(generations)
         try:
+            # image is not deleted if other generation still uses it
             obsolete_container.delete(delete_image=True)
         except RuntimeError:
             pass  # backup container not found
+        for generation in range(generations - 1, 0, -1):
+            self.rename_backup_container(generation, generation + 1)
         try:
             backup_container = self.fork()
-            backup_container.rename(obsolete_container.name)
+            backup_container.rename(self.get_backup_container().name)
         except RuntimeError:
             pass  # current container not found
         else:
             backup_container.stop()
-        new_container.run(tag=tag, registry=registry)
+        if standby_container is None:
+            new_container.run(tag=tag, registry=registry)
+        else:
+            standby_container.rename(self.name)
+            standby_container.start()
         return True
 
-    def revert(self):
-        backup_container = self.get_backup_container()
+    def revert(self, generation=1):
+        """
+        starts backup container of provided generation (1 is the previous
+        version), newer backup containers are deleted
+        """
+        backup_container = self.get_backup_container(generation)
         if not backup_container.info:
             return  # does backup container exist?
         self.stop()
         backup_container.start()
         self.delete(delete_image=True)
         backup_container.rename(self.name)
+        for newer_generation in range(1, generation):
+            try:
+                self.get_backup_container(newer_generation).delete(
+                    delete_image=True,
+                )
+            except RuntimeError:
+                pass  # backup container not found
+        for older_generation in range(
+            generation + 1,
+            self.backup_generations + 1,
+        ):
+            self.rename_backup_container(
+                older_generation,
+                older_generation - generation,
+            )
+
+    def get_backup_container(self, generation=1):
+        name = '{container}_backup'.format(container=self)
+        if generation > 1:
+            name = '{name}_{generation}'.format(
+                name=name,
+                generation=generation,
+            )
+        return self.fork(name=name)
 
-    def get_backup_container(self):
-        return self.fork(name='{container}_backup'.format(container=self))
+    def get_standby_container(self):
+        return self.fork(name='{container}_standby'.format(container=self))
+
+    def create_standby_container(self, tag=None, registry=None):
+        """
+        creates (but not starts) container of the new version in advance,
+        so update has only to stop current container and start this one
+        """
+        self.delete_standby_container()
+        self.get_standby_container().create(tag=tag, registry=registry)
+
+    def delete_standby_container(self):
+        try:
+            self.get_standby_container().delete()
+        except RuntimeError:
+            pass  # standby container not found
+
+    def get_ready_standby_container(self, tag=None, registry=None):
+        """
+        returns standby container if it was created from the new image
+        with current options, outdated standby container is deleted
+        """
+        standby_container = self.get_standby_container()
+        try:
+            info = standby_container.info
+        except RuntimeError:
+            return None  # standby container not found
+        if (
+            info['Image'] == self.image[registry:tag].id
+            and self.get_fingerprint_label(info) == self.fingerprint
+        ):
+            return standby_container
+        standby_container.delete()
+        return None
+
+    def rename_backup_container(self, generation, new_generation):
+        try:
+            self.get_backup_container(generation).rename(
+                self.get_backup_container(new_generation).name,
+            )
+        except RuntimeError:
+            pass  # backup container not found
 
     def migrate(self, tag=None, registry=None):
         pass
 
-    def migrate_back(self):
+    def migrate_back(self, generation=1):
         pass
 
     def backup(self):
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import posixpath
+import re
+
+
+class BuildContext(object):
+    """
+    Local Docker build context: files of the build path which are not
+    excluded by `.dockerignore` (Dockerfile is always included).
+    """
+
+    def __init__(self, path='.', dockerfile='Dockerfile'):
+        self.path = path
+        self.dockerfile = dockerfile
+
+    @staticmethod
+    def translate(pattern):
+        regex = ''
+        index = 0
+        while index < len(pattern):
+            char = pattern[index]
+            if pattern.startswith('**', index):
+                regex += '.*'
+                index += 2
+                if pattern.startswith('/', index):
+                    regex += '/?'
+                    index += 1
+                continue
+            if char == '*':
+                regex += '[^/]*'
+            elif char == '?':
+                regex += '[^/]'
+            else:
+                regex += re.escape(char)
+            index += 1
+        # pattern matching a directory excludes its content too
+        return re.compile(regex + '(?:/.*)?$')
+
+    @property
+    def patterns(self):
+        patterns = []
+        try:
+            with open(os.path.join(self.path, '.dockerignore')) as ignore:
+                lines = ignore.read().splitlines()
+        except IOError:
+            return patterns
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            include = line.startswith('!')
+            pattern = posixpath.normpath(line.lstrip('!').strip()).strip('/')
+            if pattern == '.':
+                pattern = '**'
+            patterns.append((self.translate(pattern), include))
+        return patterns
+
+    def files(self):
+        """
+        Returns sorted list of relative paths of context files.
+        """
+        patterns = self.patterns
+        has_exceptions = any(include for regex, include in patterns)
+
+        def is_excluded(path):
+            excluded = False
+            for regex, include in patterns:
+                if regex.match(path):
+                    excluded = not include
+            return excluded
+
+        result = []
+        for root, dirs, files in os.walk(self.path):
+            prefix = os.path.relpath(root, self.path).replace(os.sep, '/')
+            prefix = prefix != '.' and prefix + '/' or ''
+            if not has_exceptions:
+                # excluded directory can't contain included files
+                dirs[:] = [
+                    directory for directory in dirs
+                    if not is_excluded(prefix + directory)
+                ]
+            for file_name in files:
+                path = prefix + file_name
+                if path == self.dockerfile or not is_excluded(path):
+                    result.append(path)
+        return sorted(result)
+
+    def fingerprint(self, *extra):
+        """
+        Returns hash of context files names, modes and contents (plus any
+        extra values provided, e.g. build arguments).
+        """
+        sha256 = hashlib.sha256()
+        for value in extra:
+            sha256.update(repr(value).encode())
+        for path in self.files():
+            full_path = os.path.join(self.path, *path.split('/'))
+            sha256.update(path.encode() + b'\0')
+            sha256.update(str(os.stat(full_path).st_mode & 0o111).encode())
+            with open(full_path, 'rb') as context_file:
+                for chunk in iter(lambda: context_file.read(65536), b''):
+                    sha256.update(chunk)
+            sha256.update(b'\0')
+        return sha256.hexdigest()
+
+    def base_images(self):
+        """
+        Returns images used by FROM instructions of Dockerfile
+        (except build stages and 'scratch').
+        """
+        path = os.path.join(self.path, self.dockerfile)
+        with open(path) as dockerfile:
+            content = re.sub(r'\\\s*\n', ' ', dockerfile.read())
+        images = []
+        stages = set(['scratch'])
+        for line in content.splitlines():
+            words = line.split()
+            if len(words) < 2 or words[0].upper() != 'FROM':
+                continue
+            arguments = [
+                word for word in words[1:] if not word.startswith('--')
+            ]
+            if not arguments:
+                continue
+            image = arguments[0]
+            if image.lower() not in stages and image not in images:
+                images.append(image)
+            if len(arguments) >= 3 and arguments[1].upper() == 'AS':
+                stages.add(arguments[2].lower())
+        return images
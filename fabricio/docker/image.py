@@ -3,15 +3,68 @@ import json
 import warnings
 
 from cached_property import cached_property
-from docker import utils as docker_utils, auth as docker_auth
 
 import fabricio
 
 from fabricio.utils import Options
 
+from .reference import ImageReference
 from .registry import Registry
 
 
+class ImageSession(object):
+    """
+    Temporary container used to run several commands by `docker exec`
+    instead of creating new container for each of them.
+
+    Container is started on the first command and removed on exit, note
+    that commands are executed without image's entrypoint
+    """
+
+    def __init__(self, image, options=()):
+        self.image = image
+        self.options = options
+        self.container_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.container_id is not None:
+            fabricio.run(
+                'docker rm --force {container}'.format(
+                    container=self.container_id,
+                ),
+                ignore_errors=True,
+            )
+            self.container_id = None
+
+    def start(self):
+        options = self.image.make_container_options(
+            temporary=False,
+            options=self.options,
+        )
+        options['restart'] = None
+        options['interactive'] = True  # keeps `cat` running
+        # image's entrypoint (e.g. app server) must not be started
+        options['entrypoint'] = 'cat'
+        self.container_id = fabricio.run(
+            'docker run {options} {image}'.format(
+                options=options,
+                image=self.image,
+            ),
+        )
+
+    def run(self, cmd, quiet=True):
+        if self.container_id is None:
+            self.start()
+        command = 'docker exec --tty --interactive {container} {cmd}'
+        return fabricio.run(
+            command.format(container=self.container_id, cmd=cmd),
+            quiet=quiet,
+        )
+
+
 class Image(object):
 
     container_options_mapping = (
@@ -26,15 +79,17 @@ class Image(object):
         ('stop-signal', 'stop_signal'),
     )
 
-    def __init__(self, name=None, tag=None, registry=None):
+    def __init__(self, name=None, tag=None, registry=None, digest=None):
         if name:
-            _registry, _name, _tag = self.parse_image_name(name)
-            self.name = _name
-            self.tag = tag or _tag or 'latest'  # TODO 'latest' is unnecessary
-            registry = registry or _registry or None
+            reference = ImageReference.parse(name)
+            self.name = reference.name
+            self.tag = tag or reference.tag or 'latest'  # TODO 'latest' is unnecessary
+            registry = registry or reference.registry or None
+            digest = digest or not tag and reference.digest or None
         else:
             self.name = name
             self.tag = tag
+        self.digest = digest
         self.registry = registry and Registry(registry)
         self.field_names = {}
         self.container = None
@@ -45,13 +100,16 @@ class Image(object):
         return repr(self)
 
     def __repr__(self):
+        # digest is immutable reference to the image, tag is ignored then
+        reference = self.digest and '{name}@{digest}' or '{name}:{tag}'
         if self.registry:
-            return '{registry}/{name}:{tag}'.format(
-                registry=self.registry,
-                name=self.name,
-                tag=self.tag,
-            )
-        return '{name}:{tag}'.format(name=self.name, tag=self.tag)
+            reference = '{registry}/' + reference
+        return reference.format(
+            registry=self.registry,
+            name=self.name,
+            tag=self.tag,
+            digest=self.digest,
+        )
 
     def __get__(self, container, owner_cls):
         if container is None:
@@ -63,6 +121,7 @@ class Image(object):
                 name=self.name,
                 tag=self.tag,
                 registry=self.registry,
+                digest=self.digest,
             )
         # this cause circular reference between container and image, but it's
         # not a problem due to temporary nature of Fabric runtime
@@ -86,6 +145,7 @@ class Image(object):
             name=self.name,
             tag=tag or self.tag,
             registry=registry or self.registry,
+            digest=not tag and self.digest or None,
         )
 
     def get_field_name(self, owner_cls):
@@ -105,11 +165,8 @@ class Image(object):
 
     @staticmethod
     def parse_image_name(image):
-        repository, tag = docker_utils.parse_repository_tag(image)
-        registry, name = docker_auth.resolve_repository_name(repository)
-        if registry == docker_auth.INDEX_NAME:
-            registry = ''
-        return registry, name, tag
+        reference = ImageReference.parse(image)
+        return reference.registry, reference.name, reference.tag
 
     @classmethod
     def make_container_options(cls, temporary=None, name=None, options=()):
@@ -167,6 +224,9 @@ class Image(object):
             return delete_callback
         return delete_callback(ignore_errors=ignore_errors)
 
+    def session(self, options=()):
+        return ImageSession(self, options=options)
+
     def run(
         self,
         cmd=None,
@@ -196,3 +256,11 @@ class Image(object):
             ),
             quiet=quiet,
         )
+
+    def create(self, cmd=None, name=None, options=()):
+        command = 'docker create {options} {image} {cmd}'
+        return fabricio.run(command.format(
+            image=self,
+            cmd=cmd or '',
+            options=self.make_container_options(name=name, options=options),
+        ))
@@ -0,0 +1,82 @@
+import collections
+import re
+import threading
+
+from fabricio.utils import OrderedDict
+
+
+class ImageReference(
+    collections.namedtuple('ImageReference', 'registry name tag digest'),
+):
+    """
+    Parsed image reference: [registry/]name[:tag][@digest]
+
+    References are memoised, so parsing of the same string returns
+    the same (immutable) object without parsing it again.
+    """
+
+    __slots__ = ()
+
+    regex = re.compile(
+        r'^'
+        r'(?:(?P<registry>localhost(?::\d+)?|[^/@]*[.:][^/@]*)/)?'
+        r'(?P<name>[^:@/]+(?:/[^:@/]+)*)'
+        r'(?::(?P<tag>[^:@/]+))?'
+        r'(?:@(?P<digest>[A-Za-z0-9_+.-]+:[A-Za-z0-9=_-]+))?'
+        r'$'
+    )
+
+    default_registries = frozenset(('docker.io', 'index.docker.io'))
+
+    cache = OrderedDict()
+
+    cache_size = 1024
+
+    cache_lock = threading.Lock()  # references are parsed by many threads
+
+    def __str__(self):
+        reference = self.name
+        if self.registry:
+            reference = self.registry + '/' + reference
+        if self.tag:
+            reference += ':' + self.tag
+        if self.digest:
+            reference += '@' + self.digest
+        return reference
+
+    @classmethod
+    def parse(cls, reference):
+        cache = cls.cache
+        with cls.cache_lock:
+            result = cache.pop(reference, None)
+            if result is not None:
+                cache[reference] = result  # most recently used goes last
+                return result
+        result = cls._parse(reference)
+        with cls.cache_lock:
+            cache.pop(reference, None)  # may be added by another thread
+            if len(cache) >= cls.cache_size:
+                cache.popitem(last=False)
+            cache[reference] = result
+        return result
+
+    @classmethod
+    def _parse(cls, reference):
+        match = cls.regex.match(reference)
+        if match is None:
+            raise ValueError('Invalid image reference: {reference}'.format(
+                reference=reference,
+            ))
+        registry = match.group('registry') or ''
+        if registry.startswith('-') or registry.endswith('-'):
+            raise ValueError('Invalid registry name: {registry}'.format(
+                registry=registry,
+            ))
+        if registry in cls.default_registries:
+            registry = ''
+        return cls(
+            registry=registry,
+            name=match.group('name'),
+            tag=match.group('tag'),
+            digest=match.group('digest'),
+        )
@@ -1,6 +1,128 @@
+import atexit
+import socket
+import time
+
+from six.moves import http_client
+
+import fabricio
+
+from fabricio.utils import Options
+
+
 class Registry(str):
 
     def __init__(self, *args, **kwargs):
         super(Registry, self).__init__(*args, **kwargs)
         self.host, _, port = self.partition(':')
         self.port = port and int(port)
+
+
+class LocalRegistry(object):
+    """
+    Docker registry container running on the local (deploy) machine.
+
+    Registry data is stored in the named volume, so it is kept between
+    deploys as layers cache even after container is stopped.
+    """
+
+    poll_interval = 0.5
+
+    def __init__(
+        self,
+        port=5000,
+        name='fabricio_registry',
+        volume='fabricio_registry',
+        image='registry:2',
+        timeout=30,
+    ):
+        self.port = port
+        self.name = name
+        self.volume = volume
+        self.image = image
+        self.timeout = timeout
+        self.started = False
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def registry(self):
+        return Registry('localhost:{port}'.format(port=self.port))
+
+    def start(self):
+        """
+        starts registry container if it is not running yet
+        """
+        if self.running:
+            return
+        state = fabricio.local(
+            "docker inspect --type container "
+            "--format '{{{{.State.Running}}}}' {name}".format(name=self.name),
+            capture=True,
+            ignore_errors=True,
+        )
+        if state == 'true':
+            self.running = True
+            return  # started by someone else, leave it as is
+        if state.failed:
+            options = Options([
+                ('name', self.name),
+                ('publish', '127.0.0.1:{port}:5000'.format(port=self.port)),
+                ('volume', '{volume}:/var/lib/registry'.format(
+                    volume=self.volume,
+                )),
+                ('detach', True),
+            ])
+            fabricio.local('docker run {options} {image}'.format(
+                options=options,
+                image=self.image,
+            ))
+        else:
+            fabricio.local('docker start {name}'.format(name=self.name))
+        self.started = self.running = True
+        atexit.register(self.stop)
+        self.wait_ready()
+
+    def wait_ready(self):
+        """
+        waits until just started registry accepts requests
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            # proxy settings are not applied unlike urllib's
+            connection = http_client.HTTPConnection(
+                '127.0.0.1',
+                self.port,
+                timeout=self.poll_interval * 2,
+            )
+            try:
+                connection.request('GET', '/v2/')
+                connection.getresponse()
+                return  # any HTTP response means registry is up
+            except (socket.error, http_client.HTTPException):
+                if time.time() > deadline:
+                    raise RuntimeError(
+                        'local registry is not ready after {timeout} '
+                        'seconds'.format(timeout=self.timeout)
+                    )
+            finally:
+                connection.close()
+            time.sleep(self.poll_interval)
+
+    def stop(self):
+        """
+        stops registry container if it was started by this instance
+        """
+        self.running = False
+        if not self.started:
+            return
+        self.started = False
+        fabricio.local(
+            'docker stop {name}'.format(name=self.name),
+            ignore_errors=True,
+        )
@@ -0,0 +1,72 @@
+import threading
+
+from six.moves import queue
+
+from fabricio.context import ExecutionContext
+from fabricio.utils import OrderedDict
+
+__all__ = ['ThreadedExecutor']
+
+
+class ThreadedExecutor(object):
+    """
+    Runs callable for each host in a pool of threads of the current
+    process (unlike Fabric's parallel mode which forks process per host).
+
+    Each host is processed in its own `ExecutionContext`, SSH connections
+    are shared through Fabric's connection cache, so they are reused by
+    subsequent stages. Suitable for read-only operations which don't rely
+    on state changed by other hosts, e.g. gathering containers status.
+
+    `timeout` is applied to SSH connection and to each command.
+    """
+
+    def __init__(self, workers=16, timeout=None):
+        self.workers = int(workers)
+        self.timeout = timeout and int(timeout)
+
+    def get_settings(self):
+        settings = dict(
+            abort_on_prompts=True,  # threads can't ask for password
+        )
+        if self.timeout:
+            settings.update(timeout=self.timeout, command_timeout=self.timeout)
+        return settings
+
+    def execute(self, task, hosts, *args, **kwargs):
+        """
+        Returns mapping of hosts to results of `task` in order of `hosts`,
+        host result is exception instance if `task` failed on that host.
+        """
+        hosts = list(hosts)
+        results = OrderedDict((host, None) for host in hosts)
+        if not hosts:
+            return results
+        pending = queue.Queue()
+        for host in hosts:
+            pending.put(host)
+        settings = self.get_settings()
+
+        def worker():
+            while True:
+                try:
+                    host = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    with ExecutionContext(host=host, **settings):
+                        results[host] = task(*args, **kwargs)
+                except BaseException as error:  # Fabric aborts by SystemExit
+                    results[host] = error
+
+        threads = [
+            threading.Thread(target=worker)
+            for _ in range(min(self.workers, len(hosts)))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)  # keeps main thread interruptible
+        return results
@@ -0,0 +1,240 @@
+import json
+import os
+
+import six
+
+from six.moves import configparser
+
+import fabricio
+
+from fabricio.utils import OrderedDict, shell_quote
+
+
+class Inventory(object):
+    """
+    Hosts inventory loaded from JSON, YAML or INI file or from output
+    of executable which prints JSON.
+
+    JSON/YAML inventory is a mapping of host strings to host attributes
+    (or mapping with 'hosts' key containing such mapping):
+
+        {
+            "user@10.0.0.1": {
+                "roles": ["web", "db"],
+                "tags": ["primary"],
+                "region": "eu",
+                "infrastructure": "production"
+            }
+        }
+
+    INI inventory has a section per host, `roles` and `tags` are
+    comma separated lists:
+
+        [user@10.0.0.1]
+        roles = web, db
+        region = eu
+
+    Parsed inventory is reloaded only when file modification time changes.
+    Hosts are indexed by role, tag, region and infrastructure, so selection
+    cost depends on the size of the result, not on the size of inventory.
+    """
+
+    indexes = (
+        ('role', 'roles'),
+        ('tag', 'tags'),
+        ('region', 'region'),
+        ('infrastructure', 'infrastructure'),
+    )
+
+    cache = {}
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def __iter__(self):
+        return iter(self.select())
+
+    def __len__(self):
+        return len(self.load()[0])
+
+    def __getitem__(self, host):
+        return self.load()[0][host]
+
+    def __contains__(self, host):
+        return host in self.load()[0]
+
+    def load(self):
+        mtime = os.path.getmtime(self.path)
+        cached = self.cache.get(self.path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        hosts = OrderedDict(
+            (host, self.normalize_host_attributes(attributes))
+            for host, attributes in self.parse()
+        )
+        data = hosts, self.make_indexes(hosts)
+        self.cache[self.path] = mtime, data
+        return data
+
+    def parse(self):
+        extension = os.path.splitext(self.path)[1].lower()
+        if extension == '.json':
+            with open(self.path) as inventory_file:
+                return self.parse_data(json.load(inventory_file))
+        if extension in ('.yml', '.yaml'):
+            return self.parse_data(self.load_yaml())
+        if extension in ('.ini', '.cfg'):
+            return self.parse_ini()
+        if os.access(self.path, os.X_OK):
+            output = fabricio.local(shell_quote(self.path), capture=True)
+            return self.parse_data(json.loads(output))
+        raise ValueError('unknown inventory format: {path}'.format(
+            path=self.path,
+        ))
+
+    def load_yaml(self):
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError('PyYAML is required to load YAML inventory')
+        with open(self.path) as inventory_file:
+            return yaml.safe_load(inventory_file)
+
+    @staticmethod
+    def parse_data(data):
+        if isinstance(data, dict) and 'hosts' in data:
+            data = data['hosts']
+        if isinstance(data, dict):
+            return (
+                (host, attributes or {})
+                for host, attributes in data.items()
+            )
+        if isinstance(data, list):
+            return (
+                isinstance(host, dict)
+                and (host['host'], host)
+                or (host, {})
+                for host in data
+            )
+        raise ValueError('inventory must be a mapping or a list of hosts')
+
+    def parse_ini(self):
+        parser = configparser.RawConfigParser()
+        parser.optionxform = str  # keep case of the attributes names
+        with open(self.path) as inventory_file:
+            parser.readfp(inventory_file)
+        return (
+            (host, dict(parser.items(host)))
+            for host in parser.sections()
+        )
+
+    @staticmethod
+    def split_values(value):
+        if value is None:
+            return ()
+        if isinstance(value, six.string_types):
+            value = value.split(',')
+        elif not isinstance(value, (list, tuple, set, frozenset)):
+            value = (value, )
+        return tuple(
+            six.text_type(item).strip() for item in value
+            if six.text_type(item).strip()
+        )
+
+    def normalize_host_attributes(self, attributes):
+        attributes = dict(attributes)
+        attributes.pop('host', None)
+        attributes['roles'] = self.split_values(attributes.get('roles'))
+        attributes['tags'] = self.split_values(attributes.get('tags'))
+        return attributes
+
+    def make_indexes(self, hosts):
+        indexes = dict((name, {}) for name, attribute in self.indexes)
+        positions = {}
+        for position, (host, attributes) in enumerate(hosts.items()):
+            positions[host] = position
+            for name, attribute in self.indexes:
+                # any attribute may have several values (e.g. list
+                # of regions) which are normalized like roles and tags
+                values = self.split_values(attributes.get(attribute))
+                index = indexes[name]
+                for value in values:
+                    index.setdefault(value, []).append(host)
+        return dict(indexes=indexes, positions=positions)
+
+    def get_hosts(self, **criteria):
+        hosts, meta = self.load()
+        buckets = []
+        for name, value in criteria.items():
+            if value is None:
+                continue
+            if name not in meta['indexes']:
+                raise TypeError('unknown selector: {name}'.format(name=name))
+            bucket = meta['indexes'][name].get(value)
+            if not bucket:
+                return []
+            buckets.append(bucket)
+        if not buckets:
+            return list(hosts)
+        buckets.sort(key=len)
+        if len(buckets) == 1:
+            return list(buckets[0])
+        result = set(buckets[0])
+        for bucket in buckets[1:]:
+            result.intersection_update(bucket)
+            if not result:
+                return []
+        return sorted(result, key=meta['positions'].__getitem__)
+
+    def select(self, role=None, tag=None, region=None, infrastructure=None):
+        """
+        Returns lazy selection of hosts which can be used as `hosts`
+        of tasks or as value of `fab.env.roledefs`.
+        """
+        return InventorySelection(
+            inventory=self,
+            role=role,
+            tag=tag,
+            region=region,
+            infrastructure=infrastructure,
+        )
+
+    def roledefs(self, **criteria):
+        """
+        Returns roles definitions which can be used to update
+        `fab.env.roledefs`, e.g.:
+
+            fab.env.roledefs.update(inventory.roledefs(region='eu'))
+        """
+        meta = self.load()[1]
+        return dict(
+            (role, self.select(role=role, **criteria))
+            for role in meta['indexes']['role']
+        )
+
+
+class InventorySelection(object):
+
+    def __init__(self, inventory, **criteria):
+        self.inventory = inventory
+        self.criteria = criteria
+
+    def __iter__(self):
+        return iter(self.inventory.get_hosts(**self.criteria))
+
+    def __len__(self):
+        return len(self.inventory.get_hosts(**self.criteria))
+
+    def __call__(self):
+        # Fabric treats callable roledefs values as "lazy" roles
+        return self.inventory.get_hosts(**self.criteria)
+
+    def __repr__(self):
+        return '<{cls} {criteria}>'.format(
+            cls=type(self).__name__,
+            criteria=dict(
+                (name, value)
+                for name, value in self.criteria.items()
+                if value is not None
+            ),
+        )
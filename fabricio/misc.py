@@ -1,7 +1,12 @@
+import hashlib
+import json
+import os
 import re
+import socket
 
 from cached_property import cached_property
 from fabric import api as fab
+from fabric.network import normalize
 
 
 class AvailableVagrantHosts(object):
@@ -9,10 +14,24 @@ class AvailableVagrantHosts(object):
     Returns list of IP addresses of available vagrant VMs in the current dir.
 
     If provided guest_network_interface then it will be used to obtain the IP.
+
+    If use_cache is True then found hosts are stored in the '.vagrant' dir
+    and reused by the next runs until Vagrantfile or VMs set is changed,
+    `vagrant up` is skipped if all cached hosts accept SSH connections
+    (otherwise halted VMs are started).
     """
 
-    def __init__(self, guest_network_interface=None):
+    cache_file = os.path.join('.vagrant', 'fabricio_hosts.json')
+
+    def __init__(
+        self,
+        guest_network_interface=None,
+        use_cache=False,
+        parallel=True,
+    ):
         self.guest_network_interface = guest_network_interface
+        self.use_cache = use_cache
+        self.parallel = parallel
 
     def __iter__(self):
         return iter(self.hosts)
@@ -24,39 +43,110 @@ class AvailableVagrantHosts(object):
             "| head -1 "
             "| awk '{{ print $2 }}'"
         ).format(interface=self.guest_network_interface)
-        ip = fab.run(
+        return fab.run(
             ip_command,
             quiet=True,
         ).split('/')[0]
-        if not ip:
-            error_msg = 'Could not find IPV4 address of ' + fab.env.host_string
-            raise ValueError(error_msg)
-        return ip
+
+    def _get_ips(self, host_strings):
+        @fab.parallel
+        def get_ip():
+            return self._get_ip()
+
+        with fab.settings(
+            fab.hide('running', 'status'),
+            # see https://github.com/fabric/fabric/issues/1522
+            # disable_known_hosts=True,
+        ):
+            ips = fab.execute(get_ip, hosts=host_strings)
+        for host_string in host_strings:
+            # errors are checked here to not abort in parallel mode
+            if not ips.get(host_string):
+                error_msg = 'Could not find IPV4 address of ' + host_string
+                raise ValueError(error_msg)
+        return ips
+
+    @property
+    def cache_key(self):
+        md5 = hashlib.md5()
+        md5.update(str(self.guest_network_interface).encode())
+        with open('Vagrantfile', 'rb') as vagrantfile:
+            md5.update(vagrantfile.read())
+        machines_dir = os.path.join('.vagrant', 'machines')
+        for path, dirs, files in sorted(os.walk(machines_dir)):
+            for file_name in sorted(files):
+                file_path = os.path.join(path, file_name)
+                md5.update(file_path.encode())
+                md5.update(str(os.path.getmtime(file_path)).encode())
+        return md5.hexdigest()
+
+    def load_cache(self, key):
+        try:
+            with open(self.cache_file) as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, ValueError):
+            return None
+        if cache.get('key') != key:
+            return None
+        return cache
+
+    def save_cache(self, key, hosts, keys):
+        with open(self.cache_file, 'w') as cache_file:
+            json.dump(dict(key=key, hosts=hosts, keys=keys), cache_file)
+
+    @staticmethod
+    def is_reachable(host_strings, timeout=1):
+        for host_string in host_strings:
+            _, host, port = normalize(host_string)
+            try:
+                socket.create_connection((host, int(port)), timeout).close()
+            except (socket.error, socket.timeout):
+                return False
+        return True
+
+    @staticmethod
+    def use_cached_hosts(cache):
+        fab.env.key_filename = cache['keys']
+        for host_string in cache['hosts']:
+            fab.puts('Added host: ' + host_string)
+        return cache['hosts']
 
     @cached_property
     def hosts(self):
+        if self.use_cache:
+            cache = self.load_cache(self.cache_key)
+            if cache is not None and self.is_reachable(cache['hosts']):
+                # VMs are up already
+                return self.use_cached_hosts(cache)
+        fab.local(self.parallel and 'vagrant up --parallel' or 'vagrant up')
+        if self.use_cache:
+            # VMs state is changed by `vagrant up`
+            cache_key = self.cache_key
+            cache = self.load_cache(cache_key)
+            if cache is not None:
+                return self.use_cached_hosts(cache)
         keys = fab.env.key_filename = []
         hosts = []
-        fab.local('vagrant up')
         ssh_configs_data = fab.local('vagrant ssh-config', capture=True)
-        ssh_configs = map(
+        ssh_configs = list(map(
             lambda config: dict(map(
                 lambda row: row.lstrip().split(' ', 1),
                 config.splitlines()
             )),
             re.split('(?m)\s*^$\s*', ssh_configs_data),
-        )
+        ))
+        host_strings = []
         for ssh_config in ssh_configs:
             keys.append(ssh_config['IdentityFile'])
-            host_string = '{User}@{HostName}:{Port}'.format(**ssh_config)
-            if self.guest_network_interface is not None:
-                with fab.settings(
-                    host_string=host_string,
-                    # see https://github.com/fabric/fabric/issues/1522
-                    # disable_known_hosts=True,
-                ):
-                    ip = self._get_ip()
-                    host_string = '{User}@{ip}'.format(ip=ip, **ssh_config)
+            host_strings.append('{User}@{HostName}:{Port}'.format(**ssh_config))
+        if self.guest_network_interface is not None:
+            ips = self._get_ips(host_strings)
+            for index, ssh_config in enumerate(ssh_configs):
+                ip = ips[host_strings[index]]
+                host_strings[index] = '{User}@{ip}'.format(ip=ip, **ssh_config)
+        for host_string in host_strings:
             fab.puts('Added host: ' + host_string)
             hosts.append(host_string)
+        if self.use_cache:
+            self.save_cache(cache_key, hosts=hosts, keys=keys)
         return hosts
@@ -0,0 +1,284 @@
+import re
+import socket
+import sys
+import threading
+import time
+import uuid
+
+import six
+
+from fabric import api as fab, state
+from fabric.exceptions import CommandTimeout, NetworkError
+from fabric.network import normalize_to_string, ssh
+from fabric.operations import (
+    _AttributeString, _prefix_commands, _prefix_env_vars,
+)
+from fabric.utils import error
+
+from fabricio import utils
+
+__all__ = ['PersistentShell', 'run', 'close_all']
+
+_lock = threading.Lock()
+
+_shells = {}
+
+# commands which need terminal (e.g. `docker run --tty`) are run
+# by `fab.run` with pty, persistent shell has no terminal
+_tty_option = re.compile(r'(?:^|\s)(?:--tty|-t|-it|-ti)(?:[=\s]|$)')
+
+
+class ShellError(Exception):
+    pass
+
+
+class _OutputBuffer(object):
+    """
+    Collects output chunks until `end` pattern is found, only the new
+    chunk with the tail of previous data is searched each time
+    """
+
+    def __init__(self, end, max_end_size):
+        self.end = end
+        self.max_end_size = max_end_size
+        self.chunks = []
+        self.tail = b''
+        self.match = None
+
+    def feed(self, chunk):
+        if self.match is not None:
+            return
+        self.chunks.append(chunk)
+        window = self.tail + chunk
+        if self.end.search(window) is not None:
+            self.chunks = [b''.join(self.chunks)]
+            self.match = self.end.search(
+                self.chunks[0],
+                len(self.chunks[0]) - len(window),
+            )
+        self.tail = window[-self.max_end_size:]
+
+    @property
+    def data(self):
+        return self.chunks[0][:self.match.start()]
+
+
+class PersistentShell(object):
+    """
+    Long-running remote shell which executes commands sent to its stdin.
+
+    Fabric opens new SSH channel and starts new login shell (which sources
+    profile files) for each command. This shell is started once per host,
+    each command is run in a subshell (so `cd`, `exit`, etc. don't affect
+    the next ones) and is followed by unique sentinel line with exit code
+    written to stdout and stderr, output is read until these lines.
+    """
+
+    poll_interval = 0.005
+
+    recv_size = 32768
+
+    def __init__(self, connection, shell='/bin/bash -l'):
+        self.connection = connection
+        self.shell = shell
+        self.channel = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_active(self):
+        channel = self.channel
+        return (
+            channel is not None
+            and not channel.closed
+            and not channel.exit_status_ready()
+            and channel.get_transport().is_active()
+        )
+
+    def open(self):
+        transport = self.connection.get_transport()
+        if transport is None or not transport.is_active():
+            raise ShellError('SSH connection is closed')
+        self.channel = transport.open_session()
+        self.channel.exec_command(self.shell)
+        # skip output of profile scripts
+        sentinel = self.make_sentinel()
+        self.write(self.wrap_command('true', sentinel))
+        self.receive(sentinel, timeout=fab.env.timeout)
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+    @staticmethod
+    def wrap_command(command, sentinel):
+        return (
+            '(eval {command}) < /dev/null; '
+            "printf '\\n%s %s\\n' {sentinel} $?; "
+            "printf '\\n%s\\n' {sentinel} >&2\n"
+        ).format(command=utils.shell_quote(command), sentinel=sentinel)
+
+    @staticmethod
+    def make_sentinel():
+        return 'fabricio-' + uuid.uuid4().hex
+
+    def write(self, data):
+        if six.PY3:
+            data = data.encode()
+        self.channel.sendall(data)
+
+    def send(self, command, sentinel):
+        if not self.is_active:
+            self.close()
+            self.open()
+        self.write(self.wrap_command(command, sentinel))
+
+    def receive(self, sentinel, timeout=None):
+        """
+        Returns stdout, stderr and exit code of the last sent command
+        """
+        if six.PY3:
+            sentinel = sentinel.encode()
+        stdout = _OutputBuffer(
+            end=re.compile(b'\n' + re.escape(sentinel) + b' (\\d+)\n'),
+            max_end_size=len(sentinel) + 32,
+        )
+        stderr = _OutputBuffer(
+            end=re.compile(b'\n' + re.escape(sentinel) + b'\n'),
+            max_end_size=len(sentinel) + 2,
+        )
+        deadline = timeout and time.time() + timeout
+        while stdout.match is None or stderr.match is None:
+            received = False
+            if self.channel.recv_ready():
+                stdout.feed(self.channel.recv(self.recv_size))
+                received = True
+            if self.channel.recv_stderr_ready():
+                stderr.feed(self.channel.recv_stderr(self.recv_size))
+                received = True
+            if received:
+                continue
+            if self.channel.exit_status_ready():
+                raise ShellError('remote shell exited unexpectedly')
+            if deadline and time.time() > deadline:
+                raise CommandTimeout(timeout=timeout)
+            time.sleep(self.poll_interval)
+        status = int(stdout.match.group(1))
+        stdout, stderr = stdout.data, stderr.data
+        if six.PY3:
+            stdout = stdout.decode('utf-8', 'replace')
+            stderr = stderr.decode('utf-8', 'replace')
+        return stdout, stderr, status
+
+
+def get_shell():
+    host_string = normalize_to_string(fab.env.host_string)
+    # connects if necessary, hosts are connected concurrently
+    connection = state.connections[host_string]
+    with _lock:
+        shell = _shells.get(host_string)
+        if shell is None or shell.connection is not connection:
+            shell_command = fab.env.shell
+            if shell_command.endswith(' -c'):
+                shell_command = shell_command[:-3]
+            shell = _shells[host_string] = PersistentShell(
+                connection=connection,
+                shell=shell_command,
+            )
+        return shell
+
+
+def close_all():
+    with _lock:
+        for shell in _shells.values():
+            shell.close()
+        _shells.clear()
+
+
+def _print_output(data, stream, prefix):
+    stream = stream or sys.stdout
+    for line in data.splitlines():
+        stream.write('[{host}] {prefix}: {line}\n'.format(
+            host=fab.env.host_string,
+            prefix=prefix,
+            line=line,
+        ))
+
+
+def run(command, stdout=None, stderr=None, timeout=None, **kwargs):
+    """
+    Runs command using persistent shell of the current host,
+    falls back to `fab.run` if shell can't be started or used
+    (or if command needs terminal or options not supported by persistent
+    shell are provided)
+    """
+    if kwargs or _tty_option.search(command):
+        return fab.run(
+            command,
+            stdout=stdout,
+            stderr=stderr,
+            timeout=timeout,
+            **kwargs
+        )
+    real_command = _prefix_env_vars(_prefix_commands(command, 'remote'))
+    try:
+        shell = get_shell()
+    except (NetworkError, ShellError, ssh.SSHException, socket.error):
+        return fab.run(command, stdout=stdout, stderr=stderr, timeout=timeout)
+    if state.output.running:
+        (stdout or sys.stdout).write('[{host}] run: {command}\n'.format(
+            host=fab.env.host_string,
+            command=command,
+        ))
+    sentinel = shell.make_sentinel()
+    with shell.lock:
+        try:
+            shell.send(real_command, sentinel)
+        except (
+            ShellError,
+            CommandTimeout,
+            ssh.SSHException,
+            socket.error,
+            EOFError,
+        ):
+            shell.close()
+            return fab.run(
+                command,
+                stdout=stdout,
+                stderr=stderr,
+                timeout=timeout,
+            )
+        try:
+            result_stdout, result_stderr, status = shell.receive(
+                sentinel,
+                timeout=timeout or fab.env.command_timeout,
+            )
+        except BaseException:
+            # command may be still running, shell can't be reused
+            shell.close()
+            raise
+    if state.output.stdout:
+        _print_output(result_stdout, stdout, 'out')
+    if state.output.stderr:
+        _print_output(result_stderr, stderr, 'err')
+    out = _AttributeString(result_stdout.strip())
+    err = _AttributeString(result_stderr.strip())
+    out.failed = False
+    out.command = command
+    out.real_command = real_command
+    if status not in fab.env.ok_ret_codes:
+        out.failed = True
+        message = 'run() received nonzero return code {status}'.format(
+            status=status,
+        )
+        if fab.env.warn_only:
+            message += " while executing '{command}'!".format(command=command)
+        else:
+            message += ' while executing!\n\nRequested: {command}'.format(
+                command=command,
+            )
+        error(message=message, stdout=out, stderr=err)
+    out.return_code = status
+    out.succeeded = not out.failed
+    out.stderr = err
+    return out
@@ -1,29 +1,46 @@
+import atexit
 import contextlib
 import functools
+import json
 import os
 import sys
+import tempfile
+import threading
+import time
 import types
 import warnings
 
+import six
+
 from fabric import api as fab, colors
-from fabric.contrib import console
+from fabric.contrib import console, project
 from fabric.main import is_task_object
 from fabric.tasks import WrappedCallableTask
 
 import fabricio
 
 from fabricio import docker
-from fabricio.utils import patch, strtobool, Options, OrderedDict
+from fabricio.executor import ThreadedExecutor
+from fabricio.utils import strtobool, shell_quote, Options, OrderedDict
 
 __all__ = [
     'infrastructure',
     'skip_unknown_host',
+    'close_persistent_shells',
     'DockerTasks',
     'PullDockerTasks',
     'BuildDockerTasks',
+    'MultiImageBuildTasks',
 ]
 
 
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
 def skip_unknown_host(task):
     @functools.wraps(task)
     def _task(*args, **kwargs):
@@ -36,6 +53,19 @@ def skip_unknown_host(task):
     return _task
 
 
+def close_persistent_shells(task):
+    @functools.wraps(task)
+    def _task(*args, **kwargs):
+        try:
+            return task(*args, **kwargs)
+        finally:
+            if fab.env.persistent_shell:
+                from fabricio import shell
+                shell.close_all()
+    _task.wrapped = task  # compatibility with '--display <task>' option
+    return _task
+
+
 class IgnoreHostsTask(WrappedCallableTask):
 
     hosts = roles = property(lambda self: (), lambda self, value: None)
@@ -339,17 +369,16 @@ class PullDockerTasks(_DockerTasks):
         pull Docker image from registry
         """
         if self.tunnel_required:
-            with contextlib.closing(open(os.devnull, 'w')) as output:
-                with patch(sys, 'stdout', output):
-                    # forward sys.stdout to os.devnull to prevent
-                    # printing debug messages by fab.remote_tunnel
-
-                    with fab.remote_tunnel(
-                        remote_port=self.registry.port,
-                        local_port=self.local_registry.port,
-                        local_host=self.local_registry.host,
-                    ):
-                        _DockerTasks.pull(self, tag=tag)
+            with fabricio.ExecutionContext(mute_threads=True):
+                # mute debug messages printed by fab.remote_tunnel
+                # connection handlers running in paramiko's thread
+
+                with fab.remote_tunnel(
+                    remote_port=self.registry.port,
+                    local_port=self.local_registry.port,
+                    local_host=self.local_registry.host,
+                ):
+                    _DockerTasks.pull(self, tag=tag)
         else:
             _DockerTasks.pull(self, tag=tag)
 
@@ -392,6 +421,21 @@ class PullDockerTasks(_DockerTasks):
 
 class DockerTasks(Tasks):
 
+    preflight_timeout = 10
+
+    preflight_workers = 16
+
+    preflight_min_free_disk = 1024  # MiB
+
+    preflight_min_free_memory = 64  # MiB
+
+    preflight_command = (
+        "docker version --format '{{.Server.Version}}' "
+        "&& df -Pk \"$(docker info --format '{{.DockerRootDir}}')\" "
+        "| awk 'NR == 2 {print $4}' "
+        "&& awk '/^MemAvailable:/ {print $2}' /proc/meminfo"
+    )
+
     def __init__(
         self,
         container,
@@ -399,19 +443,46 @@ class DockerTasks(Tasks):
         ssh_tunnel_port=None,
         migrate_commands=False,
         backup_commands=False,
+        transfer_images=False,
+        local_registry=None,
+        use_digest=False,
+        skip_up_to_date=False,
+        pool_size=None,
+        preflight=False,
         **kwargs
     ):
         super(DockerTasks, self).__init__(**kwargs)
+        if local_registry:
+            if registry:
+                raise ValueError(
+                    'registry and local_registry can not be used together'
+                )
+            if local_registry is True:
+                local_registry = docker.LocalRegistry()
+            registry = local_registry.registry
+            ssh_tunnel_port = ssh_tunnel_port or local_registry.port
+        self.local_registry = local_registry or None
         self.container = container  # type: docker.Container
         self.registry = registry and docker.Registry(registry)
         self.ssh_tunnel_port = ssh_tunnel_port
+        self.transfer_images = transfer_images
+        self.use_digest = use_digest
+        self.skip_up_to_date = skip_up_to_date
+        self.preflight = preflight
+        self.pool_size = pool_size and int(pool_size)
+        self.digest = None
+        self._saved_images = {}
         self.backup.use_task_objects = backup_commands
         self.restore.use_task_objects = backup_commands
         self.migrate.use_task_objects = migrate_commands
         self.migrate_back.use_task_objects = migrate_commands
         self.revert.use_task_objects = False  # disabled in favour of rollback
-        self.prepare.use_task_objects = registry is not None
-        self.push.use_task_objects = registry is not None
+        self.prepare.use_task_objects = (
+            registry is not None or transfer_images
+        )
+        self.push.use_task_objects = (
+            registry is not None and not transfer_images
+        )
         self._backup_done = set()
         self._restore_done = set()
 
@@ -419,13 +490,22 @@ class DockerTasks(Tasks):
     def image(self):
         return self.container.image
 
+    @staticmethod
+    def get_generation_kwargs(generation):
+        generation = int(generation)
+        if generation == 1:
+            # containers overriding `revert()`/`migrate_back()` may not
+            # support generations
+            return {}
+        return dict(generation=generation)
+
     @fab.task
     @skip_unknown_host
-    def revert(self):
+    def revert(self, generation=1):
         """
         revert Docker container to previous version
         """
-        self.container.revert()
+        self.container.revert(**self.get_generation_kwargs(generation))
 
     @fab.task
     @fab.serial
@@ -439,20 +519,21 @@ class DockerTasks(Tasks):
     @fab.task
     @fab.serial
     @skip_unknown_host
-    def migrate_back(self):
+    def migrate_back(self, generation=1):
         """
         remove previously applied migrations if any
         """
-        self.container.migrate_back()
+        self.container.migrate_back(**self.get_generation_kwargs(generation))
 
     @fab.task(task_class=IgnoreHostsTask)
-    def rollback(self, migrate_back=True):
+    def rollback(self, migrate_back=True, generation=1):
         """
         rollback Docker container to previous version
+        (`generation` > 1 selects one of the older kept versions)
         """
         if strtobool(migrate_back):
-            fab.execute(self.migrate_back)
-        fab.execute(self.revert)
+            fab.execute(self.migrate_back, generation=generation)
+        fab.execute(self.revert, generation=generation)
 
     @fab.task
     @fab.serial
@@ -476,13 +557,19 @@ class DockerTasks(Tasks):
             self._restore_done.add(fab.env.infrastructure)
             self.container.restore(backup_name=backup_filename)
 
+    def start_local_registry(self):
+        if self.local_registry is not None:
+            self.local_registry.start()
+
     @fab.task(task_class=IgnoreHostsTask)
     def prepare(self, tag=None):
         """
         prepare Docker image
         """
-        if self.registry is None:
+        if self.registry is None and not self.transfer_images:
             return
+        self.start_local_registry()
+        # image is sent to the hosts from local machine in transfer mode
         fabricio.local(
             'docker pull {image}'.format(image=self.image[tag]),
             quiet=False,
@@ -517,8 +604,9 @@ class DockerTasks(Tasks):
         """
         push Docker image to registry
         """
-        if self.registry is None:
+        if self.registry is None or self.transfer_images:
             return
+        self.start_local_registry()
         tag_with_registry = str(self.image[self.registry:tag])
         fabricio.local(
             'docker tag {image} {tag}'.format(
@@ -533,25 +621,297 @@ class DockerTasks(Tasks):
             use_cache=True,
         )
 
-    def pull_image(self, tag=None, registry=None):
-        temporary_tag = str(self.image[registry:tag])
+    def get_image_digest(self, image):
+        repo_digests = fabricio.local(
+            "docker inspect --type image --format '{{{{json .RepoDigests}}}}' "
+            "{image}".format(image=image),
+            capture=True,
+            ignore_errors=True,
+        )
+        if repo_digests.failed:
+            return None
+        reference = docker.ImageReference.parse(str(image))
+        for repo_digest in json.loads(repo_digests) or ():
+            repo_digest = docker.ImageReference.parse(repo_digest)
+            if (
+                repo_digest.registry == reference.registry
+                and repo_digest.name == reference.name
+            ):
+                return repo_digest.digest
+        return None
+
+    def resolve_digest(self, tag=None):
+        """
+        resolves tag of the image which is pulled by hosts to its digest,
+        local image is refreshed from registry first because it may be
+        outdated (e.g. if `prepare` was skipped)
+        """
+        image = self.image[self.registry:tag]
+        refreshed = fabricio.local(
+            'docker pull {image}'.format(image=image),
+            ignore_errors=True,
+        )
+        # digest of not refreshed image may be stale
+        digest = not refreshed.failed and self.get_image_digest(image) or None
+        if digest is None:
+            fab.warn('Could not resolve digest of {image}'.format(image=image))
+        else:
+            fabricio.log('{image} resolved to {digest}'.format(
+                image=image,
+                digest=digest,
+            ))
+        self.digest = digest
+        return digest
+
+    def pull_image(self, tag=None, registry=None, digest=None):
+        image = self.image[registry:tag]
+        if digest:
+            image = docker.Image(
+                name=image.name,
+                registry=image.registry,
+                digest=digest,
+            )
+        temporary_tag = str(image)
         fabricio.run(
             'docker pull {image}'.format(image=temporary_tag),
             quiet=False,
         )
-        if registry and registry != self.image.registry:
+        if digest or registry and registry != self.image.registry:
+            # image pulled by digest has no tag
             fabricio.run('docker tag {image} {tag}'.format(
                 image=temporary_tag,
                 tag=self.image[tag],
             ))
             fabricio.run('docker rmi {image}'.format(image=temporary_tag))
 
+    def get_transfer_image(self, tag=None):
+        """
+        returns local image which is sent to the hosts in transfer mode
+        """
+        return self.image[tag]
+
+    def get_target_image_id(self, tag=None):
+        """
+        returns ID of the local image which hosts get by pull
+        """
+        image_id = fabricio.local(
+            "docker inspect --type image --format '{{{{.Id}}}}' "
+            "{image}".format(image=self.get_transfer_image(tag)),
+            capture=True,
+            ignore_errors=True,
+        )
+        return not image_id.failed and image_id.strip() or None
+
+    def get_hosts(self):
+        """
+        returns hosts of the tasks taking into account roles
+        and command line options
+        """
+        return self.update.get_hosts_and_effective_roles([], [], [], fab.env)[0]
+
+    @fab.task(task_class=IgnoreHostsTask)
+    def status(self, workers=16, timeout=10):
+        """
+        show containers status (hosts are checked by pool of threads)
+        """
+        executor = ThreadedExecutor(workers=workers, timeout=timeout)
+        results = executor.execute(self.container.get_status, self.get_hosts())
+        for host, status in results.items():
+            color = colors.green
+            if isinstance(status, BaseException):
+                status = 'error: {error}'.format(error=status)
+                color = colors.red
+            elif status is None:
+                status = 'container {container} not found'.format(
+                    container=self.container,
+                )
+                color = colors.red
+            fabricio.log(
+                '{host}: {status}'.format(host=host, status=status),
+                color=color,
+            )
+        return results
+
+    def check_host(self):
+        """
+        checks Docker daemon, free disk space in Docker root directory
+        and free memory of the current host, returns Docker version
+        """
+        result = fabricio.run(self.preflight_command).splitlines()
+        if len(result) != 3:
+            raise RuntimeError('unexpected output: {result}'.format(
+                result=' '.join(result),
+            ))
+        version, free_disk, free_memory = result
+        problems = []
+        free_disk = int(free_disk) // 1024
+        if free_disk < self.preflight_min_free_disk:
+            problems.append('{free} MiB of free disk space'.format(
+                free=free_disk,
+            ))
+        free_memory = int(free_memory) // 1024
+        if free_memory < self.preflight_min_free_memory:
+            problems.append('{free} MiB of free memory'.format(
+                free=free_memory,
+            ))
+        if problems:
+            raise RuntimeError('only ' + ', '.join(problems))
+        return version.strip()
+
+    @fab.task(task_class=IgnoreHostsTask)
+    def check_hosts(self, timeout=None):
+        """
+        check connection, Docker daemon, free disk and memory of all hosts
+        """
+        executor = ThreadedExecutor(
+            workers=self.preflight_workers,
+            timeout=timeout or self.preflight_timeout,
+        )
+        results = executor.execute(self.check_host, self.get_hosts())
+        self._abort_if_failed(results, title='Pre-flight check')
+        return results
+
+    @property
+    def prepare_refreshes_image(self):
+        """
+        whether 'prepare' step updates local image which hosts get,
+        otherwise local image may be outdated
+        """
+        return self.registry is not None or self.transfer_images
+
+    def execute_concurrently(self, task, **kwargs):
+        """
+        executes task on all hosts by pool of `pool_size` threads of the
+        current process, falls back to `fab.execute` if pool size not set
+        """
+        if not self.pool_size:
+            return fab.execute(task, **kwargs)
+        executor = ThreadedExecutor(workers=self.pool_size)
+        results = executor.execute(task, self.get_hosts(), **kwargs)
+        self._abort_if_failed(results, title=task.name)
+        return results
+
+    @staticmethod
+    def _abort_if_failed(results, title):
+        """
+        aborts listing errors of all failed hosts if any,
+        `results` are returned by `ThreadedExecutor.execute`
+        """
+        failed = []
+        for host, result in results.items():
+            if isinstance(result, BaseException):
+                failed.append('{host}: {error}'.format(
+                    host=host,
+                    error=str(result).strip() or type(result).__name__,
+                ))
+        if failed:
+            fab.abort('{title} failed:\n{failed}'.format(
+                title=title,
+                failed='\n'.join(failed),
+            ))
+
+    def hosts_up_to_date(self, tag=None):
+        """
+        checks all hosts by pool of threads, returns True only if deploy
+        would not change anything on any host
+        """
+        image_id = self.get_target_image_id(tag)
+        if image_id is None:
+            return False
+        hosts = self.get_hosts()
+        if not hosts:
+            return False
+        results = ThreadedExecutor().execute(
+            self.container.is_up_to_date,
+            hosts,
+            image_id,
+        )
+        # errors are treated as changes
+        return all(result is True for result in results.values())
+
+    def save_image(self, image):
+        path = self._saved_images.get(str(image))
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.tar')
+            os.close(fd)
+            atexit.register(_remove_file, path)
+            fabricio.local('docker save --output {path} {image}'.format(
+                path=path,
+                image=image,
+            ))
+            self._saved_images[str(image)] = path
+        return docker.ImageArchive(path)
+
+    @staticmethod
+    def get_host_layers_chains():
+        result = fabricio.run(
+            'docker images --quiet --no-trunc '
+            '| xargs docker inspect --type image '
+            "--format '{{json .RootFS.Layers}}'",
+            ignore_errors=True,
+        )
+        if result.failed:
+            return []
+        return [
+            json.loads(line) or []
+            for line in result.splitlines() if line.strip()
+        ]
+
+    def transfer_image(self, tag=None):
+        """
+        sends image to the host without registry, layers which host
+        already has are not sent
+        """
+        image = self.get_transfer_image(tag)
+        archive = self.save_image(image)
+        delta_fd, delta = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(delta_fd)
+        try:
+            skipped_size = archive.make_delta(
+                delta,
+                chains=self.get_host_layers_chains(),
+            )
+            fabricio.log(
+                'Uploading {image}: {size:.1f} MB ({skipped:.1f} MB of '
+                'layers found on host)'.format(
+                    image=image,
+                    size=os.path.getsize(delta) / 1048576.0,
+                    skipped=skipped_size / 1048576.0,
+                )
+            )
+            remote_path = fabricio.run('mktemp')
+            try:
+                fab.put(delta, remote_path)
+                fabricio.run(
+                    'docker load --input {path}'.format(path=remote_path),
+                    quiet=False,
+                )
+            finally:
+                fabricio.remove(remote_path, ignore_errors=True)
+        finally:
+            os.remove(delta)
+        if str(image) != str(self.image[tag]):
+            fabricio.run('docker tag {image} {tag}'.format(
+                image=image,
+                tag=self.image[tag],
+            ))
+            fabricio.run('docker rmi {image}'.format(image=image))
+
     @fab.task
     @skip_unknown_host
-    def pull(self, tag=None):
+    def pull(self, tag=None, digest=None):
         """
         pull Docker image from registry
         """
+        if self.transfer_images:
+            self.transfer_image(tag=tag)
+        else:
+            self.pull_registry_image(tag=tag, digest=digest)
+        if self.container.use_standby:
+            self.container.create_standby_container(tag=tag)
+
+    def pull_registry_image(self, tag=None, digest=None):
+        self.start_local_registry()
         if self.ssh_tunnel_port:
             if self.registry:
                 local_port = self.registry.port
@@ -564,20 +924,23 @@ class DockerTasks(Tasks):
                     'Either local host or local port for SSH tunnel '
                     'can not be obtained'
                 )
-            with contextlib.closing(open(os.devnull, 'w')) as output:
-                with patch(sys, 'stdout', output):
-                    # forward sys.stdout to os.devnull to prevent
-                    # printing debug messages by fab.remote_tunnel
-
-                    with fab.remote_tunnel(
-                        remote_port=self.ssh_tunnel_port,
-                        local_port=local_port,
-                        local_host=local_host,
-                    ):
-                        registry = 'localhost:{0}'.format(self.ssh_tunnel_port)
-                        self.pull_image(tag=tag, registry=registry)
+            with fabricio.ExecutionContext(mute_threads=True):
+                # mute debug messages printed by fab.remote_tunnel
+                # connection handlers running in paramiko's thread
+
+                with fab.remote_tunnel(
+                    remote_port=self.ssh_tunnel_port,
+                    local_port=local_port,
+                    local_host=local_host,
+                ):
+                    registry = 'localhost:{0}'.format(self.ssh_tunnel_port)
+                    self.pull_image(
+                        tag=tag,
+                        registry=registry,
+                        digest=digest,
+                    )
         else:
-            self.pull_image(tag=tag, registry=self.registry)
+            self.pull_image(tag=tag, registry=self.registry, digest=digest)
 
     @fab.task
     @skip_unknown_host
@@ -590,6 +953,7 @@ class DockerTasks(Tasks):
             fabricio.log('No changes detected, update skipped.')
 
     @fab.task(default=True, task_class=IgnoreHostsTask)
+    @close_persistent_shells
     def deploy(
         self,
         tag=None,
@@ -601,12 +965,41 @@ class DockerTasks(Tasks):
         """
         prepare -> push -> backup -> pull -> migrate -> update
         """
-        if strtobool(prepare):
-            fab.execute(self.prepare, tag=tag)
-            fab.execute(self.push, tag=tag)
-        if strtobool(backup):
-            fab.execute(self.backup)
-        fab.execute(self.pull, tag=tag)
+        if self.preflight:
+            # fails fast, connections are reused by the next steps
+            self.check_hosts()
+        try:
+            # local registry (if any) is needed until pull is done
+            self.start_local_registry()
+            if strtobool(prepare):
+                fab.execute(self.prepare, tag=tag)
+            if (
+                self.skip_up_to_date
+                and not strtobool(force)
+                and strtobool(prepare)
+                and self.prepare_refreshes_image
+                and self.hosts_up_to_date(tag)
+            ):
+                fabricio.log('All hosts are up to date, deploy skipped.')
+                return
+            if strtobool(prepare):
+                fab.execute(self.push, tag=tag)
+            if strtobool(backup):
+                fab.execute(self.backup)
+            pull_kwargs = dict(tag=tag)
+            if self.transfer_images:
+                # save image once before pull is (possibly) run in parallel
+                self.save_image(self.get_transfer_image(tag))
+            elif self.use_digest:
+                # all hosts get the same image even if tag is changed
+                # in the middle of deploy
+                pull_kwargs['digest'] = self.resolve_digest(tag)
+            # the only step run concurrently if `pool_size` is set, update
+            # stays serial to not restart all hosts at once
+            self.execute_concurrently(self.pull, **pull_kwargs)
+        finally:
+            if self.local_registry is not None:
+                self.local_registry.stop()
         if strtobool(migrate):
             fab.execute(self.migrate, tag=tag)
         fab.execute(self.update, tag=tag, force=force)
@@ -672,25 +1065,200 @@ class BuildDockerTasks(PullDockerTasks):
 
 class ImageBuildDockerTasks(DockerTasks):
 
-    def __init__(self, container, build_path='.', **kwargs):
+    build_fingerprint_label = 'fabricio.build.fingerprint'
+
+    def __init__(
+        self,
+        container,
+        build_path='.',
+        use_build_fingerprint=False,
+        use_cache_from=False,
+        inline_cache=False,
+        build_host=None,
+        remote_build_path=None,
+        **kwargs
+    ):
         super(ImageBuildDockerTasks, self).__init__(container, **kwargs)
+        if build_host is not None and self.transfer_images:
+            # image is transferred from the local machine
+            raise ValueError(
+                'build_host and transfer_images can not be used together'
+            )
         self.build_path = build_path
+        self.use_build_fingerprint = use_build_fingerprint
+        self.use_cache_from = use_cache_from
+        self.inline_cache = inline_cache
+        self.build_host = build_host
+        self._remote_build_path = remote_build_path
         self.prepare.use_task_objects = True
-        self.push.use_task_objects = True
+        self.push.use_task_objects = not self.transfer_images
+
+    @property
+    def remote_build_path(self):
+        return self._remote_build_path or (
+            '/tmp/fabricio/build/' + self.image.name.replace('/', '_')
+        )
+
+    def build_command(self, command, **kwargs):
+        """
+        runs command locally or on the build host if provided
+        """
+        if self.build_host is None:
+            return fabricio.local(command, **kwargs)
+        kwargs.pop('capture', None)
+        with fab.settings(host_string=self.build_host):
+            return fabricio.run(command, **kwargs)
+
+    def sync_build_context(self):
+        """
+        copies build context to the build host, only changed files are
+        transferred, files removed locally are removed remotely too
+        """
+        rules = []
+        directories = set()
+        for path in docker.BuildContext(self.build_path).files():
+            parts = path.split('/')
+            for index in range(1, len(parts)):
+                directory = '/'.join(parts[:index])
+                if directory not in directories:
+                    directories.add(directory)
+                    rules.append('+ /' + directory + '/')
+            rules.append('+ /' + path)
+        rules.append('- *')
+        filters_fd, filters = tempfile.mkstemp(suffix='.rsync')
+        try:
+            with os.fdopen(filters_fd, 'w') as filters_file:
+                filters_file.write('\n'.join(rules) + '\n')
+            self.build_command('mkdir -p {path}'.format(
+                path=self.remote_build_path,
+            ))
+            with fab.settings(host_string=self.build_host):
+                project.rsync_project(
+                    remote_dir=self.remote_build_path,
+                    local_dir=os.path.join(self.build_path, ''),
+                    delete=True,
+                    extra_opts='--filter={filters} --delete-excluded'.format(
+                        filters=shell_quote('. ' + filters),
+                    ),
+                )
+        finally:
+            os.remove(filters)
+
+    def get_transfer_image(self, tag=None):
+        return self.image[self.registry:tag]
+
+    @property
+    def prepare_refreshes_image(self):
+        return True  # image is built or found by 'prepare'
+
+    def get_target_image_id(self, tag=None):
+        image_id = self.build_command(
+            "docker inspect --type image --format '{{{{.Id}}}}' "
+            "{image}".format(image=self.get_transfer_image(tag)),
+            capture=True,
+            ignore_errors=True,
+        )
+        return not image_id.failed and image_id.strip() or None
+
+    def get_build_fingerprint(self):
+        return docker.BuildContext(self.build_path).fingerprint()
+
+    def find_built_image(self, image, fingerprint):
+        """
+        looks for image built from the same context locally and then
+        in the registry, found local image is tagged as `image`
+        """
+        repository = image.name
+        if image.registry:
+            repository = '{registry}/{name}'.format(
+                registry=image.registry,
+                name=image.name,
+            )
+        # labels are inherited by child images, so images of other
+        # repositories built from the found one are filtered out
+        image_id = self.build_command(
+            'docker images --quiet --filter label={label}={fingerprint} '
+            '--filter reference={repository} | head -1'.format(
+                label=self.build_fingerprint_label,
+                fingerprint=fingerprint,
+                repository=repository,
+            ),
+            capture=True,
+            ignore_errors=True,
+        )
+        if image_id:
+            self.build_command('docker tag {image_id} {image}'.format(
+                image_id=image_id,
+                image=image,
+            ))
+            return True
+        if not self.registry:
+            return False
+        if not self.pull_previous_image(image):
+            return False
+        image_fingerprint = self.build_command(
+            "docker inspect --type image "
+            "--format '{{{{index .Config.Labels \"{label}\"}}}}' "
+            "{image}".format(label=self.build_fingerprint_label, image=image),
+            capture=True,
+            ignore_errors=True,
+        )
+        return image_fingerprint == fingerprint
+
+    def pull_previous_image(self, image):
+        result = self.build_command(
+            'docker pull {image}'.format(image=image),
+            ignore_errors=True,
+            use_cache=True,
+        )
+        return not result.failed
+
+    def get_cache_from(self, image, no_cache=False):
+        """
+        pulls previous version of the image from the registry to use it
+        as build cache (on clean build machines especially)
+        """
+        if no_cache or not self.use_cache_from or not self.registry:
+            return None
+        return self.pull_previous_image(image) and str(image) or None
 
     @fab.task(task_class=IgnoreHostsTask)
     def prepare(self, tag=None, no_cache=False):
         """
         prepare Docker image
         """
+        self.start_local_registry()
+        image = self.image[self.registry:tag]
+        fingerprint = None
+        if self.use_build_fingerprint and not strtobool(no_cache):
+            # note that updates of base images are not taken into account,
+            # use `no_cache` to force build
+            fingerprint = self.get_build_fingerprint()
+            if self.find_built_image(image, fingerprint):
+                fabricio.log(
+                    'Build context not changed, build of {image} '
+                    'skipped.'.format(image=image)
+                )
+                return
         options = Options([
-            ('tag', str(self.image[self.registry:tag])),
+            ('tag', str(image)),
             ('no-cache', strtobool(no_cache)),
             ('pull', True),
+            ('label', fingerprint and '{label}={fingerprint}'.format(
+                label=self.build_fingerprint_label,
+                fingerprint=fingerprint,
+            )),
+            ('cache-from', self.get_cache_from(image, strtobool(no_cache))),
+            # store cache metadata in the image (requires BuildKit)
+            ('build-arg', self.inline_cache and 'BUILDKIT_INLINE_CACHE=1'),
         ])
-        fabricio.local(
+        build_path = self.build_path
+        if self.build_host is not None:
+            self.sync_build_context()
+            build_path = self.remote_build_path
+        self.build_command(
             'docker build {options} {build_path}'.format(
-                build_path=self.build_path,
+                build_path=build_path,
                 options=options,
             ),
             quiet=False,
@@ -698,9 +1266,223 @@ class ImageBuildDockerTasks(DockerTasks):
         )
         self.delete_dangling_images()
 
+    def delete_dangling_images(self):
+        if self.build_host is None:
+            return super(ImageBuildDockerTasks, self).delete_dangling_images()
+        self.build_command(
+            'for img in $(docker images --filter "dangling=true" --quiet); '
+            'do docker rmi "$img"; done'
+        )
+
+    def push_image(self, tag=None):
+        self.build_command(
+            'docker push {image}'.format(image=self.image[self.registry:tag]),
+            quiet=False,
+            use_cache=True,
+        )
+
     @fab.task(task_class=IgnoreHostsTask)
     def push(self, tag=None):
         """
         push Docker image to registry
         """
+        if self.transfer_images:
+            return  # image is sent to the hosts directly
+        self.start_local_registry()
         self.push_image(tag=tag)
+
+
+class MultiImageBuildTasks(Tasks):
+    """
+    Builds and pushes images of several `ImageBuildDockerTasks` concurrently.
+
+    Images which are based on other images of the set (see FROM instruction
+    of their Dockerfile) are built only after their base images.
+    """
+
+    def __init__(self, build_tasks, workers=4, **kwargs):
+        super(MultiImageBuildTasks, self).__init__(**kwargs)
+        self.build_tasks = list(build_tasks)
+        self.workers = workers
+
+    def get_dependencies(self, tag=None):
+        references = [
+            docker.ImageReference.parse(str(tasks.image[tasks.registry:tag]))
+            for tasks in self.build_tasks
+        ]
+        dependencies = []
+        for tasks in self.build_tasks:
+            base_images = docker.BuildContext(tasks.build_path).base_images()
+            depends_on = set()
+            for base_image in map(docker.ImageReference.parse, base_images):
+                for index, reference in enumerate(references):
+                    if base_image.name == reference.name and (
+                        not base_image.registry
+                        or base_image.registry == reference.registry
+                    ):
+                        depends_on.add(index)
+            depends_on.discard(len(dependencies))
+            dependencies.append(depends_on)
+        return dependencies
+
+    # seconds between checks of worker processes
+    poll_interval = 1
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _prefix_output(prefix):
+        """
+        prefixes each line written to stdout and stderr of the current
+        process including output of commands it runs (e.g. `docker build`)
+        """
+        prefix = prefix.encode()
+        threads = []
+        originals = {}
+        for fd in (1, 2):
+            getattr(sys, fd == 1 and 'stdout' or 'stderr').flush()
+            read_fd, write_fd = os.pipe()
+            original = originals[fd] = os.dup(fd)
+            os.dup2(write_fd, fd)
+            os.close(write_fd)
+
+            def copy(read_fd=read_fd, original=original):
+                with os.fdopen(read_fd, 'rb') as pipe:
+                    for line in iter(pipe.readline, b''):
+                        os.write(original, prefix + line)
+
+            thread = threading.Thread(target=copy)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, original in originals.items():
+                os.dup2(original, fd)  # closes pipe, so copy thread stops
+            for thread in threads:
+                thread.join()
+            for original in originals.values():
+                os.close(original)
+
+    @classmethod
+    def _run_task(cls, index, task, results, prefix, **kwargs):
+        started = time.time()
+        error = None
+        try:
+            with cls._prefix_output(prefix):
+                fab.execute(task, **kwargs)
+        except BaseException as exception:
+            error = repr(exception)
+        results.put((index, error, time.time() - started))
+
+    def get_image(self, index, tag=None):
+        build_tasks = self.build_tasks[index]
+        return str(build_tasks.image[build_tasks.registry:tag])
+
+    def run_concurrently(
+        self,
+        task_name,
+        tag=None,
+        dependencies=None,
+        **kwargs
+    ):
+        import multiprocessing
+
+        kwargs['tag'] = tag
+        dependencies = dependencies or [set() for _ in self.build_tasks]
+        results = multiprocessing.Queue()
+        pending = list(range(len(self.build_tasks)))
+        running = {}
+        done = set()
+        timings = OrderedDict()
+        errors = []
+
+        def finish(index, error, elapsed):
+            image = self.get_image(index, tag=tag)
+            timings[image] = elapsed
+            if error is not None:
+                errors.append('{image}: {error}'.format(
+                    image=image,
+                    error=error,
+                ))
+            done.add(index)
+
+        while pending or running:
+            for index in list(pending):
+                if errors or len(running) >= max(int(self.workers), 1):
+                    break
+                if dependencies[index] <= done:
+                    pending.remove(index)
+                    process = running[index] = multiprocessing.Process(
+                        target=self._run_task,
+                        args=(
+                            index,
+                            getattr(self.build_tasks[index], task_name),
+                            results,
+                            '[{image}] '.format(
+                                image=self.get_image(index, tag=tag),
+                            ),
+                        ),
+                        kwargs=kwargs,
+                    )
+                    process.start()
+            if not running:
+                if pending and not errors:
+                    fab.abort('Circular dependency between images found')
+                break
+            try:
+                index, error, elapsed = results.get(timeout=self.poll_interval)
+            except six.moves.queue.Empty:
+                # worker killed (e.g. by OOM killer) never reports result
+                for index, process in list(running.items()):
+                    if process.exitcode:
+                        running.pop(index).join()
+                        finish(index, 'process exited with code {code}'.format(
+                            code=process.exitcode,
+                        ), elapsed=0)
+                continue
+            if index not in running:
+                continue  # already marked as failed
+            running.pop(index).join()
+            finish(index, error, elapsed)
+        for image, elapsed in timings.items():
+            fabricio.log('{task} {image}: {elapsed:.1f}s'.format(
+                task=task_name,
+                image=image,
+                elapsed=elapsed,
+            ))
+        if errors:
+            fab.abort('{task} failed:\n{errors}'.format(
+                task=task_name,
+                errors='\n'.join(errors),
+            ))
+        return timings
+
+    @fab.task(task_class=IgnoreHostsTask)
+    def prepare(self, tag=None, no_cache=False):
+        """
+        prepare Docker images concurrently
+        """
+        self.run_concurrently(
+            'prepare',
+            tag=tag,
+            dependencies=self.get_dependencies(tag=tag),
+            no_cache=no_cache,
+        )
+
+    @fab.task(task_class=IgnoreHostsTask)
+    def push(self, tag=None):
+        """
+        push Docker images to registry concurrently
+        """
+        self.run_concurrently('push', tag=tag)
+
+    @fab.task(default=True, task_class=IgnoreHostsTask)
+    def build(self, tag=None, no_cache=False):
+        """
+        prepare -> push
+        """
+        fab.execute(self.prepare, tag=tag, no_cache=no_cache)
+        fab.execute(self.push, tag=tag)
@@ -1,11 +1,15 @@
 import contextlib
-import re
 
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 
+try:
+    from shlex import quote as shell_quote
+except ImportError:  # Python 2
+    from pipes import quote as shell_quote
+
 from distutils import util as distutils
 
 import six
@@ -36,35 +40,80 @@ class default_property(object):
 
 
 class Options(OrderedDict):
+    """
+    Command line options, values are quoted using POSIX shell rules.
 
-    quoting_required_regex = re.compile('[\s"\']+')
+    Option value can be a string, an integer, a boolean (flag), a list of
+    values or a mapping (e.g. env variables) which is rendered as a list
+    of 'key=value' pairs
+    """
 
-    def quote_option_value(self, value):
-        if value and not self.quoting_required_regex.search(value):
-            return value
-        return '"{value}"'.format(value=value.replace('"', '\\"'))
+    rendered_options_cache_size = 4096
+
+    rendered_options = {}  # (option, value) -> rendered option
+
+    @staticmethod
+    def quote_option_value(value):
+        return shell_quote(value)
 
     def make_option(self, option, value=None):
-        option = '--' + option
-        if value is not None:
-            # TODO escape value
-            option += ' ' + self.quote_option_value(value)
-        return option
+        key = option, value
+        rendered_option = self.rendered_options.get(key)
+        if rendered_option is None:
+            rendered_option = '--' + option
+            if value is not None:
+                rendered_option += ' ' + self.quote_option_value(value)
+            if len(self.rendered_options) >= self.rendered_options_cache_size:
+                self.rendered_options.clear()
+            self.rendered_options[key] = rendered_option
+        return rendered_option
+
+    @staticmethod
+    def make_value(value):
+        if isinstance(value, six.string_types):
+            return value
+        return str(value)
+
+    def make_values(self, value):
+        if value is None:
+            return ()
+        if isinstance(value, bool):
+            return (None, ) if value else ()
+        if isinstance(value, six.string_types):
+            return (value, )
+        if isinstance(value, six.integer_types):
+            return (str(value), )
+        if hasattr(value, 'items'):
+            items = value.items()
+            if not isinstance(value, OrderedDict):
+                items = sorted(items)
+            return tuple(
+                self.make_value(key) + '=' + self.make_value(item_value)
+                for key, item_value in items
+            )
+        return tuple(
+            self.make_value(single_value)
+            for single_value in value
+            if single_value is not None
+        )
 
     def make_options(self):
         for option, value in self.items():
-            if value is None:
-                continue
-            if isinstance(value, bool):
-                if value is True:
-                    yield self.make_option(option)
-            elif isinstance(value, six.string_types):
-                yield self.make_option(option, value)
-            elif isinstance(value, six.integer_types):
-                yield self.make_option(option, str(value))
-            else:
-                for single_value in value:
-                    yield self.make_option(option, single_value)
+            for single_value in self.make_values(value):
+                yield self.make_option(option, single_value)
+
+    def make_argv(self):
+        """
+        Returns options as list of arguments which can be passed to
+        the command without shell
+        """
+        argv = []
+        for option, value in self.items():
+            for single_value in self.make_values(value):
+                argv.append('--' + option)
+                if single_value is not None:
+                    argv.append(single_value)
+        return argv
 
     def __str__(self):
         return ' '.join(self.make_options())
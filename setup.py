@@ -10,7 +10,6 @@ install_requires = [
     'Fabric>=1.1,<2.0',
     'frozendict>=1.2,<2.0',
     'cached-property>=1.3',
-    'docker-py>=1.8.1,<2.0',
     'six>=1.4.0',
 ]
 
@@ -7,7 +7,7 @@ import fabricio
 
 from fabricio import docker
 from fabricio.apps.python.django import DjangoContainer
-from tests import SucceededResult
+from tests import SucceededResult, FailedResult
 
 
 class DjangoContainerTestCase(unittest.TestCase):
@@ -68,6 +68,109 @@ class DjangoContainerTestCase(unittest.TestCase):
                             run.mock_calls,
                         )
 
+    @mock.patch.object(fabricio, 'log')
+    def test_migrate_with_fingerprint(self, *args):
+        fingerprint_cmd = (
+            'docker run --rm --tty --interactive image:tag '
+            'sh -c \'find . -path "*/migrations/*.py" -type f -exec md5sum {} + '
+            '| LC_ALL=C sort -k 2 | md5sum\''
+        )
+        cases = dict(
+            new_image=dict(
+                side_effect=(
+                    SucceededResult('[{"Id": "image_id"}]'),
+                    FailedResult(),
+                    SucceededResult('Waiting for database...\r\nd41d8cd98f00b204e9800998ecf8427e  -\r\n'),
+                    SucceededResult(),
+                    FailedResult(),
+                    SucceededResult(),
+                    SucceededResult(),
+                ),
+                expected_commands=[
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('cat /fingerprints/images/image_id', ignore_errors=True),
+                    mock.call(fingerprint_cmd, quiet=True),
+                    mock.call('mkdir -p /fingerprints/images && echo d41d8cd98f00b204e9800998ecf8427e > /fingerprints/images/image_id'),
+                    mock.call('cat /fingerprints/name.applied', ignore_errors=True),
+                    mock.call('docker run --rm --tty --interactive image:tag python manage.py migrate --noinput', quiet=False),
+                    mock.call('mkdir -p /fingerprints && echo d41d8cd98f00b204e9800998ecf8427e > /fingerprints/name.applied'),
+                ],
+            ),
+            new_migrations=dict(
+                side_effect=(
+                    SucceededResult('[{"Id": "image_id"}]'),
+                    SucceededResult('d41d8cd98f00b204e9800998ecf8427e'),
+                    SucceededResult('0cc175b9c0f1b6a831c399e269772661'),
+                    SucceededResult(),
+                    SucceededResult(),
+                ),
+                expected_commands=[
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('cat /fingerprints/images/image_id', ignore_errors=True),
+                    mock.call('cat /fingerprints/name.applied', ignore_errors=True),
+                    mock.call('docker run --rm --tty --interactive image:tag python manage.py migrate --noinput', quiet=False),
+                    mock.call('mkdir -p /fingerprints && echo d41d8cd98f00b204e9800998ecf8427e > /fingerprints/name.applied'),
+                ],
+            ),
+            no_new_migrations=dict(
+                side_effect=(
+                    SucceededResult('[{"Id": "image_id"}]'),
+                    SucceededResult('d41d8cd98f00b204e9800998ecf8427e'),
+                    SucceededResult('d41d8cd98f00b204e9800998ecf8427e'),
+                ),
+                expected_commands=[
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('cat /fingerprints/images/image_id', ignore_errors=True),
+                    mock.call('cat /fingerprints/name.applied', ignore_errors=True),
+                ],
+            ),
+            invalid_cached_fingerprint=dict(
+                side_effect=(
+                    SucceededResult('[{"Id": "image_id"}]'),
+                    SucceededResult('Waiting'),
+                    SucceededResult('d41d8cd98f00b204e9800998ecf8427e  -'),
+                    SucceededResult(),
+                    SucceededResult('d41d8cd98f00b204e9800998ecf8427e'),
+                ),
+                expected_commands=[
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('cat /fingerprints/images/image_id', ignore_errors=True),
+                    mock.call(fingerprint_cmd, quiet=True),
+                    mock.call('mkdir -p /fingerprints/images && echo d41d8cd98f00b204e9800998ecf8427e > /fingerprints/images/image_id'),
+                    mock.call('cat /fingerprints/name.applied', ignore_errors=True),
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(
+                    fabricio,
+                    'run',
+                    side_effect=data['side_effect'],
+                ) as run:
+                    container = DjangoContainer(
+                        name='name',
+                        image='image:tag',
+                        migrations_fingerprint_dir='/fingerprints',
+                    )
+                    container.migrate()
+                    self.assertListEqual(run.mock_calls, data['expected_commands'])
+
+    def test_migrate_with_invalid_fingerprint_output(self):
+        container = DjangoContainer(
+            name='name',
+            image='image:tag',
+            migrations_fingerprint_dir='/fingerprints',
+        )
+        side_effect = (
+            SucceededResult('[{"Id": "image_id"}]'),
+            FailedResult(),
+            SucceededResult('Waiting for database...'),
+        )
+        with mock.patch.object(fabricio, 'run', side_effect=side_effect):
+            with self.assertRaises(RuntimeError):
+                container.migrate()
+
     def test_migrate_back(self):
         cases = dict(
             no_change=dict(
@@ -204,6 +307,41 @@ class DjangoContainerTestCase(unittest.TestCase):
                     container.migrate_back()
                     self.assertListEqual(run.mock_calls, expected_commands)
 
+    def test_migrate_back_with_session(self):
+        side_effect = (
+            SucceededResult('[{"Image": "current_image_id"}]'),
+            SucceededResult('container_id'),
+            SucceededResult(
+                'app1.0001_initial\n'
+                'app1.0002_foo\n'
+            ),
+            SucceededResult('[{"Image": "backup_image_id"}]'),
+            SucceededResult(),
+            SucceededResult(),
+            SucceededResult(),
+        )
+        expected_commands = [
+            mock.call('docker inspect --type container name'),
+            mock.call('docker run --interactive --detach --entrypoint cat current_image_id'),
+            mock.call('docker exec --tty --interactive container_id python manage.py showmigrations --plan | egrep "^\[X\]" | awk "{print \$2}"', quiet=True),
+            mock.call('docker inspect --type container name_backup'),
+            mock.call('docker run --rm --tty --interactive backup_image_id python manage.py showmigrations --plan | egrep "^\[X\]" | awk "{print \$2}"', quiet=True),
+            mock.call('docker exec --tty --interactive container_id python manage.py migrate --no-input app1 zero', quiet=False),
+            mock.call('docker rm --force container_id', ignore_errors=True),
+        ]
+        with mock.patch.object(
+            fabricio,
+            'run',
+            side_effect=side_effect,
+        ) as run:
+            container = DjangoContainer(
+                name='name',
+                image='image:tag',
+                migrations_session_enabled=True,
+            )
+            container.migrate_back()
+            self.assertListEqual(run.mock_calls, expected_commands)
+
     def test_migrate_back_errors(self):
         cases = dict(
             current_container_not_found=dict(
@@ -0,0 +1,124 @@
+import sys
+import threading
+
+import mock
+import six
+import unittest2 as unittest
+
+from fabric import api as fab, state
+
+import fabricio
+
+from fabricio.context import ExecutionContext, get_current_context, _ContextDict
+
+
+class ExecutionContextTestCase(unittest.TestCase):
+
+    def test_threads_do_not_share_settings_and_output(self):
+        outputs = {}
+        hosts = {}
+        entered = threading.Semaphore(0)
+        proceed = threading.Event()
+
+        def task(host):
+            output = six.StringIO()
+            with ExecutionContext(host='user@' + host, stdout=output):
+                with fab.settings(fab.hide('running'), custom=host):
+                    entered.release()
+                    proceed.wait(5)  # both threads are inside context
+                    fabricio.log('message', color=str)
+                    hosts[host] = fab.env.host, fab.env.custom
+            outputs[host] = output.getvalue()
+
+        threads = [
+            threading.Thread(target=task, args=(host, ))
+            for host in ('host1', 'host2')
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            entered.acquire()
+        proceed.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertDictEqual(
+            dict(host1=('host1', 'host1'), host2=('host2', 'host2')),
+            hosts,
+        )
+        self.assertDictEqual(
+            dict(
+                host1='[user@host1] message\n',
+                host2='[user@host2] message\n',
+            ),
+            outputs,
+        )
+        self.assertNotIn('custom', fab.env)
+        self.assertIsNone(fab.env.host_string)
+        self.assertTrue(state.output.running)
+        self.assertNotIsInstance(fab.env, _ContextDict)
+        self.assertIsNone(get_current_context())
+
+    def test_nested_context_inherits_settings_and_streams(self):
+        output = six.StringIO()
+        with ExecutionContext(stdout=output, custom='outer'):
+            with ExecutionContext(host='host'):
+                self.assertEqual('outer', fab.env.custom)
+                self.assertEqual('host', fab.env.host_string)
+                sys.stdout.write('inner')
+            self.assertIsNone(fab.env.host_string)
+        self.assertEqual('inner', output.getvalue())
+        self.assertNotIn('custom', fab.env)
+
+    def test_mute_threads(self):
+        output = six.StringIO()
+        original_stdout = sys.stdout
+        sys.stdout = output
+
+        def write():
+            sys.stdout.write('thread')
+
+        # thread serving SSH connection of the host (e.g. paramiko transport)
+        transport = threading.Thread(target=write)
+        connection = mock.Mock(**{'get_transport.return_value': transport})
+        dict.__setitem__(state.connections, 'user@host:22', connection)
+        try:
+            with ExecutionContext(
+                host='user@host',
+                mute_threads=True,
+                stdout=six.StringIO(),
+            ):
+                transport.start()
+                transport.join()
+                # threads of other hosts are not muted
+                thread = threading.Thread(target=write)
+                thread.start()
+                thread.join()
+            write()
+        finally:
+            sys.stdout = original_stdout
+            dict.__delitem__(state.connections, 'user@host:22')
+        self.assertEqual('threadthread', output.getvalue())
+
+    def test_run_output_written_by_other_thread(self):
+        def run(command, stdout=None, stderr=None, **kwargs):
+            # Fabric writes remote output from its own threads
+            def write():
+                (stdout or sys.stdout).write('out')
+                (stderr or sys.stderr).write('err')
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join()
+        stdout = six.StringIO()
+        stderr = six.StringIO()
+        with mock.patch.object(fab, 'run', run):
+            with ExecutionContext(stdout=stdout, stderr=stderr):
+                with fab.hide('user'):
+                    fabricio.run('command')
+        self.assertEqual('out', stdout.getvalue())
+        self.assertEqual('err', stderr.getvalue())
+
+    def test_log_to_custom_output(self):
+        output = six.StringIO()
+        fabricio.log('message', color=str, output=output)
+        self.assertEqual('message\n', output.getvalue())
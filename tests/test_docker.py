@@ -1,11 +1,23 @@
+import contextlib
+import json
+import os
+import shutil
+import socket
+import tarfile
+import tempfile
+import threading
+
 import mock
+import six
 import unittest2 as unittest
 
 import fabricio
 
 from fabricio import docker
+from fabricio.docker import registry
 from fabricio.docker.container import Option, Attribute
-from tests import SucceededResult
+from fabricio.utils import OrderedDict
+from tests import SucceededResult, FailedResult
 
 
 class TestContainer(docker.Container):
@@ -138,6 +150,68 @@ class ContainerTestCase(unittest.TestCase):
         container.null = 'value'
         self.assertEqual(container.options['null'], 'value')
 
+    def test_options_cache(self):
+
+        class Container(docker.Container):
+
+            counter = 0
+
+            @Option
+            def foo(self):
+                self.__class__.counter += 1
+                return self.counter
+
+        container = Container('name', options=dict(user='user', bar='bar'))
+
+        options = container.options
+        self.assertEqual('user', options['user'])
+        self.assertEqual('bar', options['bar'])
+        self.assertEqual(1, options['foo'])
+
+        # dynamic options are computed on each access
+        self.assertEqual(2, container.options['foo'])
+        self.assertEqual(3, container.safe_options['foo'])
+
+        # static options are invalidated on change
+        container.user = 'fabricio'
+        self.assertEqual('fabricio', container.options['user'])
+        self.assertEqual('fabricio', container.safe_options['user'])
+
+        # dynamic option overridden by the instance becomes static
+        container.foo = 'foo'
+        self.assertIs(container.options, container.options)
+        self.assertIs(container.safe_options, container.safe_options)
+        self.assertEqual('foo', container.options['foo'])
+
+        container.options = dict(baz='baz')
+        self.assertNotIn('bar', container.options)
+        self.assertEqual('baz', container.options['baz'])
+
+        container.ports = '80:80'
+        self.assertEqual('80:80', container.options['ports'])
+        self.assertIsNone(container.safe_options['ports'])
+
+    def test_options_cache_invalidated_by_class_attributes(self):
+
+        class Container(docker.Container):
+            ports = '80:80'
+
+        class ChildContainer(Container):
+            pass
+
+        container = Container('name')
+        child_container = ChildContainer('name')
+        self.assertEqual('80:80', container.options['ports'])
+        self.assertEqual('80:80', child_container.options['ports'])
+
+        Container.ports = '8080:80'
+        self.assertEqual('8080:80', container.options['ports'])
+        self.assertEqual('8080:80', child_container.options['ports'])
+        self.assertEqual('8080:80', container.fork().options['ports'])
+
+        Container.user = 'user'
+        self.assertEqual('user', container.safe_options['user'])
+
     def test_attributes_inheritance(self):
 
         class Container(docker.Container):
@@ -175,6 +249,31 @@ class ContainerTestCase(unittest.TestCase):
         container.null = 'value'
         self.assertEqual(container.null, 'value')
 
+    def test_fields_are_collected_once_per_class(self):
+
+        class Container(docker.Container):
+            foo = Option()
+            bar = Attribute()
+
+        class Child(Container):
+            pass
+
+        self.assertIs(Container.default_options, Container('name').default_options)
+        self.assertIn('foo', Child.default_options)
+        self.assertIn('bar', Child.attributes)
+        self.assertEqual('image', Child.image.field_names[Child])
+
+        # fields added after class creation
+        Container.baz = Option()
+        Container.qux = Attribute()
+        self.assertIn('baz', Child.default_options)
+        self.assertIn('qux', Child.attributes)
+        self.assertIn('baz', Child('name').options)
+
+        Child.image = image = docker.Image('image')
+        self.assertEqual('image', image.field_names[Child])
+        self.assertEqual('image', Child('name').image.name)
+
     def test_container_does_not_allow_modify_options(self):
         container = TestContainer('name')
 
@@ -357,7 +456,7 @@ class ContainerTestCase(unittest.TestCase):
                     name='name',
                 ),
                 class_kwargs=dict(image=docker.Image('image:tag')),
-                expected_command='docker run --name name --detach image:tag ',
+                expected_command='docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:tag ',
             ),
             complex=dict(
                 init_kwargs=dict(
@@ -391,6 +490,7 @@ class ContainerTestCase(unittest.TestCase):
                     '--name name '
                     '--detach '
                     '--custom_option foo '
+                    '--label fabricio.fingerprint=c417ab54f3897656350a1dbc5620c663c78335f987a62764bb0d53d992c30ed2 '
                     'image:tag cmd'
                 ),
             ),
@@ -793,6 +893,46 @@ class ContainerTestCase(unittest.TestCase):
                 update_kwargs=dict(),
                 excpected_result=False,
             ),
+            no_change_with_fingerprint=dict(
+                side_effect=(
+                    SucceededResult('[{"Image": "image_id", "Config": {"Labels": {"fabricio.fingerprint": "a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36"}}}]'),  # current container info
+                    SucceededResult('[{"Id": "image_id"}]'),  # new image info
+                    SucceededResult(),  # force starting container
+                ),
+                expected_commands=[
+                    mock.call('docker inspect --type container name'),
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('docker start name'),
+                ],
+                update_kwargs=dict(),
+                excpected_result=False,
+            ),
+            options_changed=dict(
+                side_effect=(
+                    SucceededResult('[{"Image": "image_id", "Config": {"Labels": {"fabricio.fingerprint": "old_fingerprint"}}}]'),  # current container info
+                    SucceededResult('[{"Id": "image_id"}]'),  # new image info
+                    SucceededResult('[{"Image": "image_id"}]'),  # obsolete container info
+                    SucceededResult(),  # delete obsolete container
+                    SucceededResult(),  # remove obsolete volumes
+                    SucceededResult(),  # delete obsolete container image
+                    SucceededResult(),  # rename current container
+                    SucceededResult(),  # stop current container
+                    SucceededResult('new_container_id'),  # run new container
+                ),
+                expected_commands=[
+                    mock.call('docker inspect --type container name'),
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('docker inspect --type container name_backup'),
+                    mock.call('docker rm name_backup'),
+                    mock.call('for volume in $(docker volume ls --filter "dangling=true" --quiet); do docker volume rm "$volume"; done'),
+                    mock.call('docker rmi image_id', ignore_errors=True),
+                    mock.call('docker rename name name_backup'),
+                    mock.call('docker stop --time 10 name_backup'),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:tag ', quiet=True),
+                ],
+                update_kwargs=dict(),
+                excpected_result=True,
+            ),
             no_change_with_tag=dict(
                 side_effect=(
                     SucceededResult('[{"Image": "image_id"}]'),  # current container info
@@ -824,7 +964,7 @@ class ContainerTestCase(unittest.TestCase):
                     mock.call('docker rmi image_id', ignore_errors=True),
                     mock.call('docker rename name name_backup'),
                     mock.call('docker stop --time 10 name_backup'),
-                    mock.call('docker run --name name --detach image:tag ', quiet=True),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:tag ', quiet=True),
                 ],
                 update_kwargs=dict(force=True),
                 excpected_result=True,
@@ -850,7 +990,7 @@ class ContainerTestCase(unittest.TestCase):
                     mock.call('docker rmi old_image_id', ignore_errors=True),
                     mock.call('docker rename name name_backup'),
                     mock.call('docker stop --time 10 name_backup'),
-                    mock.call('docker run --name name --detach image:tag ', quiet=True),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:tag ', quiet=True),
                 ],
                 update_kwargs=dict(),
                 excpected_result=True,
@@ -876,7 +1016,7 @@ class ContainerTestCase(unittest.TestCase):
                     mock.call('docker rmi old_image_id', ignore_errors=True),
                     mock.call('docker rename name name_backup'),
                     mock.call('docker stop --time 10 name_backup'),
-                    mock.call('docker run --name name --detach image:foo ', quiet=True),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:foo ', quiet=True),
                 ],
                 update_kwargs=dict(tag='foo'),
                 excpected_result=True,
@@ -902,7 +1042,7 @@ class ContainerTestCase(unittest.TestCase):
                     mock.call('docker rmi old_image_id', ignore_errors=True),
                     mock.call('docker rename name name_backup'),
                     mock.call('docker stop --time 10 name_backup'),
-                    mock.call('docker run --name name --detach registry/image:tag ', quiet=True),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 registry/image:tag ', quiet=True),
                 ],
                 update_kwargs=dict(registry='registry'),
                 excpected_result=True,
@@ -928,7 +1068,7 @@ class ContainerTestCase(unittest.TestCase):
                     mock.call('docker rmi old_image_id', ignore_errors=True),
                     mock.call('docker rename name name_backup'),
                     mock.call('docker stop --time 10 name_backup'),
-                    mock.call('docker run --name name --detach registry/image:foo ', quiet=True),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 registry/image:foo ', quiet=True),
                 ],
                 update_kwargs=dict(tag='foo', registry='registry'),
                 excpected_result=True,
@@ -948,7 +1088,7 @@ class ContainerTestCase(unittest.TestCase):
                     mock.call('docker inspect --type container name_backup'),
                     mock.call('docker rename name name_backup'),
                     mock.call('docker stop --time 10 name_backup'),
-                    mock.call('docker run --name name --detach image:tag ', quiet=True),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:tag ', quiet=True),
                 ],
                 update_kwargs=dict(),
                 excpected_result=True,
@@ -964,7 +1104,7 @@ class ContainerTestCase(unittest.TestCase):
                     mock.call('docker inspect --type container name_backup'),
                     mock.call('docker rename name name_backup'),
                     mock.call('docker stop --time 10 name_backup'),
-                    mock.call('docker run --name name --detach image:tag ', quiet=True),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:tag ', quiet=True),
                 ],
                 update_kwargs=dict(force=True),
                 excpected_result=True,
@@ -980,7 +1120,7 @@ class ContainerTestCase(unittest.TestCase):
                     mock.call('docker inspect --type container name'),
                     mock.call('docker inspect --type container name_backup'),
                     mock.call('docker rename name name_backup'),
-                    mock.call('docker run --name name --detach image:tag ', quiet=True),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:tag ', quiet=True),
                 ],
                 update_kwargs=dict(),
                 excpected_result=True,
@@ -1029,6 +1169,165 @@ class ContainerTestCase(unittest.TestCase):
             container.revert()
             self.assertListEqual(run.mock_calls, expected_commands)
 
+    def test_update_keeps_backup_generations(self):
+        side_effect = (
+            SucceededResult('[{"Image": "image_id"}]'),  # current container info
+            SucceededResult('[{"Id": "new_image_id"}]'),  # new image info
+            SucceededResult('[{"Image": "obsolete_image_id"}]'),  # obsolete container info
+            SucceededResult(),  # delete obsolete container
+            SucceededResult(),  # remove obsolete volumes
+            SucceededResult(),  # delete obsolete container image
+            SucceededResult(),  # rename second backup container
+            RuntimeError,  # first backup container not found
+            SucceededResult(),  # rename current container
+            SucceededResult(),  # stop current container
+            SucceededResult('new_container_id'),  # run new container
+        )
+        expected_commands = [
+            mock.call('docker inspect --type container name'),
+            mock.call('docker inspect --type image image:tag'),
+            mock.call('docker inspect --type container name_backup_3'),
+            mock.call('docker rm name_backup_3'),
+            mock.call('for volume in $(docker volume ls --filter "dangling=true" --quiet); do docker volume rm "$volume"; done'),
+            mock.call('docker rmi obsolete_image_id', ignore_errors=True),
+            mock.call('docker rename name_backup_2 name_backup_3'),
+            mock.call('docker rename name_backup name_backup_2'),
+            mock.call('docker rename name name_backup'),
+            mock.call('docker stop --time 10 name_backup'),
+            mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:tag ', quiet=True),
+        ]
+        container = TestContainer(name='name', backup_generations=3)
+        with mock.patch.object(fabricio, 'run', side_effect=side_effect) as run:
+            self.assertTrue(container.update())
+            self.assertListEqual(expected_commands, run.mock_calls)
+
+    def test_update_with_standby(self):
+        cases = dict(
+            standby_ready=dict(
+                side_effect=(
+                    SucceededResult('[{"Image": "image_id"}]'),  # current container info
+                    SucceededResult('[{"Id": "new_image_id"}]'),  # new image info
+                    SucceededResult('[{"Image": "new_image_id", "Config": {"Labels": {"fabricio.fingerprint": "a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36"}}}]'),  # standby container info
+                    SucceededResult('[{"Id": "new_image_id"}]'),  # new image info
+                    RuntimeError,  # obsolete container not found
+                    SucceededResult(),  # rename current container
+                    SucceededResult(),  # stop current container
+                    SucceededResult(),  # rename standby container
+                    SucceededResult(),  # start standby container
+                ),
+                expected_commands=[
+                    mock.call('docker inspect --type container name'),
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('docker inspect --type container name_standby'),
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('docker inspect --type container name_backup'),
+                    mock.call('docker rename name name_backup'),
+                    mock.call('docker stop --time 10 name_backup'),
+                    mock.call('docker rename name_standby name'),
+                    mock.call('docker start name'),
+                ],
+                expected_result=True,
+            ),
+            standby_outdated=dict(
+                side_effect=(
+                    SucceededResult('[{"Image": "image_id"}]'),  # current container info
+                    SucceededResult('[{"Id": "new_image_id"}]'),  # new image info
+                    SucceededResult('[{"Image": "new_image_id", "Config": {"Labels": {"fabricio.fingerprint": "old_fingerprint"}}}]'),  # standby container info
+                    SucceededResult('[{"Id": "new_image_id"}]'),  # new image info
+                    SucceededResult(),  # delete standby container
+                    SucceededResult(),  # remove dangling volumes
+                    RuntimeError,  # obsolete container not found
+                    SucceededResult(),  # rename current container
+                    SucceededResult(),  # stop current container
+                    SucceededResult('new_container_id'),  # run new container
+                ),
+                expected_commands=[
+                    mock.call('docker inspect --type container name'),
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('docker inspect --type container name_standby'),
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('docker rm name_standby'),
+                    mock.call('for volume in $(docker volume ls --filter "dangling=true" --quiet); do docker volume rm "$volume"; done'),
+                    mock.call('docker inspect --type container name_backup'),
+                    mock.call('docker rename name name_backup'),
+                    mock.call('docker stop --time 10 name_backup'),
+                    mock.call('docker run --name name --detach --label fabricio.fingerprint=a92aaa26d5ed4aeb35951de20ab522ce8da6277828a09431f4e5476486482e36 image:tag ', quiet=True),
+                ],
+                expected_result=True,
+            ),
+            no_change=dict(
+                side_effect=(
+                    SucceededResult('[{"Image": "image_id"}]'),  # current container info
+                    SucceededResult('[{"Id": "image_id"}]'),  # new image info
+                    SucceededResult(),  # force starting container
+                    SucceededResult(),  # delete standby container
+                    SucceededResult(),  # remove dangling volumes
+                ),
+                expected_commands=[
+                    mock.call('docker inspect --type container name'),
+                    mock.call('docker inspect --type image image:tag'),
+                    mock.call('docker start name'),
+                    mock.call('docker rm name_standby'),
+                    mock.call('for volume in $(docker volume ls --filter "dangling=true" --quiet); do docker volume rm "$volume"; done'),
+                ],
+                expected_result=False,
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                container = TestContainer(name='name', use_standby=True)
+                with mock.patch.object(fabricio, 'run', side_effect=data['side_effect']) as run:
+                    self.assertEqual(data['expected_result'], container.update())
+                    self.assertListEqual(data['expected_commands'], run.mock_calls)
+
+    def test_create_standby_container(self):
+        container = TestContainer(name='name', options=dict(ports='80:80'))
+        with mock.patch.object(fabricio, 'run', side_effect=(RuntimeError, SucceededResult('id'))) as run:
+            container.create_standby_container(tag='foo')
+            self.assertListEqual(
+                [
+                    mock.call('docker rm name_standby'),
+                    mock.call('docker create --publish 80:80 --name name_standby --label fabricio.fingerprint=%s image:foo ' % container.fingerprint),
+                ],
+                run.mock_calls,
+            )
+
+    def test_revert_to_older_generation(self):
+        side_effect = (
+            SucceededResult('[{"Image": "backup_image_id"}]'),  # backup container info
+            SucceededResult(),  # stop current container
+            SucceededResult(),  # start backup container
+            SucceededResult('[{"Image": "failed_image_id"}]'),  # current container info
+            SucceededResult(),  # delete current container
+            SucceededResult(),  # delete dangling volumes
+            SucceededResult(),  # delete current container image
+            SucceededResult(),  # rename backup container
+            SucceededResult('[{"Image": "newer_image_id"}]'),  # newer backup container info
+            SucceededResult(),  # delete newer backup container
+            SucceededResult(),  # delete dangling volumes
+            SucceededResult(),  # delete newer backup container image
+            SucceededResult(),  # rename older backup container
+        )
+        expected_commands = [
+            mock.call('docker inspect --type container name_backup_2'),
+            mock.call('docker stop --time 10 name'),
+            mock.call('docker start name_backup_2'),
+            mock.call('docker inspect --type container name'),
+            mock.call('docker rm name'),
+            mock.call('for volume in $(docker volume ls --filter "dangling=true" --quiet); do docker volume rm "$volume"; done'),
+            mock.call('docker rmi failed_image_id', ignore_errors=True),
+            mock.call('docker rename name_backup_2 name'),
+            mock.call('docker inspect --type container name_backup'),
+            mock.call('docker rm name_backup'),
+            mock.call('for volume in $(docker volume ls --filter "dangling=true" --quiet); do docker volume rm "$volume"; done'),
+            mock.call('docker rmi newer_image_id', ignore_errors=True),
+            mock.call('docker rename name_backup_3 name_backup'),
+        ]
+        container = TestContainer(name='name', backup_generations=3)
+        with mock.patch.object(fabricio, 'run', side_effect=side_effect) as run:
+            container.revert(generation=2)
+            self.assertListEqual(expected_commands, run.mock_calls)
+
     @mock.patch.object(fabricio, 'run', side_effect=RuntimeError)
     def test_revert_raises_error_if_backup_container_not_found(self, *args):
         container = docker.Container(name='name')
@@ -1039,6 +1338,93 @@ class ContainerTestCase(unittest.TestCase):
             "Container 'name_backup' not found",
         )
 
+    def test_fingerprint(self):
+        container = docker.Container(name='name', options=dict(env='FOO=foo'))
+        self.assertEqual(
+            container.fingerprint,
+            docker.Container(name='name', options=dict(env='FOO=foo')).fingerprint,
+        )
+        self.assertNotEqual(
+            container.fingerprint,
+            container.fork(options=dict(env='FOO=bar')).fingerprint,
+        )
+        self.assertNotEqual(
+            container.fingerprint,
+            container.fork(cmd='cmd').fingerprint,
+        )
+        self.assertEqual(
+            container.fork(options=dict(foo=set(['b', 'a']))).fingerprint,
+            container.fork(options=dict(foo=['a', 'b'])).fingerprint,
+        )
+        with self.assertRaises(TypeError):
+            container.fork(options=dict(foo=object())).fingerprint
+
+    def test_run_keeps_custom_labels(self):
+        cases = dict(
+            string=dict(label='foo=foo'),
+            list=dict(label=['foo=foo', 'bar=bar']),
+            mapping=dict(label=OrderedDict([('foo', 'foo')])),
+        )
+        for case, options in cases.items():
+            with self.subTest(case=case):
+                container = docker.Container(name='name', options=options)
+                labels = container.run_options['label']
+                fingerprint = container.fingerprint
+                if isinstance(labels, dict):
+                    self.assertDictEqual(
+                        {'foo': 'foo', 'fabricio.fingerprint': fingerprint},
+                        labels,
+                    )
+                else:
+                    self.assertEqual(
+                        'fabricio.fingerprint=' + fingerprint,
+                        labels[-1],
+                    )
+                    self.assertEqual('foo=foo', labels[0])
+
+    def test_is_up_to_date(self):
+        container = docker.Container(name='name')
+        fingerprint = container.fingerprint
+        cases = dict(
+            up_to_date=dict(
+                state=SucceededResult('image_id true ' + fingerprint),
+                expected_result=True,
+            ),
+            without_label=dict(
+                state=SucceededResult('image_id true <no value>'),
+                expected_result=True,
+            ),
+            options_changed=dict(
+                state=SucceededResult('image_id true fingerprint'),
+                expected_result=False,
+            ),
+            image_changed=dict(
+                state=SucceededResult('old_image_id true ' + fingerprint),
+                expected_result=False,
+            ),
+            stopped=dict(
+                state=SucceededResult('image_id false ' + fingerprint),
+                expected_result=False,
+            ),
+            not_found=dict(
+                state=FailedResult(),
+                expected_result=False,
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(fabricio, 'run', return_value=data['state']) as run:
+                    self.assertEqual(
+                        data['expected_result'],
+                        container.is_up_to_date('image_id'),
+                    )
+                    run.assert_called_once_with(
+                        'docker inspect --type container --format '
+                        '\'{{.Image}} {{.State.Running}} '
+                        '{{index .Config.Labels "fabricio.fingerprint"}}\' name',
+                        ignore_errors=True,
+                    )
+
 
 class ImageTestCase(unittest.TestCase):
 
@@ -1175,6 +1561,74 @@ class ImageTestCase(unittest.TestCase):
                 expected_registry='registry:123',
                 expected_str='registry:123/image:tag',
             ),
+            single_arg_with_localhost_registry=dict(
+                init_kwargs=dict(
+                    name='localhost/user/image:tag',
+                ),
+                expected_name='user/image',
+                expected_tag='tag',
+                expected_registry='localhost',
+                expected_str='localhost/user/image:tag',
+            ),
+            single_arg_with_default_registry=dict(
+                init_kwargs=dict(
+                    name='docker.io/user/image:tag',
+                ),
+                expected_name='user/image',
+                expected_tag='tag',
+                expected_registry=None,
+                expected_str='user/image:tag',
+            ),
+            single_arg_with_user=dict(
+                init_kwargs=dict(
+                    name='user/image:tag',
+                ),
+                expected_name='user/image',
+                expected_tag='tag',
+                expected_registry=None,
+                expected_str='user/image:tag',
+            ),
+            single_arg_with_digest=dict(
+                init_kwargs=dict(
+                    name='registry:123/user/image@sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+                ),
+                expected_name='user/image',
+                expected_tag='latest',
+                expected_registry='registry:123',
+                expected_digest='sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+                expected_str='registry:123/user/image@sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+            ),
+            single_arg_with_tag_and_digest=dict(
+                init_kwargs=dict(
+                    name='image:tag@sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+                ),
+                expected_name='image',
+                expected_tag='tag',
+                expected_registry=None,
+                expected_digest='sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+                expected_str='image@sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+            ),
+            with_digest=dict(
+                init_kwargs=dict(
+                    name='image',
+                    digest='sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+                ),
+                expected_name='image',
+                expected_tag='latest',
+                expected_registry=None,
+                expected_digest='sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+                expected_str='image@sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+            ),
+            forced_tag_resets_digest=dict(
+                init_kwargs=dict(
+                    name='image@sha256:aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+                    tag='foo',
+                ),
+                expected_name='image',
+                expected_tag='foo',
+                expected_registry=None,
+                expected_str='image:foo',
+            ),
             forced_with_tag=dict(
                 init_kwargs=dict(
                     name='image:tag',
@@ -1213,8 +1667,92 @@ class ImageTestCase(unittest.TestCase):
                 self.assertEqual(data['expected_name'], image.name)
                 self.assertEqual(data['expected_tag'], image.tag)
                 self.assertEqual(data['expected_registry'], image.registry)
+                self.assertEqual(data.get('expected_digest'), image.digest)
                 self.assertEqual(data['expected_str'], str(image))
 
+    def test_parse_image_reference(self):
+        cases = dict(
+            name=dict(
+                reference='image',
+                expected=('', 'image', None, None),
+            ),
+            user_and_name_and_tag=dict(
+                reference='user/image:tag',
+                expected=('', 'user/image', 'tag', None),
+            ),
+            registry_without_port=dict(
+                reference='registry.local/image',
+                expected=('registry.local', 'image', None, None),
+            ),
+            localhost_with_port=dict(
+                reference='localhost:5000/image:tag',
+                expected=('localhost:5000', 'image', 'tag', None),
+            ),
+            default_registry=dict(
+                reference='index.docker.io/library/image',
+                expected=('', 'library/image', None, None),
+            ),
+            digest=dict(
+                reference='host:5000/user/image:tag@sha256:0123abcd',
+                expected=('host:5000', 'user/image', 'tag', 'sha256:0123abcd'),
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                reference = docker.ImageReference.parse(data['reference'])
+                self.assertTupleEqual(data['expected'], reference)
+                self.assertEqual(data['reference'].replace(
+                    'index.docker.io/', '',
+                ), str(reference))
+                self.assertIs(
+                    reference,
+                    docker.ImageReference.parse(data['reference']),
+                )
+
+    def test_parse_image_reference_raises_error_if_invalid(self):
+        cases = dict(
+            scheme='http://registry/image',
+            empty_tag='image:',
+            bad_digest='image@sha256',
+            hyphen='-registry:5000/image',
+        )
+        for case, reference in cases.items():
+            with self.subTest(case=case):
+                with self.assertRaises(ValueError):
+                    docker.ImageReference.parse(reference)
+
+    @mock.patch.object(docker.ImageReference, 'cache_size', 2)
+    @mock.patch.object(docker.ImageReference, 'cache', OrderedDict())
+    def test_parse_image_reference_cache_is_limited(self):
+        first = docker.ImageReference.parse('first')
+        docker.ImageReference.parse('second')
+        self.assertIs(first, docker.ImageReference.parse('first'))
+        docker.ImageReference.parse('third')  # 'second' is pushed out
+        self.assertListEqual(
+            ['first', 'third'],
+            list(docker.ImageReference.cache),
+        )
+
+    @mock.patch.object(docker.ImageReference, 'cache_size', 16)
+    @mock.patch.object(docker.ImageReference, 'cache', OrderedDict())
+    def test_parse_image_reference_by_many_threads(self):
+        errors = []
+
+        def parse():
+            try:
+                for i in range(2000):
+                    docker.ImageReference.parse('image:{0}'.format(i % 32))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=parse) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertListEqual([], errors)
+        self.assertEqual(16, len(docker.ImageReference.cache))
+
     def test_getitem(self):
         cases = dict(
             none=dict(
@@ -1269,6 +1807,13 @@ class ImageTestCase(unittest.TestCase):
                 self.assertEqual(data['expected_tag'], new_image.tag)
                 self.assertEqual(data['expected_registry'], new_image.registry)
 
+    def test_getitem_keeps_digest_unless_tag_changed(self):
+        image = docker.Image(name='name@sha256:0123abcd')
+        self.assertEqual('sha256:0123abcd', image['registry':].digest)
+        self.assertEqual('registry/name@sha256:0123abcd', str(image['registry':]))
+        self.assertIsNone(image['tag'].digest)
+        self.assertEqual('name:tag', str(image['tag']))
+
     def test_run(self):
         image = docker.Image('image')
         cases = dict(
@@ -1311,6 +1856,83 @@ class ImageTestCase(unittest.TestCase):
                     image.run(**data['kwargs'])
                     run.assert_called_once_with(data['expected_command'], quiet=True)
 
+    def test_session(self):
+        cases = dict(
+            unused=dict(
+                commands=[],
+                side_effect=(),
+                expected_commands=[],
+            ),
+            single_command=dict(
+                commands=['cmd'],
+                side_effect=(
+                    SucceededResult('container_id'),
+                    SucceededResult('result'),
+                    SucceededResult(),
+                ),
+                expected_commands=[
+                    mock.call('docker run --interactive --detach --entrypoint cat image:latest'),
+                    mock.call('docker exec --tty --interactive container_id cmd', quiet=True),
+                    mock.call('docker rm --force container_id', ignore_errors=True),
+                ],
+            ),
+            several_commands=dict(
+                commands=['cmd1', 'cmd2'],
+                side_effect=(
+                    SucceededResult('container_id'),
+                    SucceededResult('result'),
+                    SucceededResult('result'),
+                    SucceededResult(),
+                ),
+                expected_commands=[
+                    mock.call('docker run --interactive --detach --entrypoint cat image:latest'),
+                    mock.call('docker exec --tty --interactive container_id cmd1', quiet=True),
+                    mock.call('docker exec --tty --interactive container_id cmd2', quiet=True),
+                    mock.call('docker rm --force container_id', ignore_errors=True),
+                ],
+            ),
+            with_options=dict(
+                commands=['cmd'],
+                options=dict(user='user', restart_policy='always', foo='bar'),
+                side_effect=(
+                    SucceededResult('container_id'),
+                    SucceededResult('result'),
+                    SucceededResult(),
+                ),
+                expected_commands=[
+                    mock.call('docker run --user user --interactive --detach --foo bar --entrypoint cat image:latest'),
+                    mock.call('docker exec --tty --interactive container_id cmd', quiet=True),
+                    mock.call('docker rm --force container_id', ignore_errors=True),
+                ],
+            ),
+            image_entrypoint_overridden=dict(
+                commands=['cmd'],
+                options=dict(entrypoint='gunicorn'),
+                side_effect=(
+                    SucceededResult('container_id'),
+                    SucceededResult('result'),
+                    SucceededResult(),
+                ),
+                expected_commands=[
+                    mock.call('docker run --interactive --detach --entrypoint cat image:latest'),
+                    mock.call('docker exec --tty --interactive container_id cmd', quiet=True),
+                    mock.call('docker rm --force container_id', ignore_errors=True),
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(
+                    fabricio,
+                    'run',
+                    side_effect=data['side_effect'],
+                ) as run:
+                    image = docker.Image('image')
+                    with image.session(options=data.get('options', {})) as session:
+                        for command in data['commands']:
+                            self.assertEqual('result', session.run(command))
+                    self.assertListEqual(run.mock_calls, data['expected_commands'])
+
     def test_image_as_descriptor(self):
         class Container(docker.Container):
             info = dict(Image='image_id')
@@ -1414,3 +2036,226 @@ class ImageTestCase(unittest.TestCase):
         container = Container('name')
         with self.assertRaises(ValueError):
             _ = container.image
+
+
+class BuildContextTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.build_path = tempfile.mkdtemp()
+        self.make_files(
+            'Dockerfile',
+            'app.py',
+            'app.pyc',
+            'README.md',
+            'src/module.py',
+            'src/module.pyc',
+            'docs/index.md',
+            'docs/keep.md',
+            '.git/HEAD',
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.build_path)
+
+    def make_files(self, *paths, **kwargs):
+        for path in paths:
+            full_path = os.path.join(self.build_path, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, 'w') as context_file:
+                context_file.write(kwargs.get('content', path))
+
+    def test_files(self):
+        cases = dict(
+            no_dockerignore=dict(
+                dockerignore=None,
+                expected_files=[
+                    '.git/HEAD',
+                    'Dockerfile',
+                    'README.md',
+                    'app.py',
+                    'app.pyc',
+                    'docs/index.md',
+                    'docs/keep.md',
+                    'src/module.py',
+                    'src/module.pyc',
+                ],
+            ),
+            patterns=dict(
+                dockerignore='# comment\n.git\n*.pyc\n\ndocs/\n',
+                expected_files=[
+                    '.dockerignore',
+                    'Dockerfile',
+                    'README.md',
+                    'app.py',
+                    'src/module.py',
+                    'src/module.pyc',
+                ],
+            ),
+            recursive_pattern_and_exception=dict(
+                dockerignore='**/*.pyc\n*.md\ndocs\n!docs/keep.md\n.git',
+                expected_files=[
+                    '.dockerignore',
+                    'Dockerfile',
+                    'app.py',
+                    'docs/keep.md',
+                    'src/module.py',
+                ],
+            ),
+            dockerfile_is_always_included=dict(
+                dockerignore='*\n!app.py',
+                expected_files=['Dockerfile', 'app.py'],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                dockerignore = os.path.join(self.build_path, '.dockerignore')
+                if data['dockerignore'] is not None:
+                    with open(dockerignore, 'w') as dockerignore_file:
+                        dockerignore_file.write(data['dockerignore'])
+                elif os.path.exists(dockerignore):
+                    os.remove(dockerignore)
+                context = docker.BuildContext(self.build_path)
+                self.assertListEqual(data['expected_files'], context.files())
+
+    def test_fingerprint(self):
+        with open(os.path.join(self.build_path, '.dockerignore'), 'w') as f:
+            f.write('*.pyc\n')
+        context = docker.BuildContext(self.build_path)
+        fingerprint = context.fingerprint()
+        self.assertEqual(fingerprint, context.fingerprint())
+        self.make_files('app.pyc', content='changed')
+        self.assertEqual(fingerprint, context.fingerprint())
+        self.assertNotEqual(fingerprint, context.fingerprint('build_arg'))
+        self.make_files('app.py', content='changed')
+        self.assertNotEqual(fingerprint, context.fingerprint())
+
+
+class ImageArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.temp_dir, 'image.tar')
+        files = [
+            ('manifest.json', json.dumps([
+                dict(Config='config.json', Layers=['a/layer.tar', 'b/layer.tar', 'c/layer.tar']),
+            ])),
+            ('config.json', json.dumps(dict(
+                rootfs=dict(diff_ids=['sha256:a', 'sha256:b', 'sha256:c']),
+            ))),
+            ('a/layer.tar', 'layer a'),
+            ('b/layer.tar', 'layer b'),
+            ('c/layer.tar', 'layer c'),
+        ]
+        with contextlib.closing(tarfile.open(self.archive_path, 'w')) as archive:
+            for name, content in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, six.BytesIO(content.encode()))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_make_delta(self):
+        cases = dict(
+            new_host=dict(
+                chains=[],
+                expected_layers=['a/layer.tar', 'b/layer.tar', 'c/layer.tar'],
+                expected_skipped_size=0,
+            ),
+            base_layers_found=dict(
+                chains=[['sha256:a', 'sha256:b', 'sha256:x']],
+                expected_layers=['c/layer.tar'],
+                expected_skipped_size=14,
+            ),
+            all_layers_found=dict(
+                chains=[['sha256:x'], ['sha256:a', 'sha256:b', 'sha256:c']],
+                expected_layers=[],
+                expected_skipped_size=21,
+            ),
+            same_layer_with_other_parents=dict(
+                chains=[['sha256:x', 'sha256:b', 'sha256:c']],
+                expected_layers=['a/layer.tar', 'b/layer.tar', 'c/layer.tar'],
+                expected_skipped_size=0,
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                delta_path = os.path.join(self.temp_dir, 'delta.tar.gz')
+                archive = docker.ImageArchive(self.archive_path)
+                skipped_size = archive.make_delta(delta_path, chains=data['chains'])
+                self.assertEqual(data['expected_skipped_size'], skipped_size)
+                with contextlib.closing(tarfile.open(delta_path)) as delta:
+                    names = delta.getnames()
+                self.assertListEqual(
+                    ['manifest.json', 'config.json'] + data['expected_layers'],
+                    names,
+                )
+
+
+class LocalRegistryTestCase(unittest.TestCase):
+
+    def test_start_and_stop(self):
+        inspect = mock.call("docker inspect --type container --format '{{.State.Running}}' fabricio_registry", capture=True, ignore_errors=True)
+        stop = mock.call('docker stop fabricio_registry', ignore_errors=True)
+        cases = dict(
+            running=dict(
+                side_effect=[SucceededResult('true')],
+                expected_calls=[inspect],
+                expected_ready_checks=0,
+            ),
+            stopped=dict(
+                side_effect=[SucceededResult('false'), SucceededResult(), SucceededResult()],
+                expected_calls=[
+                    inspect,
+                    mock.call('docker start fabricio_registry'),
+                    stop,
+                ],
+            ),
+            not_exists=dict(
+                side_effect=[FailedResult(), SucceededResult(), SucceededResult()],
+                expected_calls=[
+                    inspect,
+                    mock.call('docker run --name fabricio_registry --publish 127.0.0.1:5000:5000 --volume fabricio_registry:/var/lib/registry --detach registry:2'),
+                    stop,
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(fabricio, 'local', side_effect=data['side_effect']) as local:
+                    with mock.patch('atexit.register'):
+                        with mock.patch.object(registry.http_client, 'HTTPConnection') as connection:
+                            local_registry = docker.LocalRegistry()
+                            with local_registry:
+                                local_registry.start()  # started only once
+                            local_registry.stop()
+                    self.assertListEqual(data['expected_calls'], local.mock_calls)
+                    self.assertEqual('localhost:5000', local_registry.registry)
+                    self.assertEqual(data.get('expected_ready_checks', 1), connection.call_count)
+
+    @mock.patch.object(registry.LocalRegistry, 'poll_interval', 0)
+    def test_wait_ready(self):
+        local_registry = docker.LocalRegistry(port=1234)
+        connection = mock.Mock()
+        connection.request.side_effect = [
+            socket.error('connection refused'),
+            registry.http_client.BadStatusLine('connection reset'),
+            None,
+        ]
+        with mock.patch.object(registry.http_client, 'HTTPConnection', return_value=connection) as connection_class:
+            local_registry.wait_ready()
+        self.assertEqual(3, connection_class.call_count)
+        connection_class.assert_called_with('127.0.0.1', 1234, timeout=0)
+        connection.request.assert_called_with('GET', '/v2/')
+        self.assertEqual(1, connection.getresponse.call_count)
+        self.assertEqual(3, connection.close.call_count)
+
+    @mock.patch.object(registry.LocalRegistry, 'poll_interval', 0)
+    def test_wait_ready_timeout(self):
+        local_registry = docker.LocalRegistry(timeout=0)
+        connection = mock.Mock()
+        connection.request.side_effect = socket.error('connection refused')
+        with mock.patch.object(registry.http_client, 'HTTPConnection', return_value=connection):
+            with self.assertRaises(RuntimeError):
+                local_registry.wait_ready()
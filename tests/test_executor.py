@@ -0,0 +1,38 @@
+import threading
+
+import unittest2 as unittest
+
+from fabric import api as fab
+
+from fabricio.executor import ThreadedExecutor
+
+
+class ThreadedExecutorTestCase(unittest.TestCase):
+
+    def test_execute(self):
+        threads = set()
+
+        def task(suffix):
+            threads.add(threading.current_thread())
+            if fab.env.host == 'host2':
+                raise RuntimeError('error')
+            self.assertTrue(fab.env.abort_on_prompts)
+            self.assertEqual(5, fab.env.command_timeout)
+            return fab.env.host_string + suffix
+
+        hosts = ['user@host{0}'.format(index) for index in range(1, 6)]
+        results = ThreadedExecutor(workers=2, timeout=5).execute(
+            task,
+            hosts,
+            suffix='!',
+        )
+        self.assertListEqual(hosts, list(results))
+        self.assertEqual('user@host1!', results['user@host1'])
+        self.assertIsInstance(results['user@host2'], RuntimeError)
+        self.assertEqual('user@host5!', results['user@host5'])
+        self.assertLessEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertIsNone(fab.env.command_timeout)
+
+    def test_execute_without_hosts(self):
+        self.assertDictEqual({}, ThreadedExecutor().execute(lambda: 1, []))
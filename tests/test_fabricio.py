@@ -1,3 +1,8 @@
+import json
+import os
+import subprocess
+import sys
+
 import mock
 import unittest2 as unittest
 
@@ -88,3 +93,50 @@ class FabricioTestCase(unittest.TestCase):
         fabricio.run('command', ignore_errors=True, use_cache=True)
         self.assertEqual(2, run.call_count)
         run.reset_mock()
+
+
+class ImportTestCase(unittest.TestCase):
+
+    heavy_modules = (
+        'docker',
+        'requests',
+        'websocket',
+    )
+
+    # generous default, tests may run on loaded machines
+    import_time_limit = float(
+        os.environ.get('FABRICIO_TEST_IMPORT_TIME_LIMIT', 5),
+    )
+
+    def test_heavy_modules_are_not_imported_on_startup(self):
+        # `fab` itself loads fabric.main (and fabric.contrib with it) before
+        # fabfile, so only modules added by fabricio are taken into account
+        script = (
+            'import json, sys, time\n'
+            'import fabric.main\n'
+            'modules = set(sys.modules)\n'
+            'started = time.time()\n'
+            'import fabricio.tasks, fabricio.apps.db.postgres\n'
+            'import fabricio.apps.python.django\n'
+            'print(json.dumps(dict(\n'
+            '    modules=sorted(set(sys.modules) - modules),\n'
+            '    time=time.time() - started,\n'
+            ')))\n'
+        )
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen(
+            [sys.executable, '-W', 'ignore', '-c', script],
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        output = process.communicate()[0]
+        self.assertEqual(0, process.returncode)
+        result = json.loads(output.decode().splitlines()[-1])
+        for module in result['modules']:
+            with self.subTest(module=module):
+                self.assertNotIn(module.split('.')[0], self.heavy_modules)
+        self.assertLess(
+            result['time'],
+            self.import_time_limit,
+            'import took {time:.3f}s'.format(time=result['time']),
+        )
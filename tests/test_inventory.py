@@ -0,0 +1,220 @@
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+import unittest2 as unittest
+
+from fabric import api as fab
+
+import fabricio
+
+from fabricio import tasks
+from fabricio.inventory import Inventory
+from tests import SucceededResult
+
+hosts_data = dict(
+    hosts=[
+        dict(host='host1', roles=['web', 'db'], region='eu', tags=['a']),
+        dict(host='host2', roles=['web'], region='us', infrastructure='prod'),
+        dict(host='host3', roles='web, db', region='eu', tags='a, b'),
+        dict(host='host4', region='eu'),
+    ],
+)
+
+ini_data = """
+[host1]
+roles = web, db
+region = eu
+tags = a
+
+[host2]
+roles = web
+region = us
+infrastructure = prod
+
+[host3]
+roles = web,db
+region = eu
+tags = a,b
+
+[host4]
+region = eu
+"""
+
+
+class InventoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        Inventory.cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        Inventory.cache.clear()
+
+    def make_inventory(self, file_name, data):
+        path = os.path.join(self.temp_dir, file_name)
+        with open(path, 'w') as inventory_file:
+            inventory_file.write(data)
+        return path
+
+    def test_select(self):
+        cases = dict(
+            all=dict(
+                criteria=dict(),
+                expected_hosts=['host1', 'host2', 'host3', 'host4'],
+            ),
+            by_role=dict(
+                criteria=dict(role='db'),
+                expected_hosts=['host1', 'host3'],
+            ),
+            by_tag=dict(
+                criteria=dict(tag='b'),
+                expected_hosts=['host3'],
+            ),
+            by_region=dict(
+                criteria=dict(region='eu'),
+                expected_hosts=['host1', 'host3', 'host4'],
+            ),
+            by_infrastructure=dict(
+                criteria=dict(infrastructure='prod'),
+                expected_hosts=['host2'],
+            ),
+            by_role_and_region=dict(
+                criteria=dict(role='web', region='eu'),
+                expected_hosts=['host1', 'host3'],
+            ),
+            by_role_and_tag_and_region=dict(
+                criteria=dict(role='db', tag='a', region='eu'),
+                expected_hosts=['host1', 'host3'],
+            ),
+            nothing_found=dict(
+                criteria=dict(role='db', region='us'),
+                expected_hosts=[],
+            ),
+            unknown_value=dict(
+                criteria=dict(role='unknown'),
+                expected_hosts=[],
+            ),
+        )
+        inventories = dict(
+            json=self.make_inventory('hosts.json', json.dumps(hosts_data)),
+            ini=self.make_inventory('hosts.ini', ini_data),
+        )
+        for case, data in cases.items():
+            for inventory_type, path in inventories.items():
+                with self.subTest(case=case, inventory_type=inventory_type):
+                    inventory = Inventory(path)
+                    selection = inventory.select(**data['criteria'])
+                    self.assertListEqual(
+                        data['expected_hosts'],
+                        list(selection),
+                    )
+                    self.assertListEqual(data['expected_hosts'], selection())
+
+    def test_json_mapping(self):
+        path = self.make_inventory('hosts.json', json.dumps({
+            'host1': {'roles': ['web']},
+            'host2': None,
+        }))
+        inventory = Inventory(path)
+        self.assertEqual(2, len(inventory))
+        self.assertIn('host2', inventory)
+        self.assertListEqual(['host1'], list(inventory.select(role='web')))
+        self.assertEqual(('web', ), inventory['host1']['roles'])
+
+    def test_multiple_regions_and_infrastructures(self):
+        path = self.make_inventory('hosts.json', json.dumps([
+            dict(host='host1', region=['eu', 'us'], infrastructure='prod'),
+            dict(host='host2', region='us', infrastructure=['prod', 'test']),
+            dict(host='host3', region=1),
+        ]))
+        inventory = Inventory(path)
+        self.assertListEqual(
+            ['host1', 'host2'],
+            list(inventory.select(region='us')),
+        )
+        self.assertListEqual(['host1'], list(inventory.select(region='eu')))
+        self.assertListEqual(
+            ['host2'],
+            list(inventory.select(infrastructure='test')),
+        )
+        self.assertListEqual(
+            ['host1', 'host2'],
+            list(inventory.select(region='us', infrastructure='prod')),
+        )
+        self.assertListEqual(['host3'], list(inventory.select(region='1')))
+
+    def test_executable(self):
+        path = os.path.join(self.temp_dir, 'inventory')
+        with open(path, 'w') as inventory_file:
+            inventory_file.write('#!/bin/sh\n')
+        os.chmod(path, 0o755)
+        with mock.patch.object(
+            fabricio,
+            'local',
+            return_value=SucceededResult(json.dumps(hosts_data)),
+        ) as local:
+            inventory = Inventory(path)
+            self.assertListEqual(
+                ['host1', 'host3'],
+                list(inventory.select(role='db')),
+            )
+            self.assertListEqual(['host2'], list(inventory.select(region='us')))
+            local.assert_called_once_with(path, capture=True)
+
+    def test_unknown_format(self):
+        path = self.make_inventory('hosts.txt', '')
+        with self.assertRaises(ValueError):
+            list(Inventory(path))
+
+    def test_unknown_selector(self):
+        path = self.make_inventory('hosts.json', json.dumps(hosts_data))
+        with self.assertRaises(TypeError):
+            Inventory(path).get_hosts(unknown='value')
+
+    def test_reload_on_change(self):
+        path = self.make_inventory('hosts.json', json.dumps(hosts_data))
+        inventory = Inventory(path)
+        selection = inventory.select(role='db')
+        self.assertListEqual(['host1', 'host3'], list(selection))
+        with mock.patch('json.load') as json_load:
+            self.assertListEqual(['host1', 'host3'], list(selection))
+            json_load.assert_not_called()
+        self.make_inventory('hosts.json', json.dumps(['host5']))
+        mtime = os.path.getmtime(path) + 1
+        os.utime(path, (mtime, mtime))
+        self.assertListEqual([], list(selection))
+        self.assertListEqual(['host5'], list(inventory))
+
+    def test_roledefs(self):
+        path = self.make_inventory('hosts.json', json.dumps(hosts_data))
+        roledefs = Inventory(path).roledefs(region='eu')
+        self.assertSetEqual(set(['web', 'db']), set(roledefs))
+        self.assertListEqual(['host1', 'host3'], roledefs['web']())
+        self.assertListEqual(['host1', 'host3'], roledefs['db']())
+
+    def test_as_tasks_hosts_and_roles(self):
+        class TestTasks(tasks.Tasks):
+
+            @fab.task
+            def task(self):
+                pass
+
+        path = self.make_inventory('hosts.json', json.dumps(hosts_data))
+        inventory = Inventory(path)
+        test_tasks = TestTasks(hosts=inventory.select(region='us'))
+        self.assertListEqual(
+            ['host2'],
+            test_tasks.task.get_hosts_and_effective_roles([], [], [])[0],
+        )
+        with fab.settings(roledefs=inventory.roledefs()):
+            test_tasks = TestTasks(roles=['db'])
+            self.assertListEqual(
+                ['host1', 'host3'],
+                test_tasks.task.get_hosts_and_effective_roles(
+                    [], [], [], env=fab.env,
+                )[0],
+            )
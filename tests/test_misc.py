@@ -0,0 +1,229 @@
+import os
+import shutil
+import socket
+import tempfile
+
+import mock
+import unittest2 as unittest
+
+from fabric import api as fab
+
+from fabricio.misc import AvailableVagrantHosts
+
+ssh_config = """Host vm1
+  HostName 127.0.0.1
+  User vagrant
+  Port 2222
+  IdentityFile /vm1/private_key
+
+Host vm2
+  HostName 127.0.0.1
+  User vagrant
+  Port 2200
+  IdentityFile /vm2/private_key
+"""
+
+
+class AvailableVagrantHostsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+        os.makedirs(os.path.join('.vagrant', 'machines'))
+        with open('Vagrantfile', 'w') as vagrantfile:
+            vagrantfile.write('Vagrantfile')
+        self.fab_settings = fab.settings(fab.hide('everything'))
+        self.fab_settings.__enter__()
+        self.key_filename = fab.env.key_filename
+
+    def tearDown(self):
+        fab.env.key_filename = self.key_filename
+        self.fab_settings.__exit__(None, None, None)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def local(command, capture=False):
+        if command == 'vagrant ssh-config':
+            return ssh_config.strip()  # output is stripped by Fabric
+        return ''
+
+    def test_hosts(self):
+        cases = dict(
+            default=dict(
+                init_kwargs=dict(),
+                ips=None,
+                expected_local_calls=[
+                    mock.call('vagrant up --parallel'),
+                    mock.call('vagrant ssh-config', capture=True),
+                ],
+                expected_hosts=[
+                    'vagrant@127.0.0.1:2222',
+                    'vagrant@127.0.0.1:2200',
+                ],
+            ),
+            serial=dict(
+                init_kwargs=dict(parallel=False),
+                ips=None,
+                expected_local_calls=[
+                    mock.call('vagrant up'),
+                    mock.call('vagrant ssh-config', capture=True),
+                ],
+                expected_hosts=[
+                    'vagrant@127.0.0.1:2222',
+                    'vagrant@127.0.0.1:2200',
+                ],
+            ),
+            with_guest_network_interface=dict(
+                init_kwargs=dict(guest_network_interface='eth1'),
+                ips={
+                    'vagrant@127.0.0.1:2222': '192.168.0.1',
+                    'vagrant@127.0.0.1:2200': '192.168.0.2',
+                },
+                expected_local_calls=[
+                    mock.call('vagrant up --parallel'),
+                    mock.call('vagrant ssh-config', capture=True),
+                ],
+                expected_hosts=[
+                    'vagrant@192.168.0.1',
+                    'vagrant@192.168.0.2',
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(
+                    fab,
+                    'local',
+                    side_effect=self.local,
+                ) as local:
+                    with mock.patch.object(
+                        fab,
+                        'execute',
+                        return_value=data['ips'],
+                    ) as execute:
+                        hosts = AvailableVagrantHosts(**data['init_kwargs'])
+                        self.assertListEqual(
+                            data['expected_hosts'],
+                            list(hosts),
+                        )
+                self.assertListEqual(
+                    data['expected_local_calls'],
+                    local.mock_calls,
+                )
+                self.assertListEqual(
+                    ['/vm1/private_key', '/vm2/private_key'],
+                    fab.env.key_filename,
+                )
+                self.assertEqual(
+                    data['ips'] is not None and 1 or 0,
+                    execute.call_count,
+                )
+
+    def test_ip_not_found(self):
+        ips = {
+            'vagrant@127.0.0.1:2222': '192.168.0.1',
+            'vagrant@127.0.0.1:2200': '',
+        }
+        with mock.patch.object(fab, 'local', side_effect=self.local):
+            with mock.patch.object(fab, 'execute', return_value=ips):
+                hosts = AvailableVagrantHosts(guest_network_interface='eth1')
+                with self.assertRaises(ValueError):
+                    list(hosts)
+
+    def test_cache(self):
+        ips = {
+            'vagrant@127.0.0.1:2222': '192.168.0.1',
+            'vagrant@127.0.0.1:2200': '192.168.0.2',
+        }
+        expected_hosts = ['vagrant@192.168.0.1', 'vagrant@192.168.0.2']
+
+        def get_hosts(reachable=True):
+            with mock.patch.object(
+                fab,
+                'local',
+                side_effect=self.local,
+            ) as local:
+                with mock.patch.object(
+                    fab,
+                    'execute',
+                    return_value=ips,
+                ) as execute:
+                    with mock.patch.object(
+                        socket,
+                        'create_connection',
+                        side_effect=None if reachable else socket.error,
+                    ) as create_connection:
+                        hosts = list(AvailableVagrantHosts(
+                            guest_network_interface='eth1',
+                            use_cache=True,
+                        ))
+            return hosts, local, execute, create_connection
+
+        hosts, local, execute, create_connection = get_hosts()
+        self.assertListEqual(expected_hosts, hosts)
+        self.assertEqual(1, execute.call_count)
+        create_connection.assert_not_called()
+
+        # VMs are running, nothing is run
+        fab.env.key_filename = None
+        hosts, local, execute, create_connection = get_hosts()
+        self.assertListEqual(expected_hosts, hosts)
+        self.assertListEqual(
+            ['/vm1/private_key', '/vm2/private_key'],
+            fab.env.key_filename,
+        )
+        local.assert_not_called()
+        execute.assert_not_called()
+        self.assertListEqual(
+            [
+                mock.call(('192.168.0.1', 22), 1),
+                mock.call(('192.168.0.2', 22), 1),
+            ],
+            create_connection.call_args_list,
+        )
+
+        # VMs are halted, they are started, other commands are skipped
+        hosts, local, execute, create_connection = get_hosts(reachable=False)
+        self.assertListEqual(expected_hosts, hosts)
+        self.assertListEqual(
+            [mock.call('vagrant up --parallel')],
+            local.mock_calls,
+        )
+        execute.assert_not_called()
+
+        with open('Vagrantfile', 'w') as vagrantfile:
+            vagrantfile.write('changed Vagrantfile')
+        hosts, local, execute, create_connection = get_hosts()
+        self.assertListEqual(expected_hosts, hosts)
+        self.assertEqual(2, local.call_count)
+        self.assertEqual(1, execute.call_count)
+        create_connection.assert_not_called()
+
+    def test_cache_key(self):
+        hosts = AvailableVagrantHosts(use_cache=True)
+        key = hosts.cache_key
+        self.assertEqual(key, AvailableVagrantHosts(use_cache=True).cache_key)
+        self.assertNotEqual(
+            key,
+            AvailableVagrantHosts(guest_network_interface='eth1').cache_key,
+        )
+        machine_dir = os.path.join('.vagrant', 'machines', 'vm1')
+        os.makedirs(machine_dir)
+        with open(os.path.join(machine_dir, 'id'), 'w') as id_file:
+            id_file.write('id')
+        self.assertNotEqual(key, hosts.cache_key)
+
+    def test_load_cache(self):
+        hosts = AvailableVagrantHosts(use_cache=True)
+        self.assertIsNone(hosts.load_cache('key'))
+        hosts.save_cache('key', hosts=['host'], keys=['key_file'])
+        self.assertDictEqual(
+            dict(key='key', hosts=['host'], keys=['key_file']),
+            hosts.load_cache('key'),
+        )
+        self.assertIsNone(hosts.load_cache('another_key'))
+        with open(hosts.cache_file, 'w') as cache_file:
+            cache_file.write('invalid')
+        self.assertIsNone(hosts.load_cache('key'))
@@ -0,0 +1,260 @@
+import subprocess
+import threading
+
+import mock
+import six
+import unittest2 as unittest
+
+from fabric import api as fab, state
+from fabric.network import ssh
+
+import fabricio
+
+from fabricio import docker, shell, tasks
+
+from tests import SucceededResult
+
+
+class BashChannel(object):
+    """
+    Fake SSH channel which runs shell in local subprocess
+    """
+
+    def __init__(self):
+        self.process = None
+        self.closed = False
+        self.buffers = dict(stdout=b'', stderr=b'')
+        self.lock = threading.Lock()
+
+    def exec_command(self, command):
+        self.process = subprocess.Popen(
+            command.split(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        for name in ('stdout', 'stderr'):
+            thread = threading.Thread(target=self.read, args=(name, ))
+            thread.daemon = True
+            thread.start()
+
+    def read(self, name):
+        stream = getattr(self.process, name)
+        for line in iter(stream.readline, b''):
+            with self.lock:
+                self.buffers[name] += line
+
+    def pop(self, name, size):
+        with self.lock:
+            data = self.buffers[name][:size]
+            self.buffers[name] = self.buffers[name][size:]
+        return data
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def recv_ready(self):
+        return bool(self.buffers['stdout'])
+
+    def recv_stderr_ready(self):
+        return bool(self.buffers['stderr'])
+
+    def recv(self, size):
+        return self.pop('stdout', size)
+
+    def recv_stderr(self, size):
+        return self.pop('stderr', size)
+
+    def exit_status_ready(self):
+        return self.process.poll() is not None
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+class PersistentShellTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.channels = []
+        self.transport = mock.Mock()
+        self.transport.is_active.return_value = True
+        self.transport.open_session.side_effect = self.open_session
+        self.connection = mock.Mock()
+        self.connection.get_transport.return_value = self.transport
+        self.fab_settings = fab.settings(
+            fab.hide('everything', 'aborts'),
+            host_string='user@host:22',
+            shell='/bin/sh -c',
+        )
+        self.fab_settings.__enter__()
+        self.connections = mock.patch.dict(
+            'fabric.state.connections',
+            {'user@host:22': self.connection},
+        )
+        self.connections.start()
+
+    def tearDown(self):
+        shell.close_all()
+        self.connections.stop()
+        self.fab_settings.__exit__(None, None, None)
+
+    def open_session(self):
+        channel = BashChannel()
+        channel.transport = self.transport
+        self.channels.append(channel)
+        return channel
+
+    def test_run(self):
+        with fab.settings(warn_only=True):
+            result = shell.run('echo "$0 out"; echo err >&2; cd /; exit 3')
+        self.assertEqual('/bin/sh out', result)
+        self.assertEqual('err', result.stderr)
+        self.assertEqual(3, result.return_code)
+        self.assertTrue(result.failed)
+
+        result = shell.run('cat; echo done')  # stdin isn't consumed
+        self.assertEqual('done', result)
+        self.assertTrue(result.succeeded)
+
+        self.assertEqual(1, len(self.channels))
+
+    def test_run_keeps_working_dir_and_subshell_isolated(self):
+        with fab.cd('/tmp'):
+            self.assertEqual('/tmp', shell.run('pwd'))
+        shell.run('cd /tmp')
+        self.assertNotEqual('/tmp', shell.run('pwd'))
+        self.assertEqual(1, len(self.channels))
+
+    def test_run_aborts_on_error(self):
+        with fab.settings(abort_exception=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                shell.run('false')
+        self.assertEqual('ok', shell.run('echo ok'))
+
+    def test_shell_is_reopened_after_exit(self):
+        shell.run('true')
+        self.channels[0].close()
+        self.assertEqual('ok', shell.run('echo ok'))
+        self.assertEqual(2, len(self.channels))
+
+    @mock.patch.object(fab, 'run', return_value='fallback')
+    def test_fallback_to_fab_run(self, run):
+        cases = dict(
+            unsupported_option=dict(
+                kwargs=dict(pty=False),
+                expected_call=mock.call(
+                    'command',
+                    stdout=None,
+                    stderr=None,
+                    timeout=None,
+                    pty=False,
+                ),
+            ),
+            shell_can_not_be_opened=dict(
+                kwargs=dict(),
+                open_error=ssh.SSHException,
+                expected_call=mock.call(
+                    'command',
+                    stdout=None,
+                    stderr=None,
+                    timeout=None,
+                ),
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                run.reset_mock()
+                self.transport.open_session.side_effect = data.get(
+                    'open_error',
+                    self.open_session,
+                )
+                self.assertEqual(
+                    'fallback',
+                    shell.run('command', **data['kwargs']),
+                )
+                self.assertListEqual([data['expected_call']], run.mock_calls)
+
+    def test_fabricio_run_uses_persistent_shell(self):
+        with fab.settings(persistent_shell=True):
+            self.assertEqual('ok', fabricio.run('echo ok'))
+            with mock.patch.object(fab, 'sudo', return_value='sudo') as sudo:
+                sudo.__name__ = 'sudo'
+                self.assertEqual('sudo', fabricio.run('echo ok', sudo=True))
+        self.assertEqual(1, len(self.channels))
+
+    def test_tty_commands_use_fab_run(self):
+        with fab.settings(persistent_shell=True):
+            with mock.patch.object(
+                fab,
+                'run',
+                return_value=SucceededResult('result'),
+            ) as run:
+                run.__name__ = 'run'
+                docker.Image('image:tag').run('cmd')
+                docker.Container(name='name').execute('cmd')
+        self.assertListEqual(
+            [
+                mock.call(
+                    'docker run --rm --tty --interactive image:tag cmd',
+                    stdout=None,
+                    stderr=None,
+                    timeout=None,
+                ),
+                mock.call(
+                    'docker exec --tty --interactive name cmd',
+                    stdout=None,
+                    stderr=None,
+                    timeout=None,
+                ),
+            ],
+            run.mock_calls,
+        )
+        self.assertListEqual([], self.channels)
+
+    def test_running_line_is_written_to_stdout(self):
+        output = six.StringIO()
+        with fab.settings(fab.show('running')):
+            shell.run('true', stdout=output)
+        self.assertEqual('[user@host:22] run: true\n', output.getvalue())
+
+    @mock.patch.object(shell.PersistentShell, 'recv_size', 7)
+    def test_long_output_in_small_chunks(self):
+        result = shell.run('seq 1 20000; seq 1 100 >&2')
+        self.assertListEqual(
+            [str(number) for number in range(1, 20001)],
+            result.splitlines(),
+        )
+        self.assertEqual(100, len(result.stderr.splitlines()))
+
+    def test_connection_is_opened_outside_of_global_lock(self):
+        locked = []
+
+        class Connections(dict):
+
+            def __getitem__(self, key):
+                locked.append(shell._lock.locked())
+                return dict.__getitem__(self, key)
+
+        connections = Connections({'user@host:22': self.connection})
+        with mock.patch.object(state, 'connections', connections):
+            self.assertEqual('ok', shell.run('echo ok'))
+        self.assertListEqual([False], locked)
+
+    def test_deploy_closes_shells(self):
+        tasks_list = tasks.DockerTasks(
+            container=docker.Container(name='name', image='image'),
+        )
+        with fab.settings(persistent_shell=True):
+            fabricio.run('true')
+            with mock.patch.object(fab, 'execute'):
+                tasks_list.deploy()
+        self.assertEqual(1, len(self.channels))
+        self.assertTrue(self.channels[0].closed)
+        self.assertDictEqual({}, shell._shells)
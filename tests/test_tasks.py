@@ -1,17 +1,22 @@
+import contextlib
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
 
 import mock
 import six
 import unittest2 as unittest
 
 from fabric import api as fab
-from fabric.contrib import console
+from fabric.contrib import console, project
 from fabric.main import load_tasks_from_module, is_task_module, is_task_object
 
 import fabricio
 
 from fabricio import docker, tasks
+from tests import SucceededResult, FailedResult
 
 
 class TestContainer(docker.Container):
@@ -209,6 +214,27 @@ class DockerTasksTestCase(unittest.TestCase):
         revert.assert_called_once()
         rollback.reset_mock()
 
+        # older version
+        fab.execute(tasks_list.rollback, generation='2')
+        self.assertListEqual(
+            [mock.call.migrate_back(generation=2), mock.call.revert(generation=2)],
+            rollback.mock_calls,
+        )
+
+    def test_rollback_container_without_generations_support(self):
+        class Container(docker.Container):
+
+            def revert(self):
+                calls.append('revert')
+
+            def migrate_back(self):
+                calls.append('migrate_back')
+
+        calls = []
+        tasks_list = tasks.DockerTasks(container=Container('name'), hosts=['host'])
+        fab.execute(tasks_list.rollback)
+        self.assertListEqual(['migrate_back', 'revert'], calls)
+
     def test_pull_raises_error_if_no_ssh_tunnel_credentials_can_be_obtained(self):
         tasks_list = tasks.DockerTasks(
             container=docker.Container(name='name', image='image'),
@@ -583,6 +609,540 @@ class DockerTasksTestCase(unittest.TestCase):
                         tasks_list.delete_dangling_images()
                         local.assert_called_once_with(data['expected_command'])
 
+    @mock.patch.object(docker.ImageArchive, 'make_delta', return_value=1048576)
+    @mock.patch.object(fab, 'put')
+    @mock.patch.object(tempfile, 'mkstemp')
+    @mock.patch.object(os, 'close')
+    @mock.patch.object(os, 'remove')
+    @mock.patch.object(os.path, 'getsize', return_value=1048576)
+    @mock.patch.object(fabricio, 'run')
+    @mock.patch.object(fabricio, 'local')
+    def test_pull_with_image_transfer(self, local, run, getsize, remove, close, mkstemp, put, make_delta):
+        cases = dict(
+            default=dict(
+                tasks_class=tasks.DockerTasks,
+                init_kwargs=dict(),
+                expected_local_calls=[
+                    mock.call('docker save --output saved.tar image:tag'),
+                ],
+                expected_run_calls=[
+                    mock.call("docker images --quiet --no-trunc | xargs docker inspect --type image --format '{{json .RootFS.Layers}}'", ignore_errors=True),
+                    mock.call('mktemp'),
+                    mock.call('docker load --input /tmp/remote', quiet=False),
+                    mock.call('rm -f /tmp/remote', ignore_errors=True, sudo=False),
+                ],
+            ),
+            image_build_with_registry=dict(
+                tasks_class=tasks.ImageBuildDockerTasks,
+                init_kwargs=dict(registry='registry'),
+                expected_local_calls=[
+                    mock.call('docker save --output saved.tar registry/image:tag'),
+                ],
+                expected_run_calls=[
+                    mock.call("docker images --quiet --no-trunc | xargs docker inspect --type image --format '{{json .RootFS.Layers}}'", ignore_errors=True),
+                    mock.call('mktemp'),
+                    mock.call('docker load --input /tmp/remote', quiet=False),
+                    mock.call('rm -f /tmp/remote', ignore_errors=True, sudo=False),
+                    mock.call('docker tag registry/image:tag image:tag'),
+                    mock.call('docker rmi registry/image:tag'),
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                for mocked in (local, run, remove, put, make_delta):
+                    mocked.reset_mock()
+                run.side_effect = [
+                    SucceededResult('["sha256:a", "sha256:b"]\nnull\n'),
+                    SucceededResult('/tmp/remote'),
+                    SucceededResult(),
+                    SucceededResult(),
+                    SucceededResult(),
+                    SucceededResult(),
+                ]
+                mkstemp.side_effect = [(None, 'saved.tar'), (None, 'delta.tar.gz')]
+                tasks_list = data['tasks_class'](
+                    container=docker.Container(name='name', image='image'),
+                    transfer_images=True,
+                    hosts=['host'],
+                    **data['init_kwargs']
+                )
+                fab.execute(tasks_list.pull, tag='tag')
+                self.assertListEqual(data['expected_local_calls'], local.mock_calls)
+                self.assertListEqual(data['expected_run_calls'], run.mock_calls)
+                make_delta.assert_called_once_with('delta.tar.gz', chains=[['sha256:a', 'sha256:b'], []])
+                put.assert_called_once_with('delta.tar.gz', '/tmp/remote')
+                remove.assert_called_once_with('delta.tar.gz')
+
+    def test_prepare_and_push_with_image_transfer(self):
+        cases = dict(
+            without_registry=dict(
+                tasks_class=tasks.DockerTasks,
+                init_kwargs=dict(),
+                expected_calls=[
+                    mock.call('docker pull image:tag', quiet=False, use_cache=True),
+                    mock.call('for img in $(docker images --filter "dangling=true" --quiet); do docker rmi "$img"; done'),
+                ],
+            ),
+            with_registry=dict(
+                tasks_class=tasks.DockerTasks,
+                init_kwargs=dict(registry='registry'),
+                expected_calls=[
+                    mock.call('docker pull image:tag', quiet=False, use_cache=True),
+                    mock.call('for img in $(docker images --filter "dangling=true" --quiet); do docker rmi "$img"; done'),
+                ],
+            ),
+            image_build=dict(
+                tasks_class=tasks.ImageBuildDockerTasks,
+                init_kwargs=dict(),
+                expected_calls=[
+                    mock.call('docker build --tag image:tag --pull .', quiet=False, use_cache=True),
+                    mock.call('for img in $(docker images --filter "dangling=true" --quiet); do docker rmi "$img"; done'),
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                tasks_list = data['tasks_class'](
+                    container=docker.Container(name='name', image='image'),
+                    transfer_images=True,
+                    hosts=['host'],
+                    **data['init_kwargs']
+                )
+                with mock.patch.object(fabricio, 'local') as local:
+                    fab.execute(tasks_list.prepare, tag='tag')
+                    fab.execute(tasks_list.push, tag='tag')
+                self.assertListEqual(data['expected_calls'], local.mock_calls)
+
+    def test_deploy_with_local_registry(self):
+        cases = dict(
+            default=dict(
+                failed_task=None,
+                expected_calls=[
+                    mock.call.start(),
+                    mock.call.execute('prepare', tag='tag'),
+                    mock.call.execute('push', tag='tag'),
+                    mock.call.execute('pull', tag='tag'),
+                    mock.call.stop(),
+                    mock.call.execute('migrate', tag='tag'),
+                    mock.call.execute('update', tag='tag', force=False),
+                ],
+            ),
+            pull_failed=dict(
+                failed_task='pull',
+                expected_calls=[
+                    mock.call.start(),
+                    mock.call.execute('prepare', tag='tag'),
+                    mock.call.execute('push', tag='tag'),
+                    mock.call.execute('pull', tag='tag'),
+                    mock.call.stop(),
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                deploy = mock.Mock()
+                local_registry = mock.Mock(registry='localhost:5000', port=5000)
+                local_registry.start = deploy.start
+                local_registry.stop = deploy.stop
+                tasks_list = tasks.DockerTasks(
+                    container=docker.Container(name='name', image='image'),
+                    local_registry=local_registry,
+                    hosts=['host'],
+                )
+                self.assertEqual('localhost:5000', tasks_list.registry)
+                self.assertEqual(5000, tasks_list.ssh_tunnel_port)
+
+                def execute(task, **kwargs):
+                    deploy.execute(task.name, **kwargs)
+                    if task.name == data['failed_task']:
+                        raise RuntimeError
+
+                with mock.patch.object(fab, 'execute', side_effect=execute):
+                    try:
+                        tasks_list.deploy(tag='tag')
+                    except RuntimeError:
+                        pass
+                self.assertListEqual(data['expected_calls'], deploy.mock_calls)
+
+    def test_resolve_digest(self):
+        pull = mock.call('docker pull registry:5000/user/image:tag', ignore_errors=True)
+        inspect = mock.call("docker inspect --type image --format '{{json .RepoDigests}}' registry:5000/user/image:tag", capture=True, ignore_errors=True)
+        cases = dict(
+            refreshed=dict(
+                side_effect=[
+                    SucceededResult(),
+                    SucceededResult('["user/image@sha256:other", "registry:5000/user/image@sha256:digest"]'),
+                ],
+                expected_digest='sha256:digest',
+                expected_calls=[pull, inspect],
+            ),
+            stale_local_image=dict(
+                # local image must not be used if it can't be refreshed
+                side_effect=[
+                    FailedResult(),
+                    SucceededResult('["registry:5000/user/image@sha256:stale"]'),
+                ],
+                expected_digest=None,
+                expected_calls=[pull],
+            ),
+            not_found=dict(
+                side_effect=[
+                    SucceededResult(),
+                    FailedResult(),
+                ],
+                expected_digest=None,
+                expected_calls=[pull, inspect],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(fabricio, 'local', side_effect=data['side_effect']) as local:
+                    tasks_list = tasks.DockerTasks(
+                        container=docker.Container(name='name', image='user/image'),
+                        registry='registry:5000',
+                        use_digest=True,
+                    )
+                    self.assertEqual(data['expected_digest'], tasks_list.resolve_digest(tag='tag'))
+                    self.assertEqual(data['expected_digest'], tasks_list.digest)
+                    self.assertListEqual(data['expected_calls'], local.mock_calls)
+
+    @mock.patch.object(fab, 'remote_tunnel', return_value=mock.MagicMock())
+    def test_pull_by_digest(self, *args):
+        cases = dict(
+            image_registry=dict(
+                image='registry:5000/image',
+                init_kwargs=dict(),
+                expected_calls=[
+                    mock.call('docker pull registry:5000/image@sha256:digest', quiet=False),
+                    mock.call('docker tag registry:5000/image@sha256:digest registry:5000/image:tag'),
+                    mock.call('docker rmi registry:5000/image@sha256:digest'),
+                ],
+            ),
+            custom_registry=dict(
+                image='image',
+                init_kwargs=dict(registry='registry:5000'),
+                expected_calls=[
+                    mock.call('docker pull registry:5000/image@sha256:digest', quiet=False),
+                    mock.call('docker tag registry:5000/image@sha256:digest image:tag'),
+                    mock.call('docker rmi registry:5000/image@sha256:digest'),
+                ],
+            ),
+            ssh_tunnel=dict(
+                image='image',
+                init_kwargs=dict(registry='registry:5000', ssh_tunnel_port=1234),
+                expected_calls=[
+                    mock.call('docker pull localhost:1234/image@sha256:digest', quiet=False),
+                    mock.call('docker tag localhost:1234/image@sha256:digest image:tag'),
+                    mock.call('docker rmi localhost:1234/image@sha256:digest'),
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(fabricio, 'run') as run:
+                    tasks_list = tasks.DockerTasks(
+                        container=docker.Container(name='name', image=data['image']),
+                        hosts=['host'],
+                        **data['init_kwargs']
+                    )
+                    fab.execute(tasks_list.pull, tag='tag', digest='sha256:digest')
+                    self.assertListEqual(data['expected_calls'], run.mock_calls)
+
+    def test_pull_creates_standby_container(self):
+        tasks_list = tasks.DockerTasks(
+            container=docker.Container(name='name', image='image', use_standby=True),
+            hosts=['host'],
+        )
+        with mock.patch.object(fabricio, 'run') as run:
+            with mock.patch.object(docker.Container, 'create_standby_container') as create_standby_container:
+                fab.execute(tasks_list.pull, tag='tag')
+                run.assert_called_once_with('docker pull image:tag', quiet=False)
+                create_standby_container.assert_called_once_with(tag='tag')
+
+    def test_deploy_with_digest(self):
+        tasks_list = tasks.DockerTasks(
+            container=docker.Container(name='name', image='image'),
+            registry='registry',
+            use_digest=True,
+            hosts=['host'],
+        )
+        with mock.patch.object(fab, 'execute') as execute:
+            with mock.patch.object(tasks_list, 'resolve_digest', return_value='sha256:digest'):
+                tasks_list.deploy(tag='tag')
+        self.assertListEqual(
+            [
+                mock.call(tasks_list.prepare, tag='tag'),
+                mock.call(tasks_list.push, tag='tag'),
+                mock.call(tasks_list.pull, tag='tag', digest='sha256:digest'),
+                mock.call(tasks_list.migrate, tag='tag'),
+                mock.call(tasks_list.update, tag='tag', force=False),
+            ],
+            execute.mock_calls,
+        )
+
+    def test_deploy_skip_up_to_date(self):
+        cases = dict(
+            all_hosts_up_to_date=dict(
+                check_results=dict(host1=True, host2=True),
+                expected_tasks=['prepare'],
+            ),
+            one_host_outdated=dict(
+                check_results=dict(host1=True, host2=False),
+                expected_tasks=['prepare', 'push', 'pull', 'migrate', 'update'],
+            ),
+            host_failed=dict(
+                check_results=dict(host1=True, host2=RuntimeError()),
+                expected_tasks=['prepare', 'push', 'pull', 'migrate', 'update'],
+            ),
+            forced=dict(
+                check_results=dict(host1=True, host2=True),
+                deploy_kwargs=dict(force=True),
+                expected_tasks=['prepare', 'push', 'pull', 'migrate', 'update'],
+                expected_checked_hosts=[],
+            ),
+            prepare_skipped=dict(
+                check_results=dict(host1=True, host2=True),
+                deploy_kwargs=dict(prepare=False),
+                expected_tasks=['pull', 'migrate', 'update'],
+                expected_checked_hosts=[],
+            ),
+            local_image_is_not_refreshed_without_registry=dict(
+                init_kwargs=dict(registry=None),
+                check_results=dict(host1=True, host2=True),
+                expected_tasks=['prepare', 'push', 'pull', 'migrate', 'update'],
+                expected_checked_hosts=[],
+            ),
+            image_transfer=dict(
+                init_kwargs=dict(registry=None, transfer_images=True),
+                check_results=dict(host1=True, host2=True),
+                expected_tasks=['prepare'],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                init_kwargs = dict(registry='registry')
+                init_kwargs.update(data.get('init_kwargs', {}))
+                tasks_list = tasks.DockerTasks(
+                    container=docker.Container(name='name', image='image'),
+                    skip_up_to_date=True,
+                    hosts=['host1', 'host2'],
+                    **init_kwargs
+                )
+                executed_tasks = []
+                checked_hosts = []
+
+                def is_up_to_date(image_id):
+                    self.assertEqual('sha256:id', image_id)
+                    checked_hosts.append(fab.env.host)
+                    result = data['check_results'][fab.env.host]
+                    if isinstance(result, Exception):
+                        raise result
+                    return result
+
+                with mock.patch.object(
+                    fab,
+                    'execute',
+                    side_effect=lambda task, **kwargs: executed_tasks.append(task.name),
+                ):
+                    with mock.patch.object(
+                        docker.Container,
+                        'is_up_to_date',
+                        side_effect=is_up_to_date,
+                    ):
+                        with mock.patch.object(fabricio, 'local', return_value=SucceededResult('sha256:id\n')):
+                            tasks_list.deploy(tag='tag', **data.get('deploy_kwargs', {}))
+                self.assertListEqual(data['expected_tasks'], executed_tasks)
+                self.assertListEqual(
+                    data.get('expected_checked_hosts', ['host1', 'host2']),
+                    sorted(checked_hosts),
+                )
+
+    def test_deploy_skip_up_to_date_without_local_image(self):
+        tasks_list = tasks.DockerTasks(
+            container=docker.Container(name='name', image='image'),
+            registry='registry',
+            skip_up_to_date=True,
+            hosts=['host'],
+        )
+        executed_tasks = []
+        with mock.patch.object(fab, 'execute', side_effect=lambda task, **kwargs: executed_tasks.append(task.name)):
+            with mock.patch.object(fabricio, 'local', return_value=FailedResult()):
+                tasks_list.deploy()
+        self.assertListEqual(['prepare', 'push', 'pull', 'migrate', 'update'], executed_tasks)
+
+    def test_pool_size(self):
+        cases = dict(
+            default=dict(
+                init_kwargs=dict(),
+                expected_tasks=['prepare', 'push', 'pull', 'migrate', 'update'],
+                expected_pulled_hosts=[],
+            ),
+            pool_size=dict(
+                init_kwargs=dict(pool_size=10),
+                expected_tasks=['prepare', 'push', 'migrate', 'update'],
+                expected_pulled_hosts=['host1', 'host2'],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                tasks_list = tasks.DockerTasks(
+                    container=docker.Container(name='name'),
+                    hosts=['host1', 'host2'],
+                    **data['init_kwargs']
+                )
+                executed_tasks = []
+                pulled_hosts = []
+                with mock.patch.object(
+                    fab,
+                    'execute',
+                    side_effect=lambda task, **kwargs: executed_tasks.append(task.name),
+                ):
+                    with mock.patch.object(
+                        tasks.DockerTasks,
+                        'pull_registry_image',
+                        side_effect=lambda **kwargs: pulled_hosts.append(fab.env.host),
+                    ):
+                        tasks_list.deploy(tag='tag')
+                self.assertListEqual(data['expected_tasks'], executed_tasks)
+                self.assertListEqual(data['expected_pulled_hosts'], sorted(pulled_hosts))
+
+    def test_pool_size_aborts_if_pull_failed(self):
+        tasks_list = tasks.DockerTasks(
+            container=docker.Container(name='name'),
+            hosts=['host1', 'host2'],
+            pool_size=2,
+        )
+
+        def pull_registry_image(**kwargs):
+            if fab.env.host == 'host2':
+                raise RuntimeError('pull failed')
+
+        with mock.patch.object(fab, 'execute') as execute:
+            with mock.patch.object(
+                tasks.DockerTasks,
+                'pull_registry_image',
+                side_effect=pull_registry_image,
+            ):
+                with mock.patch.object(fab, 'abort', side_effect=SystemExit) as abort:
+                    with self.assertRaises(SystemExit):
+                        tasks_list.deploy(tag='tag')
+        abort.assert_called_once_with('pull failed:\nhost2: pull failed')
+        self.assertNotIn('update', [call[1][0].name for call in execute.mock_calls])
+
+    def test_status(self):
+        def run(command, **kwargs):
+            self.assertEqual(
+                "docker inspect --type container --format '{{.State.Status}} {{.Config.Image}}' name",
+                command,
+            )
+            if fab.env.host == 'host2':
+                return FailedResult()
+            if fab.env.host == 'host3':
+                raise RuntimeError('connection error')
+            return SucceededResult('running image:tag\n')
+
+        tasks_list = tasks.DockerTasks(
+            container=docker.Container(name='name'),
+            hosts=['host1', 'host2', 'host3'],
+        )
+        with mock.patch.object(fabricio, 'run', side_effect=run):
+            results = fab.execute(tasks_list.status)['<local-only>']
+        self.assertListEqual(['host1', 'host2', 'host3'], list(results))
+        self.assertEqual('running image:tag', results['host1'])
+        self.assertIsNone(results['host2'])
+        self.assertIsInstance(results['host3'], RuntimeError)
+
+    def test_check_hosts(self):
+        outputs = dict(
+            host1='19.03.5\n2097152\n1048576\n',
+            host2='19.03.5\n1024\n1048576\n',
+            host3=RuntimeError('Cannot connect to the Docker daemon'),
+        )
+
+        def run(command, **kwargs):
+            self.assertEqual(tasks.DockerTasks.preflight_command, command)
+            output = outputs[fab.env.host]
+            if isinstance(output, Exception):
+                raise output
+            return SucceededResult(output)
+
+        cases = dict(
+            all_hosts_ok=dict(
+                hosts=['host1'],
+                expected_error=None,
+            ),
+            some_hosts_failed=dict(
+                hosts=['host1', 'host2', 'host3'],
+                expected_error=(
+                    'Pre-flight check failed:\n'
+                    'host2: only 1 MiB of free disk space\n'
+                    'host3: Cannot connect to the Docker daemon'
+                ),
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                tasks_list = tasks.DockerTasks(
+                    container=docker.Container(name='name'),
+                    hosts=data['hosts'],
+                )
+                with mock.patch.object(fabricio, 'run', side_effect=run):
+                    with mock.patch.object(
+                        fab,
+                        'abort',
+                        side_effect=SystemExit,
+                    ) as abort:
+                        if data['expected_error'] is None:
+                            results = tasks_list.check_hosts()
+                            self.assertEqual('19.03.5', results['host1'])
+                        else:
+                            with self.assertRaises(SystemExit):
+                                tasks_list.check_hosts()
+                            abort.assert_called_once_with(
+                                data['expected_error'],
+                            )
+
+    def test_deploy_with_preflight(self):
+        tasks_list = tasks.DockerTasks(
+            container=docker.Container(name='name'),
+            preflight=True,
+            hosts=['host1', 'host2'],
+        )
+        executed_tasks = []
+        with mock.patch.object(
+            fab,
+            'execute',
+            side_effect=lambda task, **kwargs: executed_tasks.append(task.name),
+        ):
+            with mock.patch.object(
+                fabricio,
+                'run',
+                side_effect=RuntimeError('connection refused'),
+            ):
+                with mock.patch.object(fab, 'abort', side_effect=SystemExit):
+                    with self.assertRaises(SystemExit):
+                        tasks_list.deploy()
+            self.assertListEqual([], executed_tasks)
+            with mock.patch.object(
+                fabricio,
+                'run',
+                return_value=SucceededResult('19.03.5\n2097152\n1048576\n'),
+            ):
+                tasks_list.deploy()
+        self.assertListEqual(
+            ['prepare', 'push', 'pull', 'migrate', 'update'],
+            executed_tasks,
+        )
+
+    def test_local_registry_and_registry_can_not_be_used_together(self):
+        with self.assertRaises(ValueError):
+            tasks.DockerTasks(
+                container=docker.Container(name='name'),
+                registry='registry',
+                local_registry=True,
+            )
+
 
 class PullDockerTasksTestCase(unittest.TestCase):
 
@@ -1300,6 +1860,221 @@ class ImageBuildDockerTasksTestCase(unittest.TestCase):
                     fab.execute(tasks_list.prepare, **data['kwargs'])
                     self.assertListEqual(local.mock_calls, data['expected_calls'])
 
+    @mock.patch.object(tasks.ImageBuildDockerTasks, 'get_build_fingerprint', return_value='fp')
+    def test_prepare_with_build_fingerprint(self, *args):
+        find_image = mock.call('docker images --quiet --filter label=fabricio.build.fingerprint=fp --filter reference=registry/image | head -1', capture=True, ignore_errors=True)
+        build = mock.call('docker build --tag registry/image:latest --pull --label fabricio.build.fingerprint=fp .', quiet=False, use_cache=True)
+        delete_dangling_images = mock.call('for img in $(docker images --filter "dangling=true" --quiet); do docker rmi "$img"; done')
+        pull = mock.call('docker pull registry/image:latest', ignore_errors=True, use_cache=True)
+        inspect = mock.call('docker inspect --type image --format \'{{index .Config.Labels "fabricio.build.fingerprint"}}\' registry/image:latest', capture=True, ignore_errors=True)
+        cases = dict(
+            found_locally=dict(
+                side_effect=[
+                    SucceededResult('image_id'),
+                    SucceededResult(),
+                ],
+                expected_calls=[
+                    find_image,
+                    mock.call('docker tag image_id registry/image:latest'),
+                ],
+            ),
+            found_in_registry=dict(
+                side_effect=[
+                    SucceededResult(),
+                    SucceededResult(),
+                    SucceededResult('fp'),
+                ],
+                expected_calls=[find_image, pull, inspect],
+            ),
+            changed=dict(
+                side_effect=[
+                    SucceededResult(),
+                    SucceededResult(),
+                    SucceededResult('old_fp'),
+                    SucceededResult(),
+                    SucceededResult(),
+                ],
+                expected_calls=[
+                    find_image,
+                    pull,
+                    inspect,
+                    build,
+                    delete_dangling_images,
+                ],
+            ),
+            not_found_in_registry=dict(
+                side_effect=[
+                    SucceededResult(),
+                    FailedResult(),
+                    SucceededResult(),
+                    SucceededResult(),
+                ],
+                expected_calls=[
+                    find_image,
+                    pull,
+                    build,
+                    delete_dangling_images,
+                ],
+            ),
+            no_cache=dict(
+                kwargs=dict(no_cache='yes'),
+                side_effect=[
+                    SucceededResult(),
+                    SucceededResult(),
+                ],
+                expected_calls=[
+                    mock.call('docker build --tag registry/image:latest --no-cache --pull .', quiet=False, use_cache=True),
+                    delete_dangling_images,
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(fabricio, 'local', side_effect=data['side_effect']) as local:
+                    tasks_list = tasks.ImageBuildDockerTasks(
+                        container=docker.Container(name='name', image='image'),
+                        registry='registry',
+                        use_build_fingerprint=True,
+                        hosts=['host'],
+                    )
+                    fab.execute(tasks_list.prepare, **data.get('kwargs', {}))
+                    self.assertListEqual(data['expected_calls'], local.mock_calls)
+
+    def test_prepare_cache_from(self):
+        pull = mock.call('docker pull registry/image:latest', ignore_errors=True, use_cache=True)
+        delete_dangling_images = mock.call('for img in $(docker images --filter "dangling=true" --quiet); do docker rmi "$img"; done')
+        cases = dict(
+            previous_image_pulled=dict(
+                init_kwargs=dict(registry='registry', use_cache_from=True),
+                side_effect=[SucceededResult(), SucceededResult(), SucceededResult()],
+                expected_calls=[
+                    pull,
+                    mock.call('docker build --tag registry/image:latest --pull --cache-from registry/image:latest .', quiet=False, use_cache=True),
+                    delete_dangling_images,
+                ],
+            ),
+            previous_image_not_found=dict(
+                init_kwargs=dict(registry='registry', use_cache_from=True),
+                side_effect=[FailedResult(), SucceededResult(), SucceededResult()],
+                expected_calls=[
+                    pull,
+                    mock.call('docker build --tag registry/image:latest --pull .', quiet=False, use_cache=True),
+                    delete_dangling_images,
+                ],
+            ),
+            inline_cache=dict(
+                init_kwargs=dict(registry='registry', use_cache_from=True, inline_cache=True),
+                side_effect=[SucceededResult(), SucceededResult(), SucceededResult()],
+                expected_calls=[
+                    pull,
+                    mock.call('docker build --tag registry/image:latest --pull --cache-from registry/image:latest --build-arg BUILDKIT_INLINE_CACHE=1 .', quiet=False, use_cache=True),
+                    delete_dangling_images,
+                ],
+            ),
+            no_registry=dict(
+                init_kwargs=dict(use_cache_from=True),
+                side_effect=[SucceededResult(), SucceededResult()],
+                expected_calls=[
+                    mock.call('docker build --tag image:latest --pull .', quiet=False, use_cache=True),
+                    delete_dangling_images,
+                ],
+            ),
+            disabled_by_default=dict(
+                init_kwargs=dict(registry='registry'),
+                side_effect=[SucceededResult(), SucceededResult()],
+                expected_calls=[
+                    mock.call('docker build --tag registry/image:latest --pull .', quiet=False, use_cache=True),
+                    delete_dangling_images,
+                ],
+            ),
+            no_cache=dict(
+                init_kwargs=dict(registry='registry', use_cache_from=True),
+                prepare_kwargs=dict(no_cache='yes'),
+                side_effect=[SucceededResult(), SucceededResult()],
+                expected_calls=[
+                    mock.call('docker build --tag registry/image:latest --no-cache --pull .', quiet=False, use_cache=True),
+                    delete_dangling_images,
+                ],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(fabricio, 'local', side_effect=data['side_effect']) as local:
+                    tasks_list = tasks.ImageBuildDockerTasks(
+                        container=docker.Container(name='name', image='image'),
+                        hosts=['host'],
+                        **data['init_kwargs']
+                    )
+                    fab.execute(tasks_list.prepare, **data.get('prepare_kwargs', {}))
+                    self.assertListEqual(data['expected_calls'], local.mock_calls)
+
+    def test_build_host_and_transfer_images_are_incompatible(self):
+        with self.assertRaises(ValueError):
+            tasks.ImageBuildDockerTasks(
+                container=docker.Container(name='name', image='image'),
+                build_host='build_host',
+                transfer_images=True,
+            )
+
+    def test_prepare_and_push_on_build_host(self):
+        build_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, build_path)
+        for path in ('Dockerfile', 'app/main.py', 'app/main.pyc', '.dockerignore'):
+            full_path = os.path.join(build_path, path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, 'w') as context_file:
+                context_file.write('**/*.pyc' if path == '.dockerignore' else path)
+        filters = []
+
+        def rsync_project(extra_opts, **kwargs):
+            self.assertEqual('build_host', fab.env.host_string)
+            filters_path = extra_opts.split()[1].rstrip("'")
+            with open(filters_path) as filters_file:
+                filters.extend(filters_file.read().splitlines())
+
+        tasks_list = tasks.ImageBuildDockerTasks(
+            container=docker.Container(name='name', image='user/image'),
+            registry='registry',
+            build_path=build_path,
+            build_host='build_host',
+            use_cache_from=True,
+            hosts=['host'],
+        )
+        with mock.patch.object(project, 'rsync_project', side_effect=rsync_project) as rsync:
+            with mock.patch.object(fabricio, 'local') as local:
+                with mock.patch.object(fabricio, 'run', side_effect=lambda *args, **kwargs: SucceededResult()) as run:
+                    fab.execute(tasks_list.prepare)
+                    fab.execute(tasks_list.push)
+        local.assert_not_called()
+        self.assertListEqual(
+            [
+                mock.call('docker pull registry/user/image:latest', ignore_errors=True, use_cache=True),
+                mock.call('mkdir -p /tmp/fabricio/build/user_image'),
+                mock.call('docker build --tag registry/user/image:latest --pull --cache-from registry/user/image:latest /tmp/fabricio/build/user_image', quiet=False, use_cache=True),
+                mock.call('for img in $(docker images --filter "dangling=true" --quiet); do docker rmi "$img"; done'),
+                mock.call('docker push registry/user/image:latest', quiet=False, use_cache=True),
+            ],
+            run.mock_calls,
+        )
+        rsync.assert_called_once_with(
+            remote_dir='/tmp/fabricio/build/user_image',
+            local_dir=os.path.join(build_path, ''),
+            delete=True,
+            extra_opts=mock.ANY,
+        )
+        self.assertIn('--delete-excluded', rsync.call_args[1]['extra_opts'])
+        self.assertListEqual(
+            [
+                '+ /.dockerignore',
+                '+ /Dockerfile',
+                '+ /app/',
+                '+ /app/main.py',
+                '- *',
+            ],
+            filters,
+        )
+
     def test_prepare_and_push_are_in_the_commands_list_by_default(self):
         init_kwargs = dict(container='container')
         expected_commands_list = ['pull', 'rollback', 'update', 'deploy', 'prepare', 'push']
@@ -1307,3 +2082,166 @@ class ImageBuildDockerTasksTestCase(unittest.TestCase):
         docstring, new_style, classic, default = load_tasks_from_module(tasks_list)
         for expected_command in expected_commands_list:
             self.assertIn(expected_command, new_style)
+
+
+class SynchronousProcess(object):
+
+    exitcode = 0
+
+    def __init__(self, target, args=(), kwargs=None):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+
+    def start(self):
+        self.target(*self.args, **self.kwargs)
+
+    def join(self):
+        pass
+
+
+class KilledProcess(SynchronousProcess):
+
+    exitcode = -9
+
+    def start(self):
+        pass  # dies without reporting result
+
+
+@mock.patch('multiprocessing.Process', SynchronousProcess)
+@mock.patch('multiprocessing.Queue', six.moves.queue.Queue)
+@mock.patch.object(
+    tasks.MultiImageBuildTasks,
+    '_prefix_output',
+    staticmethod(lambda prefix: contextlib.closing(mock.Mock())),
+)
+class MultiImageBuildTasksTestCase(unittest.TestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        self.fab_settings = fab.settings(fab.hide('everything'))
+        self.fab_settings.__enter__()
+        self.build_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.fab_settings.__exit__(None, None, None)
+        shutil.rmtree(self.build_path)
+
+    def make_build_tasks(self, image, dockerfile):
+        build_path = tempfile.mkdtemp(dir=self.build_path)
+        with open(os.path.join(build_path, 'Dockerfile'), 'w') as file:
+            file.write(dockerfile)
+        return tasks.ImageBuildDockerTasks(
+            container=docker.Container(name=image, image=image),
+            registry='registry',
+            build_path=build_path,
+        )
+
+    def make_tasks(self, workers=2):
+        return tasks.MultiImageBuildTasks(
+            [
+                self.make_build_tasks(
+                    'app',
+                    'FROM --platform=linux/amd64 registry/base:latest AS build\n'
+                    'FROM build\n',
+                ),
+                self.make_build_tasks('base', 'FROM \\\n  debian\n'),
+                self.make_build_tasks('other', 'FROM scratch'),
+            ],
+            workers=workers,
+        )
+
+    def test_get_dependencies(self):
+        self.assertListEqual(
+            [set([1]), set(), set()],
+            self.make_tasks().get_dependencies(),
+        )
+
+    def test_prepare(self):
+        cases = dict(
+            single_worker=dict(
+                workers=1,
+                expected_images=['base', 'app', 'other'],
+            ),
+            several_workers=dict(
+                workers=2,
+                expected_images=['base', 'other', 'app'],
+            ),
+        )
+        for case, data in cases.items():
+            with self.subTest(case=case):
+                with mock.patch.object(fabricio, 'local') as local:
+                    multi_tasks = self.make_tasks(workers=data['workers'])
+                    fab.execute(multi_tasks.prepare, tag='tag')
+                    built_images = [
+                        build_call[1][0].split()[3].split('/')[1][:-4]
+                        for build_call in local.mock_calls
+                        if build_call[1][0].startswith('docker build')
+                    ]
+                    self.assertListEqual(data['expected_images'], built_images)
+
+    def test_prepare_aborts_if_build_failed(self):
+        def local(command, **kwargs):
+            if command.startswith('docker build --tag registry/base:'):
+                raise RuntimeError('build failed')
+        with mock.patch.object(fabricio, 'local', side_effect=local) as local:
+            multi_tasks = self.make_tasks(workers=1)
+            with self.assertRaises(SystemExit):
+                with fab.hide('aborts'):
+                    fab.execute(multi_tasks.prepare)
+            self.assertEqual(1, len(local.mock_calls))
+
+    def test_push(self):
+        with mock.patch.object(fabricio, 'local') as local:
+            multi_tasks = self.make_tasks()
+            fab.execute(multi_tasks.push)
+            self.assertListEqual(
+                [
+                    mock.call('docker push registry/app:latest', quiet=False, use_cache=True),
+                    mock.call('docker push registry/base:latest', quiet=False, use_cache=True),
+                    mock.call('docker push registry/other:latest', quiet=False, use_cache=True),
+                ],
+                [call for call in local.mock_calls if 'push' in call[1][0]],
+            )
+
+    def test_prepare_aborts_if_worker_died(self):
+        with mock.patch('multiprocessing.Process', KilledProcess):
+            with mock.patch.object(fabricio, 'local'):
+                multi_tasks = self.make_tasks(workers=1)
+                multi_tasks.poll_interval = 0.01
+                with mock.patch.object(
+                    fab,
+                    'abort',
+                    side_effect=SystemExit,
+                ) as abort:
+                    with self.assertRaises(SystemExit):
+                        fab.execute(multi_tasks.prepare)
+        abort.assert_called_once_with(
+            'prepare failed:\n'
+            'registry/base:latest: process exited with code -9'
+        )
+
+    def test_prefix_output(self):
+        script = (
+            'import os, sys\n'
+            'from fabricio.tasks import MultiImageBuildTasks\n'
+            'with MultiImageBuildTasks._prefix_output("[image] "):\n'
+            '    sys.stdout.write("python\\n")\n'
+            '    os.system("echo out; echo err >&2")\n'
+            'sys.stdout.write("done\\n")\n'
+        )
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen(
+            [sys.executable, '-W', 'ignore', '-c', script],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+        stdout, stderr = process.communicate()
+        self.assertEqual(0, process.returncode)
+        self.assertEqual(
+            b'[image] python\n[image] out\ndone\n',
+            stdout,
+        )
+        self.assertIn(b'[image] err\n', stderr)
@@ -1,5 +1,7 @@
 import unittest2 as unittest
 
+from frozendict import frozendict
+
 from fabricio.utils import Options, OrderedDict
 
 
@@ -7,7 +9,6 @@ class OptionsTestCase(unittest.TestCase):
 
     def test_str_version(self):
         cases = dict(
-            # TODO all values must be quoted
             empty_options_list=dict(
                 options=OrderedDict(),
                 expected_str_version='',
@@ -18,23 +19,23 @@ class OptionsTestCase(unittest.TestCase):
             ),
             multiword=dict(
                 options=OrderedDict(foo='bar baz'),
-                expected_str_version='--foo "bar baz"',
+                expected_str_version="--foo 'bar baz'",
             ),
             empty=dict(
                 options=OrderedDict(foo=''),
-                expected_str_version='--foo ""',
+                expected_str_version="--foo ''",
             ),
             with_single_quotes=dict(
                 options=OrderedDict(foo="'bar'"),
-                expected_str_version='--foo "\'bar\'"',
+                expected_str_version='--foo \'\'"\'"\'bar\'"\'"\'\'',
             ),
             with_double_quotes=dict(
                 options=OrderedDict(foo='"bar"'),
-                expected_str_version='--foo "\\"bar\\""',
+                expected_str_version='--foo \'"bar"\'',
             ),
             with_quotes_and_spaces=dict(
                 options=OrderedDict(foo='"bar" \'baz\''),
-                expected_str_version='--foo "\\"bar\\" \'baz\'"',
+                expected_str_version='--foo \'"bar" \'"\'"\'baz\'"\'"\'\'',
             ),
             single_length=dict(
                 options=OrderedDict(foo='bar'),
@@ -68,11 +69,56 @@ class OptionsTestCase(unittest.TestCase):
                 ]),
                 expected_str_version='--foo foo --bar --baz 1 --baz a',
             ),
-            # TODO empty value
-            # TODO escaped value
+            with_shell_special_characters=dict(
+                options=OrderedDict(foo='$HOME; rm -rf `pwd`'),
+                expected_str_version="--foo '$HOME; rm -rf `pwd`'",
+            ),
+            multi_value_with_spaces=dict(
+                options=OrderedDict(foo=['bar baz', 42, None]),
+                expected_str_version="--foo 'bar baz' --foo 42",
+            ),
+            mapping=dict(
+                options=OrderedDict(env=dict(FOO='foo bar', BAR='bar')),
+                expected_str_version="--env BAR=bar --env 'FOO=foo bar'",
+            ),
+            ordered_mapping=dict(
+                options=OrderedDict(env=OrderedDict([('FOO', 'foo'), ('BAR', 'bar')])),
+                expected_str_version='--env FOO=foo --env BAR=bar',
+            ),
         )
         for case, params in cases.items():
             with self.subTest(case=case):
                 options = Options(params['options'])
                 expected_str_version = params['expected_str_version']
                 self.assertEqual(expected_str_version, str(options))
+
+    def test_non_ascii_and_immutable_mapping_values(self):
+        options = Options([
+            ('env', [u'A=\xfc']),
+            ('label', frozendict(FOO='foo', BAR='bar')),
+        ])
+        self.assertListEqual(
+            [u"--env 'A=\xfc'", '--label BAR=bar', '--label FOO=foo'],
+            list(options.make_options()),
+        )
+
+    def test_make_argv(self):
+        options = Options([
+            ('foo', 'bar baz'),
+            ('flag', True),
+            ('disabled', False),
+            ('none', None),
+            ('integer', 42),
+            ('list', ['1', 'a']),
+            ('env', dict(FOO='"foo"')),
+        ])
+        self.assertListEqual(
+            [
+                '--foo', 'bar baz',
+                '--flag',
+                '--integer', '42',
+                '--list', '1', '--list', 'a',
+                '--env', 'FOO="foo"',
+            ],
+            options.make_argv(),
+        )